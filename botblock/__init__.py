@@ -1,3 +1,3 @@
 """A modern, self-hosted, privacy-respecting CAPTCHA solution"""
 
-__all__ = ['captcha']
+__all__ = ['archives', 'benchmarks', 'captcha', 'events', 'keys', 'limits', 'series', 'server', 'soak', 'stores']
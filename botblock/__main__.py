@@ -0,0 +1,122 @@
+"""Command line interface for running BotBlock services"""
+
+from argparse import ArgumentParser
+from json import load
+from signal import SIGTERM, signal
+
+
+def load_settings_file(path):
+    """Returns a Settings instance created from a JSON file of setting names and values"""
+
+    from botblock.captcha import Settings
+
+    if not path:
+        return Settings()
+    with open(path) as settings_file:
+        return Settings(**load(settings_file))
+
+
+def serve(arguments):
+    """Runs an Engine daemon that shares its pool with Clients over a Unix domain socket"""
+
+    from botblock.captcha import Engine
+    from botblock.server import Server
+
+    def stop(signal_number, frame):
+        raise KeyboardInterrupt
+
+    signal(SIGTERM, stop)
+    engine = Engine(load_settings_file(arguments.settings))
+    server = Server(engine, arguments.socket, int(arguments.permissions, 8))
+    print(f'BotBlock Engine listening on {arguments.socket}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shut_down()
+        engine.shut_down()
+
+
+def soak(arguments):
+    """Runs a soak test against an Engine, and exits with an error if it fails"""
+
+    from botblock.soak import run_soak_test
+
+    summary = run_soak_test(
+        settings = load_settings_file(arguments.settings),
+        patterns = arguments.patterns.split(','),
+        duration = arguments.duration,
+        workers = arguments.workers,
+        sample_interval = arguments.interval,
+        report_path = arguments.report,
+        max_rss_growth = arguments.max_rss_growth,
+        max_thread_growth = arguments.max_thread_growth,
+        max_latency = arguments.max_latency,
+        max_empty_pool_samples = arguments.max_empty_pool_samples,
+    )
+    if not summary['Passed']:
+        raise SystemExit(1)
+
+
+def generate(arguments):
+    """Generates CAPTCHAs ahead of time, into a packed archive that can be served without an Engine"""
+
+    from botblock.archives import generate_archive
+    from botblock.keys import KeyRing
+
+    generate_archive(
+        arguments.output,
+        arguments.count,
+        KeyRing(path = arguments.key_file),
+        settings = load_settings_file(arguments.settings),
+        workers = arguments.workers,
+        chunk_size = arguments.chunk_size,
+    )
+
+
+def main(argv = None):
+    """Parses command line arguments and runs the requested command"""
+
+    parser = ArgumentParser(prog = 'python -m botblock', description = 'BotBlock command line interface')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    serve_parser = commands.add_parser('serve', help = 'run a shared Engine daemon on a Unix domain socket')
+    serve_parser.add_argument('--socket', required = True, help = 'path of the Unix domain socket to create')
+    serve_parser.add_argument('--settings', default = '', help = 'path of a JSON file of custom settings')
+    serve_parser.add_argument('--permissions', default = '600', help = 'octal file permissions for the socket')
+    serve_parser.set_defaults(function = serve)
+
+    generate_parser = commands.add_parser('generate', help = 'generate CAPTCHAs ahead of time, into a packed archive')
+    generate_parser.add_argument('--count', required = True, type = int, help = 'number of CAPTCHAs the archive should hold')
+    generate_parser.add_argument('--output', required = True, help = 'path of the archive, without a file extension')
+    generate_parser.add_argument('--key-file', required = True, help = 'path of the key file used to hash the solutions')
+    generate_parser.add_argument('--settings', default = '', help = 'path of a JSON file of custom settings')
+    generate_parser.add_argument('--workers', default = 0, type = int, help = 'number of worker processes (0 for one per CPU)')
+    generate_parser.add_argument('--chunk-size', default = 100, type = int, help = 'number of CAPTCHAs per unit of work')
+    generate_parser.set_defaults(function = generate)
+
+    soak_parser = commands.add_parser('soak', help = 'drive an Engine with traffic for a long time, and check it for leaks')
+    soak_parser.add_argument('--settings', default = '', help = 'path of a JSON file of custom settings')
+    soak_parser.add_argument('--patterns', default = 'steady,burst,replay,expired', help = 'comma-separated traffic patterns')
+    soak_parser.add_argument('--duration', default = 3600, type = float, help = 'length of the test, in seconds')
+    soak_parser.add_argument('--workers', default = 4, type = int, help = 'number of concurrent traffic threads')
+    soak_parser.add_argument('--interval', default = 10, type = float, help = 'seconds between samples')
+    soak_parser.add_argument('--report', default = '', help = 'path of the JSONL time series report to write')
+    soak_parser.add_argument('--max-rss-growth', default = 0.25, type = float, help = 'maximum fractional RSS growth')
+    soak_parser.add_argument('--max-thread-growth', default = 2, type = int, help = 'maximum growth in the number of threads')
+    soak_parser.add_argument('--max-latency', default = 1.0, type = float, help = 'maximum p99 latency, in seconds')
+    soak_parser.add_argument(
+        '--max-empty-pool-samples',
+        default = 3,
+        type = int,
+        help = 'maximum number of samples in a row with an empty pool',
+    )
+    soak_parser.set_defaults(function = soak)
+
+    arguments = parser.parse_args(argv)
+    arguments.function(arguments)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""Contains the packed archives used to generate large numbers of CAPTCHAs ahead of time, and to serve them"""
+
+from hashlib import sha256
+from hmac import compare_digest, digest
+from json import dump, dumps, load, loads
+from os import cpu_count, getpid
+from pathlib import Path
+from struct import Struct
+from time import perf_counter
+
+
+_ARCHIVE_VERSION = 1
+# Each index record is the offset and length of a CAPTCHA image in the image file:
+_INDEX_RECORD = Struct('<QI')
+# Each manifest record is a truncated HMAC of the CAPTCHA's position and (normalized) solution:
+_MANIFEST_RECORD_SIZE = 16
+
+# The Captcha instance used by each generation worker (one per process):
+_WORKER_CAPTCHAS = {}
+
+
+def _get_archive_settings(settings):
+    """Returns a dictionary of settings without those that only apply to Engines, as they are stored in an archive
+
+    Engine settings (such as POOL_SNAPSHOT_KEY) may be secret, and don't affect the archive's CAPTCHAs. The only
+    exception is CASE_SENSITIVE, which is needed to validate them.
+    """
+
+    from botblock.captcha import Settings
+
+    engine_setting_names = set(Settings()._get_engine_setting_names()) - {'CASE_SENSITIVE'}
+    return {setting: value for setting, value in settings.items() if setting not in engine_setting_names}
+
+
+def _get_archive_paths(path):
+    """Returns the paths of an archive's metadata, image, index, and manifest files"""
+
+    path = str(path)
+    return {
+        'metadata': Path(path + '.json'),
+        'images': Path(path + '.bin'),
+        'index': Path(path + '.idx'),
+        'manifest': Path(path + '.manifest'),
+    }
+
+
+def _get_key_id(mac_key):
+    """Returns a short, public identifier for a MAC key, so that the key can be found in a KeyRing later"""
+
+    return sha256(b'botblock-archive-key-id' + mac_key).hexdigest()[:16]
+
+
+def _get_solution_tag(mac_key, archive_id, index, solution, case_sensitive):
+    """Returns the manifest record for a CAPTCHA, which binds its solution to its archive and position"""
+
+    if not case_sensitive:
+        solution = solution.lower()
+    return digest(mac_key, archive_id + index.to_bytes(8, 'big') + solution.encode(), sha256)[:_MANIFEST_RECORD_SIZE]
+
+
+def _generate_chunk(size):
+    """Generates a number of CAPTCHAs in a worker process, returning the image data and solution of each"""
+
+    captcha = _WORKER_CAPTCHAS[getpid()]
+    results = []
+    for _ in range(size):
+        captcha.generate()
+        results.append((captcha.get_image_data(), captcha.get_solution()))
+    return results
+
+
+def _initialize_worker(settings):
+    """Creates the Captcha instance used by a generation worker"""
+
+    from botblock.captcha import Captcha
+
+    _WORKER_CAPTCHAS[getpid()] = Captcha(settings)
+
+
+def _recover_archive(paths):
+    """Truncates an interrupted archive to its last complete CAPTCHA, and returns the number of complete CAPTCHAs"""
+
+    # The index is written last, so a CAPTCHA is only complete once its index record and manifest record both exist:
+    complete_captchas = min(
+        paths['index'].stat().st_size // _INDEX_RECORD.size,
+        paths['manifest'].stat().st_size // _MANIFEST_RECORD_SIZE,
+    )
+    images_size = 0
+    if complete_captchas:
+        with open(paths['index'], 'rb') as index_file:
+            index_file.seek((complete_captchas - 1) * _INDEX_RECORD.size)
+            offset, length = _INDEX_RECORD.unpack(index_file.read(_INDEX_RECORD.size))
+        images_size = offset + length
+    if paths['images'].stat().st_size < images_size:
+        raise ValueError('The archive\'s image file is shorter than its index, so it cannot be resumed')
+    with open(paths['images'], 'r+b') as images_file:
+        images_file.truncate(images_size)
+    with open(paths['index'], 'r+b') as index_file:
+        index_file.truncate(complete_captchas * _INDEX_RECORD.size)
+    with open(paths['manifest'], 'r+b') as manifest_file:
+        manifest_file.truncate(complete_captchas * _MANIFEST_RECORD_SIZE)
+    return complete_captchas
+
+
+def generate_archive(path, count, key_ring, settings = None, workers = 0, chunk_size = 100, report_interval = 5):
+    """Generates CAPTCHAs across a pool of processes, and appends them to the archive at path until it holds count
+
+    The archive is made up of four files: path.bin (the concatenated CAPTCHA images), path.idx (the offset and
+    length of each image), path.manifest (a keyed hash of each solution), and path.json (the archive's metadata).
+    Solutions are never stored in plaintext, so the archive can only be validated by holders of the KeyRing's
+    newest key. If the archive already exists (for instance, because generating it was interrupted), generation
+    resumes after its last complete CAPTCHA. Returns a dictionary describing the throughput achieved.
+    """
+
+    from multiprocessing import Pool
+    from os import urandom
+
+    from botblock.captcha import Settings
+    from botblock.keys import KeyRing
+
+    if type(count) is not int:
+        raise TypeError('The "count" argument supplied must be an int')
+    if count < 0:
+        raise ValueError('The "count" argument supplied cannot be less than 0')
+    if not isinstance(key_ring, KeyRing):
+        raise TypeError(f'The "key_ring" argument supplied must be an instance of "KeyRing", not a "{type(key_ring)}"')
+    if settings:
+        if not isinstance(settings, Settings):
+            raise TypeError(f'The "settings" argument supplied must be an instance of "Settings", not a "{type(settings)}"')
+    else:
+        settings = Settings()
+    if (type(workers) is not int) or (workers < 0):
+        raise ValueError('The "workers" argument supplied must be an integer no less than 0')
+    if (type(chunk_size) is not int) or (chunk_size < 1):
+        raise ValueError('The "chunk_size" argument supplied must be an integer greater than 0')
+
+    paths = _get_archive_paths(path)
+    mac_key = key_ring.get_mac_keys()[0]
+    # Settings are compared as they are stored, after a round trip through JSON:
+    stored_settings = loads(dumps(_get_archive_settings(settings.get_settings())))
+    if paths['metadata'].exists():
+        with open(paths['metadata']) as metadata_file:
+            metadata = load(metadata_file)
+        if metadata['version'] != _ARCHIVE_VERSION:
+            raise ValueError(f'The archive\'s version ({metadata["version"]}) is not supported')
+        # Archives generated by earlier versions also stored the Engine settings, which are removed when they are resumed:
+        metadata['settings'] = _get_archive_settings(metadata['settings'])
+        if metadata['settings'] != stored_settings:
+            raise ValueError('The archive was generated with different settings, so it cannot be resumed')
+        if metadata['key_id'] != _get_key_id(mac_key):
+            raise ValueError('The archive was generated with a different key, so it cannot be resumed')
+        for file_path in [paths['images'], paths['index'], paths['manifest']]:
+            file_path.touch()
+        existing_captchas = _recover_archive(paths)
+    else:
+        metadata = {
+            'version': _ARCHIVE_VERSION,
+            'archive_id': urandom(16).hex(),
+            'key_id': _get_key_id(mac_key),
+            'mime_type': settings.get_mime_type(),
+            'settings': stored_settings,
+        }
+        for file_path in [paths['images'], paths['index'], paths['manifest']]:
+            file_path.write_bytes(b'')
+        existing_captchas = 0
+    metadata['count'] = max(count, existing_captchas)
+    # The metadata is written first, so that an interrupted archive can always be resumed:
+    with open(paths['metadata'], 'w') as metadata_file:
+        dump(metadata, metadata_file, indent = 4)
+
+    archive_id = bytes.fromhex(metadata['archive_id'])
+    captchas_to_generate = max(0, count - existing_captchas)
+    chunks = [min(chunk_size, captchas_to_generate - i) for i in range(0, captchas_to_generate, chunk_size)]
+    workers = workers or cpu_count() or 1
+    if existing_captchas:
+        print(f'Resuming after {existing_captchas} CAPTCHAs already in the archive.')
+    print(f'Generating {captchas_to_generate} CAPTCHAs with {workers} workers...')
+
+    start_time = perf_counter()
+    last_report_time = start_time
+    captchas_generated = 0
+    images_size = paths['images'].stat().st_size
+    with open(paths['images'], 'ab') as images_file, \
+            open(paths['index'], 'ab') as index_file, \
+            open(paths['manifest'], 'ab') as manifest_file, \
+            Pool(workers, initializer = _initialize_worker, initargs = (settings,)) as pool:
+        # Chunks are returned in order, so each CAPTCHA's position in the archive is known when it is written:
+        for results in pool.imap(_generate_chunk, chunks):
+            index_records = []
+            manifest_records = []
+            for image_data, solution in results:
+                captcha_index = existing_captchas + captchas_generated + len(index_records)
+                index_records.append(_INDEX_RECORD.pack(images_size, len(image_data)))
+                manifest_records.append(
+                    _get_solution_tag(mac_key, archive_id, captcha_index, solution, settings._CASE_SENSITIVE)
+                )
+                images_size += len(image_data)
+            images_file.write(b''.join(image_data for image_data, _ in results))
+            manifest_file.write(b''.join(manifest_records))
+            images_file.flush()
+            manifest_file.flush()
+            # Writing the index last marks the chunk's CAPTCHAs as complete:
+            index_file.write(b''.join(index_records))
+            index_file.flush()
+            captchas_generated += len(results)
+            current_time = perf_counter()
+            if current_time - last_report_time >= report_interval:
+                last_report_time = current_time
+                print(
+                    f'{existing_captchas + captchas_generated} of {count} CAPTCHAs generated',
+                    f'({round(captchas_generated / (current_time - start_time), 2)} per second)...'
+                )
+
+    total_time = perf_counter() - start_time
+    stats = {
+        'Resumed From': existing_captchas,
+        'CAPTCHAs Generated': captchas_generated,
+        'CAPTCHAs in Archive': existing_captchas + captchas_generated,
+        'Archive Size': images_size,
+        'Seconds': round(total_time, 3),
+        'CAPTCHAs/Second': round(captchas_generated / total_time, 2) if total_time else 0,
+    }
+    print(
+        f"Generated {stats['CAPTCHAs Generated']} CAPTCHAs in {stats['Seconds']} seconds",
+        f"({stats['CAPTCHAs/Second']} per second); the archive now holds {stats['CAPTCHAs in Archive']}",
+        f"CAPTCHAs, with {images_size} bytes of image data."
+    )
+    return stats
+
+
+class Archive():
+    """A read-only, memory-mapped archive of pre-generated CAPTCHAs, for serving and validating them"""
+
+    def __init__(self, path, key_ring):
+        """Initializes a new Archive object, opening the archive at path (written by generate_archive)"""
+
+        from botblock.keys import KeyRing
+
+        if not isinstance(key_ring, KeyRing):
+            raise TypeError(f'The "key_ring" argument supplied must be an instance of "KeyRing", not a "{type(key_ring)}"')
+
+        paths = _get_archive_paths(path)
+        with open(paths['metadata']) as metadata_file:
+            self._metadata = load(metadata_file)
+        if self._metadata['version'] != _ARCHIVE_VERSION:
+            raise ValueError(f'The archive\'s version ({self._metadata["version"]}) is not supported')
+        self._mac_key = None
+        for mac_key in key_ring.get_mac_keys():
+            if _get_key_id(mac_key) == self._metadata['key_id']:
+                self._mac_key = mac_key
+        if self._mac_key is None:
+            raise ValueError('The KeyRing supplied does not hold the key that the archive was generated with')
+        self._archive_id = bytes.fromhex(self._metadata['archive_id'])
+        self._case_sensitive = self._metadata['settings']['CASE_SENSITIVE']
+        self._files = []
+        self._images = self._map_file(paths['images'])
+        self._index = self._map_file(paths['index'])
+        self._manifest = self._map_file(paths['manifest'])
+        # An interrupted archive may hold some incomplete CAPTCHAs, which are ignored:
+        self._count = min(len(self._index) // _INDEX_RECORD.size, len(self._manifest) // _MANIFEST_RECORD_SIZE)
+
+    def __enter__(self):
+        """Enter the runtime context and return this object"""
+
+        return self
+
+    def _map_file(self, path):
+        """Returns a read-only memory map of a file (or empty bytes, as empty files cannot be mapped)"""
+
+        from mmap import ACCESS_READ, mmap
+
+        archive_file = open(path, 'rb')
+        self._files.append(archive_file)
+        if path.stat().st_size == 0:
+            return b''
+        return mmap(archive_file.fileno(), 0, access = ACCESS_READ)
+
+    def close(self):
+        """Closes the archive's files"""
+
+        for mapped_file in [self._images, self._index, self._manifest]:
+            if mapped_file:
+                mapped_file.close()
+        for archive_file in self._files:
+            archive_file.close()
+        self._files = []
+
+    def get_captcha(self, index):
+        """Returns the image (as bytes) and MIME type of the CAPTCHA at a position in the archive"""
+
+        if (type(index) is not int) or not (0 <= index < self._count):
+            raise IndexError(f'The archive does not hold a CAPTCHA at position {index}')
+        offset, length = _INDEX_RECORD.unpack_from(self._index, index * _INDEX_RECORD.size)
+        return {'image': self._images[offset:offset + length], 'mime_type': self._metadata['mime_type']}
+
+    def get_settings(self):
+        """Returns the settings that the archive's CAPTCHAs were generated with, as a dictionary"""
+
+        return self._metadata['settings']
+
+    def validate(self, index, proposed_solution):
+        """Returns True if a solution is correct for the CAPTCHA at a position in the archive, and False if not
+
+        Archives don't keep track of which CAPTCHAs have been solved, so preventing replays is left to the caller.
+        """
+
+        if (type(index) is not int) or not (0 <= index < self._count):
+            return False
+        expected_tag = self._manifest[index * _MANIFEST_RECORD_SIZE:(index + 1) * _MANIFEST_RECORD_SIZE]
+        proposed_tag = _get_solution_tag(self._mac_key, self._archive_id, index, proposed_solution, self._case_sensitive)
+        return compare_digest(expected_tag, proposed_tag)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Close the archive and exit the runtime context"""
+
+        self.close()
+
+    def __len__(self):
+        """Returns the number of complete CAPTCHAs in the archive"""
+
+        return self._count
@@ -0,0 +1,352 @@
+"""Contains benchmarks for measuring the performance of BotBlock's Engine and its components"""
+
+from subprocess import run
+from sys import executable
+from time import perf_counter_ns, sleep
+
+
+def benchmark_engine_startup(settings = None, runs = 3):
+    """Measures how long it takes to import BotBlock and to bring an Engine to a usable state"""
+
+    from botblock.captcha import Engine, Settings
+
+    if settings:
+        if not isinstance(settings, Settings):
+            raise TypeError(f'The "settings" argument supplied must be an instance of "Settings", not a "{type(settings)}"')
+    else:
+        settings = Settings()
+
+    print('CAPTCHA Engine Startup Benchmark')
+    print('')
+    print('For the most accurate results, please limit any other activity on your system until')
+    print(f'the benchmark completes. This benchmark will start and shut down {runs} Engine instances.')
+    print('')
+
+    # Importing must be timed in a fresh interpreter, as this one has already imported BotBlock:
+    import_script = (
+        'from time import perf_counter_ns\n'
+        'from sys import modules\n'
+        'start = perf_counter_ns()\n'
+        'import botblock.captcha\n'
+        'print(perf_counter_ns() - start, "PIL" in modules)\n'
+    )
+    import_times = []
+    pillow_loaded = False
+    for _ in range(runs):
+        result = run([executable, '-c', import_script], capture_output = True, check = True, text = True)
+        import_time, pillow_imported = result.stdout.split()
+        import_times.append(int(import_time))
+        pillow_loaded = pillow_loaded or (pillow_imported == 'True')
+    # CAPTCHAs are only rendered by the Engine's subprocesses, so validating must not load Pillow either:
+    validation_script = (
+        'from sys import modules\n'
+        'from botblock.captcha import Engine, Settings\n'
+        'engine = Engine(Settings(POOL_SIZE = 1))\n'
+        'engine.validate(engine.get_captcha()["encrypted_blob"], "")\n'
+        'engine.shut_down()\n'
+        'print("PIL" in modules)\n'
+    )
+    result = run([executable, '-c', validation_script], capture_output = True, check = True, text = True)
+    pillow_loaded_by_engine = result.stdout.split()[-1] == 'True'
+
+    ready_times = []
+    full_pool_times = []
+    for i in range(runs):
+        print(f'Benchmark run {i + 1} of {runs}...')
+        start_time = perf_counter_ns()
+        engine = Engine(settings)
+        ready_times.append(perf_counter_ns() - start_time)
+        while engine._fresh_captchas.qsize() < settings._POOL_SIZE:
+            sleep(0.01)
+        full_pool_times.append(perf_counter_ns() - start_time)
+        engine.shut_down()
+
+    print('')
+    print('')
+    print('Benchmark Results:')
+    print('')
+    print(
+        'Importing botblock.captcha took about',
+        round(sum(import_times) / runs / 1_000_000, 3),
+        'milliseconds on average.'
+    )
+    if pillow_loaded:
+        print('Pillow was loaded when importing botblock.captcha.')
+    else:
+        print('Pillow was not loaded when importing botblock.captcha.')
+    if pillow_loaded_by_engine:
+        print('Pillow was loaded by an Engine that provided and validated a CAPTCHA.')
+    else:
+        print('Pillow was not loaded by an Engine that provided and validated a CAPTCHA.')
+    print(
+        f'With a WARM_START value of {settings._WARM_START}, the Engine was usable after about',
+        round(sum(ready_times) / runs / 1_000_000_000, 3),
+        'seconds on average.'
+    )
+    print(
+        f'Filling the pool of {settings._POOL_SIZE} CAPTCHAs took about',
+        round(sum(full_pool_times) / runs / 1_000_000_000, 3),
+        'seconds on average.'
+    )
+
+
+def benchmark_replay_stores(stores = None, operations = 10000, batch_size = 100):
+    """Compares the throughput of replay stores, when adding keys one at a time and in pipelined batches"""
+
+    from secrets import token_urlsafe
+    from tempfile import TemporaryDirectory
+
+    from botblock.stores import LocalRedisServer, MemoryReplayStore, RedisReplayStore, ReplayStore, SQLiteReplayStore
+
+    temporary_directory = TemporaryDirectory()
+    local_redis_server = None
+    if stores:
+        for store in stores:
+            if not isinstance(store, ReplayStore):
+                raise TypeError(f'The "stores" argument supplied must only contain instances of "ReplayStore", not a "{type(store)}"')
+    else:
+        # The Redis replay store is benchmarked against a local stand-in, so its figures include its protocol
+        # and socket overhead, but not a real server's (which is likely to be faster than the stand-in):
+        local_redis_server = LocalRedisServer(temporary_directory.name + '/redis.sock')
+        local_redis_server.start()
+        stores = [
+            MemoryReplayStore(),
+            SQLiteReplayStore(temporary_directory.name + '/replay_store.sqlite3'),
+            RedisReplayStore(unix_socket = temporary_directory.name + '/redis.sock'),
+        ]
+
+    print('Replay Store Throughput Benchmark')
+    print('')
+    print(f'Each replay store will record {operations} keys one at a time, then {operations} keys')
+    print(f'in batches of {batch_size}, and then attempt to replay all of them in batches.')
+    print('')
+
+    results = []
+    for store in stores:
+        print(f'Benchmarking {type(store).__name__}...')
+        single_keys = [token_urlsafe(90) for _ in range(operations)]
+        batched_keys = [token_urlsafe(90) for _ in range(operations)]
+        batches = [batched_keys[i:i + batch_size] for i in range(0, operations, batch_size)]
+
+        start_time = perf_counter_ns()
+        for key in single_keys:
+            store.add(key, 600)
+        single_time = perf_counter_ns() - start_time
+
+        start_time = perf_counter_ns()
+        for batch in batches:
+            store.add_many(batch, 600)
+        batched_time = perf_counter_ns() - start_time
+
+        start_time = perf_counter_ns()
+        replays_accepted = 0
+        for batch in batches:
+            replays_accepted += sum(store.add_many(batch, 600))
+        replay_time = perf_counter_ns() - start_time
+
+        results.append((type(store).__name__, single_time, batched_time, replay_time, replays_accepted))
+        store.close()
+    if local_redis_server:
+        local_redis_server.shut_down()
+    temporary_directory.cleanup()
+
+    print('')
+    print('')
+    print('Benchmark Results (In Operations per Second):')
+    print('')
+    for name, single_time, batched_time, replay_time, replays_accepted in results:
+        print(f'{name}:')
+        print(f'    Single Adds:     {round(operations / (single_time / 1_000_000_000), 2)}')
+        print(f'    Batched Adds:    {round(operations / (batched_time / 1_000_000_000), 2)}')
+        print(f'    Batched Replays: {round(operations / (replay_time / 1_000_000_000), 2)}')
+        if replays_accepted:
+            print(f'    WARNING: {replays_accepted} replayed keys were incorrectly accepted!')
+
+
+def benchmark_encoder_profiles(profiles = None, settings = None, samples = 25):
+    """Compares the size and encoding time of CAPTCHA images for different formats and encoder options"""
+
+    from io import BytesIO
+
+    from botblock.captcha import Captcha, Settings
+
+    if settings:
+        if not isinstance(settings, Settings):
+            raise TypeError(f'The "settings" argument supplied must be an instance of "Settings", not a "{type(settings)}"')
+    else:
+        settings = Settings()
+    if not profiles:
+        profiles = [
+            {'FORMAT': 'PNG', 'ENCODER_OPTIONS': {}},
+            {'FORMAT': 'PNG', 'ENCODER_OPTIONS': {'compress_level': 1}},
+            {'FORMAT': 'PNG', 'ENCODER_OPTIONS': {'compress_level': 9, 'optimize': True}},
+            {'FORMAT': 'JPEG', 'ENCODER_OPTIONS': {}},
+            {'FORMAT': 'JPEG', 'ENCODER_OPTIONS': {'quality': 60, 'subsampling': 2, 'optimize': True}},
+            {'FORMAT': 'WEBP', 'ENCODER_OPTIONS': {'quality': 80, 'method': 4}},
+            {'FORMAT': 'WEBP', 'ENCODER_OPTIONS': {'lossless': True}},
+            {'FORMAT': 'GIF', 'ENCODER_OPTIONS': {}},
+        ]
+    # Validate every profile before starting the benchmark:
+    for profile in profiles:
+        Settings(FORMAT = profile['FORMAT'], ENCODER_OPTIONS = profile['ENCODER_OPTIONS'])
+
+    print('CAPTCHA Encoder Profile Benchmark')
+    print('')
+    print(f'{samples} CAPTCHA images will be rendered, and then encoded using each of the {len(profiles)} profiles.')
+    print('')
+    print('Rendering CAPTCHA images...')
+
+    images = []
+    captcha = Captcha(settings)
+    for _ in range(samples):
+        captcha._render()
+        images.append(captcha._image.copy())
+        captcha._clean_up()
+
+    results = []
+    for profile in profiles:
+        print(f"Encoding as {profile['FORMAT']} with options {profile['ENCODER_OPTIONS']}...")
+        total_bytes = 0
+        start_time = perf_counter_ns()
+        for image in images:
+            io = BytesIO()
+            image.save(io, profile['FORMAT'], **profile['ENCODER_OPTIONS'])
+            total_bytes += len(io.getvalue())
+        results.append((profile, total_bytes / samples, (perf_counter_ns() - start_time) / samples / 1_000_000))
+
+    print('')
+    print('')
+    print('Benchmark Results (Averages per CAPTCHA, Smallest First):')
+    print('')
+    for profile, average_bytes, average_milliseconds in sorted(results, key = lambda result: result[1]):
+        print(f"{profile['FORMAT']} {profile['ENCODER_OPTIONS']}:")
+        print(f'    Image Data Size (In Bytes): {round(average_bytes, 2)}')
+        print(f'    Encoding Time (In Milliseconds): {round(average_milliseconds, 3)}')
+
+
+def benchmark_worker_isolation(profiles = None, settings = None, samples = 200):
+    """Measures how much refilling the pool slows down other work, for different worker isolation settings"""
+
+    from hashlib import sha256
+
+    from botblock.captcha import Engine, Settings
+
+    if settings:
+        if not isinstance(settings, Settings):
+            raise TypeError(f'The "settings" argument supplied must be an instance of "Settings", not a "{type(settings)}"')
+    else:
+        settings = Settings(POOL_SIZE = 100)
+    if not profiles:
+        profiles = [
+            {},
+            {'WORKER_NICENESS': 19},
+            {'WORKER_NICENESS': 19, 'REFRESH_WORKERS': 0},
+        ]
+    # Validate every profile before starting the benchmark:
+    for profile in profiles:
+        Settings(**{**settings.get_settings(), **profile})
+
+    # A fixed amount of CPU-bound work, standing in for a request handled by the web server:
+    def measure_request_times():
+        request_times = []
+        data = bytes(65536)
+        for _ in range(samples):
+            start_time = perf_counter_ns()
+            for _ in range(20):
+                sha256(data).digest()
+            request_times.append(perf_counter_ns() - start_time)
+        return sorted(request_times)
+
+    print('CAPTCHA Generation Worker Isolation Benchmark')
+    print('')
+    print('For the most accurate results, please limit any other activity on your system until')
+    print(f'the benchmark completes. For each of the {len(profiles)} profiles, an Engine will be started,')
+    print(f'its pool of {settings._POOL_SIZE} CAPTCHAs will be emptied, and {samples} simulated requests will')
+    print('be timed while the pool refills.')
+    print('')
+    print('Timing simulated requests while idle...')
+    idle_times = measure_request_times()
+
+    results = []
+    for profile in profiles:
+        print(f'Benchmarking {profile}...')
+        profile_settings = Settings(**{**settings.get_settings(), **profile, 'WARM_START': settings._POOL_SIZE})
+        engine = Engine(profile_settings)
+        for _ in range(settings._POOL_SIZE):
+            engine.get_captcha()
+        request_times = measure_request_times()
+        refresh_workers = engine.get_stats()['Refresh Workers']
+        engine.shut_down()
+        results.append((profile, refresh_workers, request_times))
+
+    print('')
+    print('')
+    print('Benchmark Results (Simulated Request Times, In Milliseconds):')
+    print('')
+    print('While Idle:')
+    print(f'    Median: {round(idle_times[len(idle_times) // 2] / 1_000_000, 3)}')
+    print(f'    99th Percentile: {round(idle_times[int(len(idle_times) * 0.99)] / 1_000_000, 3)}')
+    for profile, refresh_workers, request_times in results:
+        print(f'While Refilling With {profile} ({refresh_workers} Refresh Workers):')
+        print(f'    Median: {round(request_times[len(request_times) // 2] / 1_000_000, 3)}')
+        print(f'    99th Percentile: {round(request_times[int(len(request_times) * 0.99)] / 1_000_000, 3)}')
+
+
+def benchmark_engine_backends(settings = None, requests = 500):
+    """Compares the startup time, request latency, and refill throughput of the processes and threads Engine backends"""
+
+    from botblock.captcha import Engine, Settings
+
+    if settings:
+        if not isinstance(settings, Settings):
+            raise TypeError(f'The "settings" argument supplied must be an instance of "Settings", not a "{type(settings)}"')
+    else:
+        settings = Settings(POOL_SIZE = 100)
+
+    print('CAPTCHA Engine Backend Benchmark')
+    print('')
+    print('For the most accurate results, please limit any other activity on your system until')
+    print(f'the benchmark completes. For each backend, an Engine will be started and its pool of {settings._POOL_SIZE}')
+    print(f'CAPTCHAs filled, {requests} CAPTCHAs will be requested and validated, and the emptied pool will be refilled.')
+    print('')
+
+    results = []
+    for backend in ['processes', 'threads']:
+        print(f'Benchmarking the {backend} backend...')
+        start_time = perf_counter_ns()
+        engine = Engine(settings, backend = backend)
+        while engine._fresh_captchas.qsize() < settings._POOL_SIZE:
+            sleep(0.01)
+        full_pool_time = perf_counter_ns() - start_time
+
+        request_times = []
+        for _ in range(requests):
+            start_time = perf_counter_ns()
+            captcha_data = engine.get_captcha()
+            engine.validate(captcha_data['encrypted_blob'], '')
+            request_times.append(perf_counter_ns() - start_time)
+        request_times.sort()
+
+        # Wait for the pool to be refilled, so that it can be emptied all at once:
+        while engine._fresh_captchas.qsize() < settings._POOL_SIZE:
+            sleep(0.01)
+        for _ in range(settings._POOL_SIZE):
+            engine.get_captcha()
+        start_time = perf_counter_ns()
+        while engine._fresh_captchas.qsize() < settings._POOL_SIZE:
+            sleep(0.01)
+        refill_time = perf_counter_ns() - start_time
+        refresh_workers = engine.get_stats()['Refresh Workers']
+        engine.shut_down()
+        results.append((backend, refresh_workers, full_pool_time, request_times, refill_time))
+
+    print('')
+    print('')
+    print('Benchmark Results:')
+    print('')
+    for backend, refresh_workers, full_pool_time, request_times, refill_time in results:
+        print(f'The {backend.title()} Backend ({refresh_workers} Refresh Workers):')
+        print(f'    Time to Fill the Pool (In Seconds): {round(full_pool_time / 1_000_000_000, 3)}')
+        print(f'    Median Request Time (In Milliseconds): {round(request_times[len(request_times) // 2] / 1_000_000, 3)}')
+        print(f'    99th Percentile Request Time (In Milliseconds): {round(request_times[int(len(request_times) * 0.99)] / 1_000_000, 3)}')
+        print(f'    Refill Throughput (In CAPTCHAs per Second): {round(settings._POOL_SIZE / (refill_time / 1_000_000_000), 2)}')
@@ -1,21 +1,46 @@
 """Contains the classes required to configure and initialize the BotBlock backend"""
 
-from base64 import b64decode, b64encode
+# Heavy dependencies (Pillow, cryptography, multiprocessing, and importlib_resources) are
+# imported where they are first needed, so that importing this module stays cheap, and so
+# that code paths which never render a CAPTCHA (such as validation) never load Pillow.
+from base64 import b64encode
 from io import BytesIO
-# Switch these once minimum supported Python version is Python 3.10:
-#from importlib.resources import files
-from importlib_resources import files
-from multiprocessing import Process, Queue
 from pathlib import Path
-from queue import Empty, Full
-from random import randrange
-from secrets import choice as secure_choice
-from secrets import randbelow as secure_randbelow
-from threading import Lock, Thread
-from time import perf_counter_ns, sleep, time
-
-from cryptography.fernet import Fernet, InvalidToken
-from PIL import Image, ImageDraw, ImageFont
+from os import urandom
+from queue import Empty, Full, Queue
+from struct import unpack
+from threading import Condition, Lock, Thread
+from time import perf_counter, perf_counter_ns, sleep, time
+
+
+# Compact tokens consist of a version byte, an issuance timestamp, a random nonce, a truncated MAC
+# authenticating the token itself, and a truncated MAC binding the token to the CAPTCHA's solution:
+_COMPACT_TOKEN_VERSION = 0x01
+# Tokens for CAPTCHAs from named profiles use the first byte of the nonce to identify the profile:
+_COMPACT_PROFILE_TOKEN_VERSION = 0x02
+# Sealed tokens authenticate their solution (bound to the nonce) ahead of time, so only the issue time is signed when issued:
+_SEALED_TOKEN_VERSION = 0x03
+_SEALED_PROFILE_TOKEN_VERSION = 0x04
+_COMPACT_TOKEN_LAYOUT = '>BQ8s8s12s'
+_COMPACT_TOKEN_BYTES = 37
+_COMPACT_TOKEN_LENGTH = 50 # Base64-encoded, without padding
+# Serial tokens also carry the issuing Engine's ID and a serial number, for the SERIAL replay protection:
+_SERIAL_TOKEN_VERSION = 0x05
+_SERIAL_PROFILE_TOKEN_VERSION = 0x06
+_SERIAL_TOKEN_LAYOUT = '>BQ8sIQ8s12s'
+_SERIAL_TOKEN_BYTES = 49
+_SERIAL_TOKEN_LENGTH = 66 # Base64-encoded, without padding
+# Fernet tokens are a version byte, a timestamp, an IV, at least one block of ciphertext, and an HMAC:
+_FERNET_TOKEN_VERSION = 0x80
+_FERNET_TOKEN_OVERHEAD = 57
+_MINIMUM_FERNET_TOKEN_LENGTH = 100 # Base64-encoded, with padding
+# Blobs are only accepted if they consist of URL-safe base64 characters:
+_BLOB_PATTERN = rb'[A-Za-z0-9_-]+={0,2}'
+
+# Each process's noise banks (see the NOISE_BANK_SIZE setting), keyed by the process and the settings they were rendered with:
+_NOISE_BANKS = {}
+# With the threads backend, several workers use the same noise banks, so they are only added and discarded under this lock:
+_NOISE_BANKS_LOCK = Lock()
 
 
 class Captcha():
@@ -28,6 +53,7 @@ class Captcha():
         self._character_position_corrections = 0
         self._font_size_total = 0
         self._generation = 0
+        self._image_data = b''
         self._image_data_size = 0
         self._layers_of_noise = 0
         self.update_settings(settings)
@@ -35,8 +61,11 @@ class Captcha():
     def _add_noise(self):
         """Adds random noise to the CAPTCHA"""
 
+        if self._settings._NOISE_BANK_SIZE:
+            self._add_noise_from_bank()
+            return
         for _ in range(self._settings._MAXIMUM_NOISE):
-            noise_type = secure_choice(
+            noise_type = self._random.choice(
                 [
                     'arc',
                     'line',
@@ -46,104 +75,142 @@ class Captcha():
             )
             if noise_type == 'arc':
                 self._layers_of_noise += 1
-                self._draw_arc()
+                self._draw_arc(self._draw, self._size, self._get_fill(self._get_color_values()))
             elif noise_type == 'line':
                 self._layers_of_noise += 1
-                self._draw_line()
+                self._draw_line(self._draw, self._size, self._get_fill(self._get_color_values()))
             elif noise_type == 'points':
                 self._layers_of_noise += 1
-                self._draw_points()
+                self._draw_points(self._draw, self._size, self._get_fill(self._get_color_values()))
             else:
                 continue
 
+    def _add_noise_from_bank(self):
+        """Adds random noise to the CAPTCHA, by compositing a randomly cropped, flipped, and colored noise bank layer"""
+
+        from PIL import Image
+
+        noise_layer, layers_of_noise = self._get_noise_bank_layer()
+        self._layers_of_noise += layers_of_noise
+        left = self._random.randbelow(noise_layer.width - self._size[0] + 1)
+        top = self._random.randbelow(noise_layer.height - self._size[1] + 1)
+        noise_layer = noise_layer.crop((left, top, left + self._size[0], top + self._size[1]))
+        if self._random.randbelow(2):
+            noise_layer = noise_layer.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+        if self._random.randbelow(2):
+            noise_layer = noise_layer.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+
+        # Each label in the noise layer (one per layer of noise) is remapped to its own, new color:
+        colors = [self._get_fill(self._get_color_values()) for _ in range(layers_of_noise)]
+        unused_labels = [0] * (255 - layers_of_noise)
+        mask = noise_layer.point([0] + ([255] * 255))
+        if self._settings._COLOR_MODE == 'P':
+            # Converting from L to P mode keeps the values, which are now palette indices:
+            noise = noise_layer.point([0] + colors + unused_labels).convert('P')
+        else:
+            noise = Image.merge(
+                'RGB',
+                [
+                    noise_layer.point([0] + [color[channel] for color in colors] + unused_labels)
+                    for channel in range(3)
+                ],
+            )
+        self._image.paste(noise, mask = mask)
+
     def _clean_up(self):
         """Cleans up generation data, to increase memory and processing efficiency"""
 
         # Store the encoded image in memory, allowing the Image object to be freed:
-        self._base64 = b''
-        self.base64()
+        self._encode()
 
         # Must remove to allow for pickling (and therefore storage in queues):
         del self._draw
+        # Never store unused randomness alongside the CAPTCHA:
+        del self._random
         # Delete other attributes that are no longer needed:
         del self._base_color
         del self._image
+        del self._palette
         del self._size
 
     def _create_image(self):
         """Generates the background image for the CAPTCHA"""
 
+        from PIL import Image
+
         self._size = (self._settings._WIDTH, self._settings._HEIGHT)
         self._base_color = self._get_color_values()
+        # In palette mode, every color used is allocated a palette entry, and drawn by its index:
+        self._palette = []
         self._image = Image.new(
-            mode = 'RGB',
+            mode = self._settings._COLOR_MODE,
             size = self._size,
-            color = self._base_color,
+            color = self._get_fill(self._base_color),
         )
 
-    def _draw_arc(self):
-        """Draws a random arc across the CAPTCHA"""
+    def _draw_arc(self, draw, size, fill):
+        """Draws a random arc across an image of the provided size"""
 
-        start_x = randrange(self._size[0] + 1)
-        start_y = randrange(self._size[1] + 1)
-        self._draw.arc(
+        start_x = self._random.randrange(size[0] + 1)
+        start_y = self._random.randrange(size[1] + 1)
+        draw.arc(
             [
                 ( # Bounding box upper left coordinates
                     start_x,
                     start_y,
                 ),
                 ( # Bounding box lower right coordinates
-                    randrange(
+                    self._random.randrange(
                         start_x,
-                        self._size[0] + 1,
+                        size[0] + 1,
                     ),
-                    randrange(
+                    self._random.randrange(
                         start_y,
-                        self._size[1] + 1,
+                        size[1] + 1,
                     ),
                 ),
             ],
-            start = randrange(360), # Starting angle
-            end = randrange(360), # Ending angle
-            fill = self._get_color_values(),
-            width = randrange(1, 5),
+            start = self._random.randrange(360), # Starting angle
+            end = self._random.randrange(360), # Ending angle
+            fill = fill,
+            width = self._random.randrange(1, 5),
         )
 
-    def _draw_line(self):
-        """Draws a random line across the CAPTCHA"""
+    def _draw_line(self, draw, size, fill):
+        """Draws a random line across an image of the provided size"""
 
-        self._draw.line(
+        draw.line(
             [
                 ( # Line starting point
-                    randrange(self._size[0] + 1),
-                    randrange(self._size[1] + 1),
+                    self._random.randrange(size[0] + 1),
+                    self._random.randrange(size[1] + 1),
                 ),
                 ( # Line ending point
-                    randrange(self._size[0] + 1),
-                    randrange(self._size[1] + 1),
+                    self._random.randrange(size[0] + 1),
+                    self._random.randrange(size[1] + 1),
                 ),
             ],
-            fill = self._get_color_values(),
-            width = randrange(1, 5),
+            fill = fill,
+            width = self._random.randrange(1, 5),
         )
 
-    def _draw_points(self):
-        """Draws a random point on the CAPTCHA"""
+    def _draw_points(self, draw, size, fill):
+        """Draws random points on an image of the provided size"""
 
-        color = self._get_color_values()
-        point_coordinates = []
-        for _ in range(randrange(300)):
-            point_coordinates.append(
-                (
-                    randrange(self._size[0] + 1),
-                    randrange(self._size[1] + 1),
-                )
+        number_of_points = self._random.randrange(300)
+        point_coordinates = list(
+            zip(
+                self._random.randbelow_many(size[0] + 1, number_of_points),
+                self._random.randbelow_many(size[1] + 1, number_of_points),
             )
-        self._draw.point(point_coordinates, fill = color)
+        )
+        draw.point(point_coordinates, fill = fill)
 
     def _draw_text(self):
         """Draws the CAPTCHA's text on the base image"""
 
+        from PIL import ImageDraw
+
         self._draw = ImageDraw.Draw(self._image)
         self._text, text_and_attributes = self._get_text_and_attributes()
         for character_and_attributes in text_and_attributes:
@@ -153,19 +220,27 @@ class Captcha():
                     character_and_attributes[3], # Vertical Position
                 ),
                 character_and_attributes[0], # Character
-                fill = character_and_attributes[4],
+                fill = self._get_fill(character_and_attributes[4]),
                 font = character_and_attributes[1],
                 anchor = 'mm',
                 direction = 'ttb',
             )
 
+    def _encode(self):
+        """Encodes the CAPTCHA image in the configured format, and stores the resulting bytes"""
+
+        io = BytesIO()
+        self._image.save(io, self._settings._FORMAT, **self._settings._ENCODER_OPTIONS)
+        self._image_data = io.getvalue()
+        self._image_data_size = len(self._image_data)
+
     def _get_character_position(self, anchor, total_anchors, size, shift_percentage, previous_char_location):
         """Calculates the (shifted) position where a character should be drawn"""
 
         anchor_spacing = size / total_anchors
         center_location = anchor_spacing * anchor
         if shift_percentage:
-            offset = secure_randbelow(shift_percentage * 2) - shift_percentage
+            offset = self._random.randbelow(shift_percentage * 2) - shift_percentage
             shifted_location = round(center_location + (anchor_spacing * (offset / 100)))
         else:
             shifted_location = center_location
@@ -196,11 +271,7 @@ class Captcha():
                 self._character_colors_evaluated += 1
                 if counter == 10000:
                     raise RuntimeError('Cannot find color with high enough contrast to background')
-                proposed_color = (
-                    randrange(256), # Red color value
-                    randrange(256), # Green color value
-                    randrange(256), # Blue color value
-                )
+                proposed_color = tuple(self._random.bytes(3)) # Red, green, and blue color values
                 proposed_color_brightness = (
                     299 * proposed_color[0] +
                     587 * proposed_color[1] +
@@ -218,19 +289,26 @@ class Captcha():
                 ):
                     return proposed_color
         else:
-            return (
-                randrange(256), # Red color value
-                randrange(256), # Green color value
-                randrange(256), # Blue color value
-            )
+            return tuple(self._random.bytes(3)) # Red, green, and blue color values
+
+    def _get_fill(self, color):
+        """Returns the fill value to draw a color with: the color itself, or its palette index in palette mode"""
+
+        if self._settings._COLOR_MODE == 'P':
+            if color not in self._palette:
+                self._palette.append(color)
+            return self._palette.index(color)
+        return color
 
     def _get_font(self):
         """Returns a random font from the FONTS setting"""
 
-        typeface = secure_choice(self._settings._FONTS)
-        default_size = self._settings._FONT_SIZES[typeface]
+        from PIL import ImageFont
+
+        typeface = self._random.choice(self._settings._FONTS)
+        default_size = self._settings._get_font_sizes()[typeface]
         if self._settings._FONT_SIZE_SHIFT_PERCENTAGE:
-            offset = secure_randbelow(self._settings._FONT_SIZE_SHIFT_PERCENTAGE * 2) \
+            offset = self._random.randbelow(self._settings._FONT_SIZE_SHIFT_PERCENTAGE * 2) \
                 - self._settings._FONT_SIZE_SHIFT_PERCENTAGE
             font_size = round(default_size + (default_size * (offset / 100)))
         else:
@@ -238,6 +316,38 @@ class Captcha():
         self._font_size_total += font_size
         return ImageFont.truetype(typeface, font_size)
 
+    def _get_noise_bank_layer(self):
+        """Returns a random layer from this process's noise bank for the current settings (and its number of layers of noise)
+
+        Layers are rendered when they are first chosen, and rendered again when they are chosen after the refresh
+        interval, so that no more than one layer is ever rendered per CAPTCHA. Each combination of settings (such as
+        each profile's) has its own bank, and banks that haven't been used for their refresh interval are discarded.
+        """
+
+        from os import getpid
+
+        current_time = time()
+        bank_key = (
+            getpid(), # Forked processes must never share noise with their parent
+            self._settings._WIDTH,
+            self._settings._HEIGHT,
+            self._settings._MAXIMUM_NOISE,
+            self._settings._NOISE_BANK_SIZE,
+        )
+        with _NOISE_BANKS_LOCK:
+            for key in [key for key, bank in _NOISE_BANKS.items() if current_time - bank['Last Used'] >= bank['Refresh Interval']]:
+                del _NOISE_BANKS[key]
+            bank = _NOISE_BANKS.setdefault(bank_key, {'Layers': [(0, None, 0)] * self._settings._NOISE_BANK_SIZE})
+            bank['Last Used'] = current_time
+            bank['Refresh Interval'] = self._settings._NOISE_BANK_REFRESH_INTERVAL
+
+        index = self._random.randbelow(self._settings._NOISE_BANK_SIZE)
+        render_time, noise_layer, layers_of_noise = bank['Layers'][index]
+        if current_time - render_time >= self._settings._NOISE_BANK_REFRESH_INTERVAL:
+            noise_layer, layers_of_noise = self._render_noise_bank_layer()
+            bank['Layers'][index] = (current_time, noise_layer, layers_of_noise)
+        return noise_layer, layers_of_noise
+
     def _get_text_and_attributes(self):
         """Returns specified or randomly-generated text with randomized attributes for the CAPTCHA"""
 
@@ -246,7 +356,7 @@ class Captcha():
             text += self._settings._TEXT
         else:
             for _ in range(self._settings._TEXT_LENGTH):
-                text += secure_choice(self._settings._CHARACTER_SET)
+                text += self._random.choice(self._settings._CHARACTER_SET)
 
         text_and_attributes = []
         text_length = len(text)
@@ -366,19 +476,50 @@ class Captcha():
 
         return text_and_attributes
 
-    def base64(self):
-        """Returns the CAPTCHA image as a base64-encoded string, for easy embedding"""
+    def _render_noise_bank_layer(self):
+        """Returns a new noise bank layer (and its number of layers of noise), with each layer of noise drawn in its own label"""
 
-        if not self._base64:
-            io = BytesIO()
-            self.save(io)
-            self._base64 = b64encode(io.getvalue()).decode()
-            self._image_data_size = len(self._base64)
-        return self._base64
+        from PIL import Image, ImageDraw
 
-    def generate(self):
-        """Generates, or regenerates and replaces, the CAPTCHA and its metadata"""
+        # Layers are larger than the CAPTCHA, so that they can be cropped at a random offset:
+        size = (self._size[0] + (self._size[0] // 2), self._size[1] + (self._size[1] // 2))
+        noise_layer = Image.new(mode = 'L', size = size, color = 0)
+        draw = ImageDraw.Draw(noise_layer)
+        layers_of_noise = 0
+        for _ in range(self._settings._MAXIMUM_NOISE):
+            noise_type = self._random.choice(
+                [
+                    'arc',
+                    'line',
+                    'points',
+                    None,
+                ]
+            )
+            if noise_type == 'arc':
+                layers_of_noise += 1
+                self._draw_arc(draw, size, layers_of_noise)
+            elif noise_type == 'line':
+                layers_of_noise += 1
+                self._draw_line(draw, size, layers_of_noise)
+            elif noise_type == 'points':
+                layers_of_noise += 1
+                self._draw_points(draw, size, layers_of_noise)
+        return noise_layer, layers_of_noise
+
+    def _release_image_data(self):
+        """Frees the CAPTCHA image once it has been served (it is replaced when the CAPTCHA is regenerated)"""
+
+        self._image_data = b''
 
+    def _render(self):
+        """Draws the CAPTCHA image, without encoding it"""
+
+        # Fetch (roughly) all of the randomness needed to draw the CAPTCHA from the OS at once:
+        self._random = _RandomSource(
+            64
+            + (max(len(self._settings._TEXT), self._settings._TEXT_LENGTH) * 128)
+            + (self._settings._MAXIMUM_NOISE * 320)
+        )
         self._character_colors_evaluated = 0
         while True:
             self._character_position_corrections = 0
@@ -391,8 +532,21 @@ class Captcha():
             except RuntimeError:
                 continue
             self._add_noise()
-            self._clean_up()
             break
+        if self._settings._COLOR_MODE == 'P':
+            self._image.putpalette([value for color in self._palette for value in color])
+
+    def base64(self):
+        """Returns the CAPTCHA image as a base64-encoded string, for easy embedding"""
+
+        # Only the raw image data is kept in memory, so the base64 string is created on demand:
+        return b64encode(self._image_data).decode()
+
+    def generate(self):
+        """Generates, or regenerates and replaces, the CAPTCHA and its metadata"""
+
+        self._render()
+        self._clean_up()
         self._generation += 1
 
     def get_stats(self):
@@ -408,6 +562,16 @@ class Captcha():
             'Settings': self._settings.get_settings(),
         }
 
+    def get_image_data(self):
+        """Returns the CAPTCHA image as bytes, encoded in the configured format"""
+
+        return self._image_data
+
+    def get_mime_type(self):
+        """Returns the MIME type of the CAPTCHA image"""
+
+        return self._settings.get_mime_type()
+
     def get_settings(self):
         """Returns the Settings instance used to generate the CAPTCHA"""
 
@@ -439,11 +603,11 @@ class Captcha():
     def save(self, full_path):
         """Saves the generated CAPTCHA to a specified file"""
 
-        if self._base64:
-            with open(full_path, 'wb') as captcha_file:
-                captcha_file.write(b64decode(self._base64))
+        if hasattr(full_path, 'write'):
+            full_path.write(self._image_data)
         else:
-            self._image.save(full_path, self._settings._FORMAT)
+            with open(full_path, 'wb') as captcha_file:
+                captcha_file.write(self._image_data)
 
     def update_settings(self, settings = None):
         """Updates the Settings instance and (re)generates the CAPTCHA with the new settings"""
@@ -466,9 +630,31 @@ class Captcha():
 class Engine():
     """A backend for handling CAPTCHA configuration, creation, and validation"""
 
-    def __init__(self, settings = None):
-        """Initializes a new Engine object for configuring, creating, and validating CAPTCHAs"""
+    def __init__(
+        self,
+        settings = None,
+        replay_store = None,
+        key_ring = None,
+        event_stream = None,
+        profiles = None,
+        backend = 'processes',
+    ):
+        """Initializes a new Engine object for configuring, creating, and validating CAPTCHAs
+
+        Additional, named Settings instances may be provided as profiles, each of which gets its own
+        pool of CAPTCHAs (sized by its POOL_SIZE setting), while sharing the Engine's subprocesses.
+        With the 'threads' backend, the Engine's workers run as threads of the current process
+        instead, for environments where starting subprocesses is forbidden or expensive.
+        """
+
+        from botblock.events import EventStream
+        from botblock.keys import KeyRing
+        from botblock.stores import MemoryReplayStore, ReplayStore, SerialReplayStore
+        from itertools import count
 
+        if backend not in ['processes', 'threads']:
+            raise ValueError(f'The "backend" argument supplied must be either "processes" or "threads", not "{backend}"')
+        self._backend = backend
         if settings:
             if isinstance(settings, Settings):
                 self._settings = settings
@@ -476,20 +662,131 @@ class Engine():
                 raise TypeError(f'The "settings" argument supplied must be an instance of "Settings", not a "{type(settings)}"')
         else:
             self._settings = Settings()
+        if replay_store:
+            if isinstance(replay_store, ReplayStore):
+                self._replay_store = replay_store
+            else:
+                raise TypeError(f'The "replay_store" argument supplied must be an instance of "ReplayStore", not a "{type(replay_store)}"')
+        else:
+            self._replay_store = MemoryReplayStore()
+        if key_ring:
+            if isinstance(key_ring, KeyRing):
+                self._key_ring = key_ring
+            else:
+                raise TypeError(f'The "key_ring" argument supplied must be an instance of "KeyRing", not a "{type(key_ring)}"')
+        else:
+            self._key_ring = KeyRing()
+        if event_stream:
+            if isinstance(event_stream, EventStream):
+                self._event_stream = event_stream
+            else:
+                raise TypeError(f'The "event_stream" argument supplied must be an instance of "EventStream", not a "{type(event_stream)}"')
+        else:
+            self._event_stream = None
+        self._profiles = {'default': self._settings}
+        self._profile_ids = {}
+        if profiles:
+            if type(profiles) is not dict:
+                raise TypeError(f'The "profiles" argument supplied must be a dict, not a "{type(profiles)}"')
+            for profile, profile_settings in profiles.items():
+                if type(profile) is not str:
+                    raise TypeError('The "profiles" argument supplied must only have keys of type "str"')
+                if profile == 'default':
+                    raise ValueError('The "default" profile is set by the "settings" argument')
+                if not isinstance(profile_settings, Settings):
+                    raise TypeError(f'The "profiles" argument supplied must only contain instances of "Settings", not a "{type(profile_settings)}"')
+                profile_id = self._get_profile_id(profile)
+                if profile_id in self._profile_ids:
+                    raise ValueError(f'The profiles "{self._profile_ids[profile_id]}" and "{profile}" cannot be told apart; please rename one of them')
+                self._profile_ids[profile_id] = profile
+                self._profiles[profile] = profile_settings
+        for profile_settings in self._profiles.values():
+            self._check_key_retention(profile_settings)
+        # Workers keep their own copies of the key ring, which only rotate to the same keys as this process's when
+        # they share a key file, so otherwise solutions are only sealed (with the newest key) when they are issued:
+        self._seal_in_workers = (self._backend == 'threads') or (not self._key_ring.get_rotation_interval()) \
+            or bool(self._key_ring.get_path())
+        # Serial numbers are only recorded by the Engine that issued them, which is identified by a random ID:
+        self._engine_id = int.from_bytes(urandom(4), 'big')
+        self._serial_numbers = count()
+        self._serial_replay_store = SerialReplayStore()
+
+        from botblock.limits import ClientThrottle, TokenBucket
+
+        self._rate_limiter = TokenBucket(
+            self._settings._get_generation_rate(),
+            self._settings._RATE_LIMIT_BURST,
+            self._settings._RATE_LIMIT_PATH,
+            shared = self._backend == 'processes',
+        )
+        # Validation attempts are only made by this process, so each client's bucket is kept in its memory:
+        self._validation_throttle = ClientThrottle(
+            self._settings._VALIDATION_RATE_LIMIT / 60,
+            self._settings._VALIDATION_RATE_LIMIT_BURST,
+        )
+
+        from botblock.series import TimeSeries
+
+        # Recent activity is recorded by every worker (and by get_captcha and validate) in fixed-size ring buffers:
+        self._time_series = TimeSeries(
+            ['Issued', 'Validated', 'Solved', 'Pool Depth', 'Refilled'],
+            shared = self._backend == 'processes',
+        )
+
         self._creation_time = time()
+        self._startup_time = 0
         self._get_queries = 0
         self._validate_queries = 0
         self._captcha_solves = 0
+        # Rejected validation attempts are counted by reason, in the order that the reasons are checked:
+        self._rejections = {
+            reason: 0 for reason in ['throttled', 'malformed', 'unsupported', 'stale', 'invalid', 'expired', 'replayed', 'mismatch']
+        }
+        # Fernet blobs longer than any profile could ever have provided are rejected without being decrypted:
+        self._maximum_fernet_length = 0
+        for profile in self._profiles:
+            self._update_maximum_fernet_length(profile)
+        # Requests are counted per priority:
+        self._priority_stats = {}
+        # get_captcha and validate may be called concurrently (by the application's own threads, or get_captcha by the
+        # threads of a Server), so the counters that they update are only changed while holding this lock:
+        self._stats_lock = Lock()
+        # Results from the validation subprocess aren't labelled, so only one blob is handed to it at a time:
+        self._validation_lock = Lock()
+        # Requests waiting for fresh CAPTCHAs are woken up whenever CAPTCHAs are added to or taken from a pool:
+        self._pool_changed = self._create_condition()
         self._shut_down = False
-        self._fernet = Fernet(Fernet.generate_key())
-        self._blob_to_validate = Queue(maxsize = 1)
-        self._blob_validation_result = Queue(maxsize = 1)
-        self._fresh_captchas = Queue(maxsize = self._settings._POOL_SIZE)
-        self._modified_settings = Queue(maxsize = 1)
-        self._stop_signal = Queue(maxsize = 3)
-        self._used_captchas = Queue(maxsize = self._settings._POOL_SIZE)
+        self._blob_to_validate = self._create_queue(1)
+        self._blob_validation_result = self._create_queue(1)
+        self._fresh_captchas = self._create_queue(self._settings._POOL_SIZE)
+        # Each profile has its own fresh CAPTCHAs, while used CAPTCHAs (from all profiles) share one queue:
+        self._profile_captchas = {'default': self._fresh_captchas}
+        for profile in self._profiles:
+            if profile != 'default':
+                self._profile_captchas[profile] = self._create_queue(self._profiles[profile]._POOL_SIZE)
+        self._modified_settings = self._create_queue(1)
+        # Fresh CAPTCHA images wait in a directory of their own, so that they can't be fetched until they are issued:
+        self._staging_directory = None
+        if self._settings._POOL_DIRECTORY:
+            from secrets import token_hex
+
+            self._staging_directory = Path(self._settings._POOL_DIRECTORY) / f'.staging-{token_hex(8)}'
+            self._staging_directory.mkdir(mode = 0o700)
+        # The encoded size of the fresh CAPTCHAs is tracked across processes, to enforce the POOL_MEMORY_LIMIT setting:
+        self._pool_memory = self._create_value(0, lock = True)
+        self._pool_memory_high_water = self._create_value(0)
+        self._pool_memory_limit = self._create_value(self._settings._POOL_MEMORY_LIMIT)
+        self._largest_pooled_captcha = self._create_value(0)
+        # The replay store is used by the validation subprocess, which reports its size whenever it expires keys:
+        self._replay_store_size = self._create_value(0)
+        self._serial_replay_memory = self._create_value(0)
+        self._refresh_workers = self._settings._REFRESH_WORKERS or self._get_cpu_limit()
+        # One stop signal for each subprocess:
+        self._stop_signal = self._create_queue(2 + self._refresh_workers)
+        self._used_captchas = self._create_queue(sum(settings._POOL_SIZE for settings in self._profiles.values()))
 
         self._start_subprocesses()
+        self._wait_for_warm_start()
 
     def __enter__(self):
         """Enter the runtime context and return this object or raise an exception"""
@@ -498,21 +795,203 @@ class Engine():
             raise RuntimeError('This engine is shut down')
         return self
 
+    def _add_to_pool(self, captcha, wait = False):
+        """Makes a Captcha instance available as a fresh CAPTCHA if it fits in the pool's memory budget, and returns True if it does
+
+        Otherwise, the Captcha instance either waits for room (if wait is True), or releases its image
+        data and is queued to be regenerated once there is room.
+        """
+
+        while not self._reserve_pool_memory(captcha._image_data_size):
+            if (not wait) or (self._stop_signal.qsize() != 0):
+                captcha._release_image_data()
+                self._used_captchas.put(captcha)
+                return False
+            sleep(0.05)
+        if self._seal_in_workers:
+            captcha._seal = self._seal_solution(captcha.get_solution(), captcha._profile)
+        if self._staging_directory:
+            self._write_pool_file(captcha)
+        self._profile_captchas[captcha._profile].put(captcha)
+        with self._pool_changed:
+            self._pool_changed.notify_all()
+        return True
+
+    def _bind_issue_time(self, seal, sealing_key):
+        """Returns a new URL-safe blob from a sealed solution, by signing it (with the key it was sealed with) along with the current time"""
+
+        from base64 import urlsafe_b64encode
+        from hashlib import sha256
+        from hmac import digest
+        from struct import pack
+
+        token_format, _, _, sealed_parts = seal
+        if token_format == 'COMPACT':
+            version, nonce, solution_tag = sealed_parts
+            if self._settings._REPLAY_PROTECTION == 'SERIAL':
+                version += _SERIAL_TOKEN_VERSION - _SEALED_TOKEN_VERSION
+                header = pack('>BQ8sIQ', version, int(time()), nonce, self._engine_id, next(self._serial_numbers))
+            else:
+                header = pack('>BQ8s', version, int(time()), nonce)
+            token = header + digest(sealing_key, header + solution_tag, sha256)[:8] + solution_tag
+            return urlsafe_b64encode(token).decode().rstrip('=')
+        # This is a standard Fernet token, whose ciphertext was encrypted ahead of time (Fernet keys are made up
+        # of a signing key, followed by an encryption key):
+        iv_and_ciphertext, = sealed_parts
+        token = b'\x80' + pack('>Q', int(time())) + iv_and_ciphertext
+        return urlsafe_b64encode(token + digest(sealing_key[:16], token, sha256)).decode()
+
+    def _check_compact_blob(self, encrypted_blob, proposed_solution):
+        """Returns why a compact token is rejected ('invalid' or 'expired', or '' if it is not), whether the proposed solution matches it, its issue time, its profile, and its serial number (if this Engine issued it one)"""
+
+        from base64 import urlsafe_b64decode
+        from binascii import Error
+        from hashlib import sha256
+        from hmac import compare_digest, digest
+        from struct import error, unpack
+
+        if type(encrypted_blob) is str:
+            encrypted_blob = encrypted_blob.encode()
+        try:
+            token = urlsafe_b64decode(encrypted_blob + b'==')
+            if len(token) == _SERIAL_TOKEN_BYTES:
+                version, timestamp, nonce, engine_id, serial_number, token_tag, solution_tag = unpack(_SERIAL_TOKEN_LAYOUT, token)
+                header_size = 29
+                default_versions = [_SERIAL_TOKEN_VERSION]
+                profile_versions = [_SERIAL_PROFILE_TOKEN_VERSION]
+            else:
+                version, timestamp, nonce, token_tag, solution_tag = unpack(_COMPACT_TOKEN_LAYOUT, token)
+                engine_id = serial_number = None
+                header_size = 17
+                default_versions = [_COMPACT_TOKEN_VERSION, _SEALED_TOKEN_VERSION]
+                profile_versions = [_COMPACT_PROFILE_TOKEN_VERSION, _SEALED_PROFILE_TOKEN_VERSION]
+        except (Error, error, ValueError):
+            return 'invalid', False, 0, '', None
+        if version in default_versions:
+            profile = 'default'
+        elif version in profile_versions:
+            profile = self._profile_ids.get(nonce[0], '')
+        else:
+            profile = ''
+        current_time = int(time())
+        # Use the same clock skew rules as Fernet tokens:
+        if (not profile) or (timestamp > current_time + 60):
+            return 'invalid', False, 0, '', None
+        # Serial numbers from other Engines (sharing this Engine's keys) can only be recorded in the replay store:
+        if engine_id != self._engine_id:
+            serial_number = None
+        settings = self._profiles[profile]
+        # Unsealed tokens (which are no longer issued, but may still be outstanding) bind their solution to the whole header:
+        sealed = version not in [_COMPACT_TOKEN_VERSION, _COMPACT_PROFILE_TOKEN_VERSION]
+        header = token[:header_size]
+        for mac_key in self._key_ring.get_mac_keys():
+            if compare_digest(digest(mac_key, header + (solution_tag if sealed else b''), sha256)[:8], token_tag):
+                # Only authentic tokens are reported as expired:
+                if timestamp + settings._LIFETIME < current_time:
+                    return 'expired', False, timestamp, profile, None
+                expected_solution_tag = digest(
+                    mac_key,
+                    (nonce if sealed else header)
+                    + self._get_profile_binding(profile)
+                    + self._normalize_solution(proposed_solution, settings).encode(),
+                    sha256,
+                )[:12]
+                return '', compare_digest(expected_solution_tag, solution_tag), timestamp, profile, serial_number
+        return 'invalid', False, 0, '', None
+
+    def _check_key_retention(self, settings):
+        """Raises an exception if rotated keys would be dropped before the CAPTCHAs they protect expire"""
+
+        if self._key_ring.get_rotation_interval() and (self._key_ring.get_retention() < settings._LIFETIME):
+            raise ValueError('The retention of a rotating KeyRing cannot be less than the LIFETIME setting')
+
+    def _create_captcha(self, profile):
+        """Returns a new Captcha instance for a profile"""
+
+        captcha = Captcha(settings = self._profiles[profile])
+        captcha._profile = profile
+        return captcha
+
+    def _create_condition(self):
+        """Returns a new condition variable, which can be shared with the Engine's workers (whether they are subprocesses or threads)"""
+
+        if self._backend == 'threads':
+            return Condition()
+
+        from multiprocessing import Condition as ProcessCondition
+
+        return ProcessCondition()
+
+    def _create_queue(self, maxsize):
+        """Returns a new queue, which can be shared with the Engine's workers (whether they are subprocesses or threads)"""
+
+        if self._backend == 'threads':
+            return _ThreadQueue(maxsize = maxsize)
+
+        from multiprocessing import Queue
+
+        return Queue(maxsize = maxsize)
+
+    def _create_value(self, value, lock = False):
+        """Returns a new integer value, which can be shared with the Engine's workers (whether they are subprocesses or threads)"""
+
+        if self._backend == 'threads':
+            return _ThreadValue(value)
+
+        from multiprocessing import Value
+
+        return Value('q', value, lock = lock)
+
+    def _create_worker(self, target):
+        """Returns a new (unstarted) subprocess or thread, according to the Engine's backend, which runs target"""
+
+        if self._backend == 'threads':
+            return Thread(target = target, args = (), daemon = True)
+
+        from multiprocessing import Process
+
+        return Process(target = target, args = ())
+
+    def _expire_pool_files(self):
+        """Deletes the issued CAPTCHA images (in the POOL_DIRECTORY directory) that have expired without being fetched"""
+
+        from os import scandir
+
+        current_time = time()
+        for entry in scandir(self._settings._POOL_DIRECTORY):
+            # Issued images are given their expiration time as their modification time:
+            try:
+                if entry.is_file() and (not entry.name.startswith('.')) and (entry.stat().st_mtime < current_time):
+                    Path(entry.path).unlink()
+            except FileNotFoundError:
+                # The image was fetched (or expired by another Engine) in the meantime:
+                pass
+
     def _generate_captcha_instances(self):
         """Generates the Captcha instances with the correct settings"""
 
-        for _ in range(self._settings._POOL_SIZE):
+        self._isolate_worker()
+        captchas_to_generate = {profile: settings._POOL_SIZE for profile, settings in self._profiles.items()}
+        if self._settings._POOL_SNAPSHOT_PATH:
+            captchas_to_generate['default'] -= self._load_pool_snapshot()
+        # Take turns between the profiles, so that every profile's pool starts filling right away:
+        while any(captchas_to_generate.values()):
+            for profile in captchas_to_generate:
+                if (self._stop_signal.qsize() != 0) or (not captchas_to_generate[profile]):
+                    continue
+                self._add_to_pool(self._create_captcha(profile))
+                captchas_to_generate[profile] -= 1
             if self._stop_signal.qsize() != 0:
                 break
-            self._fresh_captchas.put(Captcha(settings = self._settings))
 
         while self._stop_signal.qsize() == 0:
             sleep(1)
             captcha_instances = []
             if self._modified_settings.qsize() != 0:
-                new_settings = self._modified_settings.get()
-                # Remove all of the Captcha instances from the queues:
-                for _ in range(self._settings._POOL_SIZE):
+                profile, new_settings = self._modified_settings.get()
+                fresh_captchas = self._profile_captchas[profile]
+                # Remove all of the profile's Captcha instances from the queues:
+                for _ in range(self._profiles[profile]._POOL_SIZE):
                     if self._stop_signal.qsize() != 0:
                         break
                     while True:
@@ -520,78 +999,296 @@ class Engine():
                         if self._used_captchas.qsize():
                             try:
                                 captcha = self._used_captchas.get(timeout = 0.1)
-                                captcha_instances.append(captcha)
-                                captcha_removed = True
+                                if captcha._profile == profile:
+                                    captcha_instances.append(captcha)
+                                    captcha_removed = True
+                                else:
+                                    # Other profiles' CAPTCHAs are returned, to be regenerated as usual:
+                                    self._used_captchas.put(captcha)
                             except Empty:
                                 pass
-                        if (not captcha_removed) and self._fresh_captchas.qsize():
+                        if (not captcha_removed) and fresh_captchas.qsize():
                             try:
-                                captcha = self._fresh_captchas.get(timeout = 0.1)
+                                captcha = fresh_captchas.get(timeout = 0.1)
+                                self._release_pool_memory(captcha._image_data_size)
                                 captcha_instances.append(captcha)
                                 captcha_removed = True
                             except Empty:
                                 pass
                         if captcha_removed or (self._stop_signal.qsize() != 0):
                             break
+                        sleep(0.01)
 
                 # Update all of the Captcha instances with the new settings:
-                self._settings = new_settings
+                self._profiles[profile] = new_settings
+                if profile == 'default':
+                    self._settings = new_settings
                 for captcha in captcha_instances:
                     if self._stop_signal.qsize() != 0:
                         break
-                    captcha.update_settings(self._settings)
-                    self._fresh_captchas.put(captcha)
+                    captcha.update_settings(new_settings)
+                    self._add_to_pool(captcha)
 
         # Close all queues before terminating:
-        self._fresh_captchas.close()
+        for fresh_captchas in self._profile_captchas.values():
+            fresh_captchas.close()
         self._modified_settings.close()
+        self._used_captchas.close()
 
         # Remove stop signal last, to indicate that the process has closed all other queues:
         self._stop_signal.get()
         self._stop_signal.close()
 
         # Wait to terminate the process until the queues' background threads have exited:
-        self._fresh_captchas.join_thread()
+        for fresh_captchas in self._profile_captchas.values():
+            fresh_captchas.join_thread()
         self._modified_settings.join_thread()
+        self._used_captchas.join_thread()
         self._stop_signal.join_thread()
 
+    def _get_cpu_limit(self):
+        """Returns the number of whole CPUs available to CAPTCHA generation, according to the CPU affinity and cgroup CPU quota"""
+
+        from math import ceil
+        from os import cpu_count
+
+        try:
+            from os import sched_getaffinity
+
+            cpus = len(sched_getaffinity(0))
+        except ImportError:
+            cpus = cpu_count() or 1
+        if self._settings._WORKER_CPU_AFFINITY:
+            cpus = min(cpus, len(self._settings._WORKER_CPU_AFFINITY))
+
+        # Containers are usually limited by a CPU quota (cgroup v2 first, then v1), rather than by their affinity:
+        quota = 0
+        try:
+            maximum, period = Path('/sys/fs/cgroup/cpu.max').read_text().split()
+            if maximum != 'max':
+                quota = int(maximum) / int(period)
+        except (OSError, ValueError):
+            try:
+                maximum = int(Path('/sys/fs/cgroup/cpu/cpu.cfs_quota_us').read_text())
+                period = int(Path('/sys/fs/cgroup/cpu/cpu.cfs_period_us').read_text())
+                if maximum > 0:
+                    quota = maximum / period
+            except (OSError, ValueError):
+                pass
+        if quota:
+            cpus = min(cpus, ceil(quota))
+        return max(1, cpus)
+
+    def _get_blob_id(self, encrypted_blob):
+        """Returns an identifier for a blob, for recording in events (the blob itself must never be recorded, as it could be replayed)"""
+
+        from hashlib import sha256
+
+        if type(encrypted_blob) is str:
+            encrypted_blob = encrypted_blob.encode()
+        return sha256(encrypted_blob).hexdigest()[:32]
+
+    def _get_fernet_issue_time(self, encrypted_blob):
+        """Returns the (unverified) time at which a Fernet token was created, or 0 if it cannot be read"""
+
+        from base64 import urlsafe_b64decode
+        from binascii import Error
+
+        if type(encrypted_blob) is str:
+            encrypted_blob = encrypted_blob.encode()
+        try:
+            return int.from_bytes(urlsafe_b64decode(encrypted_blob)[1:9], 'big')
+        except (Error, ValueError):
+            return 0
+
+    def _get_key_id(self, key):
+        """Returns a short identifier for a key, so that sealed solutions can refer to their key without holding it"""
+
+        from hashlib import sha256
+
+        return sha256(b'botblock-seal-key-id' + key).hexdigest()[:16]
+
+    def _get_profile_binding(self, profile):
+        """Returns the bytes that bind a blob to its profile (which are empty for the default profile)"""
+
+        if profile == 'default':
+            return b''
+        return profile.encode() + b'\x00'
+
+    def _get_profile_id(self, profile):
+        """Returns the number identifying a (non-default) profile in compact tokens"""
+
+        from hashlib import sha256
+
+        return sha256(profile.encode()).digest()[0]
+
+    def _get_reserved_captchas(self, profile, priority):
+        """Returns the number of a profile's fresh CAPTCHAs that are reserved for requests of a higher priority than the one provided"""
+
+        settings = self._profiles[profile]
+        return (settings._POOL_SIZE * sum(settings._PRIORITY_RESERVES[priority:])) // 100
+
+    def _get_sealing_keys(self, token_format):
+        """Returns the keys that solutions of a token format are sealed and signed with (from newest to oldest), by their identifiers"""
+
+        from base64 import urlsafe_b64decode
+
+        if token_format == 'COMPACT':
+            keys = self._key_ring.get_mac_keys()
+        else:
+            self._key_ring.get_fernet()
+            keys = [urlsafe_b64decode(key) for key in self._key_ring.get_keys()]
+        return {self._get_key_id(key): key for key in keys}
+
+    def _isolate_worker(self):
+        """Applies the WORKER_NICENESS and WORKER_CPU_AFFINITY settings to the current (generation) subprocess"""
+
+        # Threads share their process's niceness, so isolating one would also slow down requests:
+        if self._backend == 'threads':
+            return
+        if self._settings._WORKER_NICENESS:
+            from os import nice
+
+            nice(self._settings._WORKER_NICENESS)
+        if self._settings._WORKER_CPU_AFFINITY:
+            from os import sched_setaffinity
+
+            sched_setaffinity(0, self._settings._WORKER_CPU_AFFINITY)
+
+    def _load_pool_snapshot(self):
+        """Moves unserved Captcha instances from the pool snapshot file into the pool, and returns how many were moved"""
+
+        from cryptography.fernet import Fernet, InvalidToken
+        from fcntl import LOCK_EX, LOCK_UN, flock
+        from mmap import ACCESS_READ, mmap
+        from pickle import loads
+
+        snapshot_path = Path(self._settings._POOL_SNAPSHOT_PATH)
+        if (not snapshot_path.is_file()) or (snapshot_path.stat().st_size == 0):
+            return 0
+        fernet = Fernet(self._settings._POOL_SNAPSHOT_KEY)
+        settings_hash = self._settings._get_hash()
+        captchas_loaded = 0
+        with open(snapshot_path, 'r+b') as snapshot_file:
+            flock(snapshot_file, LOCK_EX)
+            with mmap(snapshot_file.fileno(), 0, access = ACCESS_READ) as snapshot:
+                entries, served_entries, snapshot_hash = self._read_pool_snapshot(snapshot)
+                if snapshot_hash == settings_hash:
+                    for index, encrypted_captcha in enumerate(entries):
+                        if captchas_loaded == self._settings._POOL_SIZE:
+                            break
+                        if (index in served_entries) or (self._stop_signal.qsize() != 0):
+                            continue
+                        # Record the entry as served before using it, so that it can never be used twice:
+                        snapshot_file.seek(0, 2)
+                        snapshot_file.write(f'S {index}\n'.encode())
+                        snapshot_file.flush()
+                        try:
+                            captcha = loads(fernet.decrypt(encrypted_captcha))
+                        except InvalidToken:
+                            continue
+                        captcha._profile = 'default'
+                        self._add_to_pool(captcha)
+                        captchas_loaded += 1
+            flock(snapshot_file, LOCK_UN)
+        return captchas_loaded
+
+    def _prefilter_blob(self, encrypted_blob, client_key):
+        """Returns why a blob is rejected before any cryptography ('throttled', 'malformed', 'unsupported', or 'stale'), or '' if it is not"""
+
+        from base64 import urlsafe_b64decode
+        from re import fullmatch
+
+        if (client_key is not None) and (not self._validation_throttle.allow(client_key)):
+            return 'throttled'
+        if type(encrypted_blob) is str:
+            if not encrypted_blob.isascii():
+                return 'malformed'
+            encrypted_blob = encrypted_blob.encode()
+        elif type(encrypted_blob) is not bytes:
+            return 'malformed'
+        blob_length = len(encrypted_blob)
+        if blob_length == _COMPACT_TOKEN_LENGTH:
+            versions = [_COMPACT_TOKEN_VERSION, _COMPACT_PROFILE_TOKEN_VERSION, _SEALED_TOKEN_VERSION, _SEALED_PROFILE_TOKEN_VERSION]
+        elif blob_length == _SERIAL_TOKEN_LENGTH:
+            versions = [_SERIAL_TOKEN_VERSION, _SERIAL_PROFILE_TOKEN_VERSION]
+        elif (blob_length % 4 == 0) and (_MINIMUM_FERNET_TOKEN_LENGTH <= blob_length <= self._maximum_fernet_length):
+            versions = [_FERNET_TOKEN_VERSION]
+        else:
+            return 'malformed'
+        if not fullmatch(_BLOB_PATTERN, encrypted_blob):
+            return 'malformed'
+        # Every format starts with its version byte and its (not yet authenticated) issue time:
+        version, timestamp = unpack('>BQ', urlsafe_b64decode(encrypted_blob[:12]))
+        if version not in versions:
+            return 'unsupported'
+        if timestamp + max(settings._LIFETIME for settings in self._profiles.values()) < time():
+            return 'stale'
+        return ''
+
+    def _read_pool_snapshot(self, snapshot):
+        """Parses the records of a pool snapshot file, and returns its entries, served entries, and settings hash"""
+
+        entries = []
+        served_entries = set()
+        snapshot_hash = ''
+        for record in iter(snapshot.readline, b''):
+            record_type, _, value = record.rstrip(b'\n').partition(b' ')
+            if record_type == b'H':
+                snapshot_hash = value.decode()
+            elif record_type == b'E':
+                entries.append(value)
+            elif record_type == b'S':
+                served_entries.add(int(value))
+        return entries, served_entries, snapshot_hash
+
+    def _record_blob(self, encrypted_blob, lifetime, serial_number, issue_time):
+        """Records a blob (or its serial number) as used, and returns why it is rejected ('replayed' or 'expired', or '' if it is not)
+
+        If the replay store fails, a description of the error is returned as well (as the second item of a tuple), so that
+        the failure can be raised by validate (the validation worker must keep running, or every later validation would
+        wait for it forever).
+        """
+
+        try:
+            if serial_number is not None:
+                if self._serial_replay_store.add(serial_number, lifetime, issue_time):
+                    return '', ''
+                return 'expired' if self._serial_replay_store.is_expired(serial_number) else 'replayed', ''
+            if type(encrypted_blob) is bytes:
+                encrypted_blob = encrypted_blob.decode()
+            return '' if self._replay_store.add(encrypted_blob, lifetime) else 'replayed', ''
+        except Exception as exception:
+            return '', f'{type(exception).__name__}: {exception}'
+
+    def _normalize_solution(self, solution, settings):
+        """Returns a solution in the form it is compared in, according to the CASE_SENSITIVE setting"""
+
+        if settings._CASE_SENSITIVE:
+            return solution
+        return solution.lower()
+
     def _refresh_captchas(self):
         """Refreshes used Captcha instances, and makes them available for reuse"""
 
-        before_generation_loop = 0
+        self._isolate_worker()
         while self._stop_signal.qsize() == 0:
-            generation_loop_range = self._settings._POOL_SIZE
-            if self._settings._RATE_LIMIT:
-                if type(self._settings._RATE_LIMIT) == int:
-                    before_generation_loop = time()
-                    generation_loop_range = self._settings._RATE_LIMIT
-                else:
-                    generation_loop_range = 1
-                    rate_limit_as_int = int(self._settings._RATE_LIMIT)
-                    for _ in range(rate_limit_as_int):
-                        if self._stop_signal.qsize() != 0:
-                            break
-                        sleep(1)
-                    sleep(self._settings._RATE_LIMIT - rate_limit_as_int)
-            for _ in range(generation_loop_range):
-                if self._stop_signal.qsize() != 0:
-                    break
-                try:
-                    captcha_to_refresh = self._used_captchas.get(timeout = 1)
-                except Empty:
-                    continue
-                captcha_to_refresh.generate()
-                self._fresh_captchas.put(captcha_to_refresh)
-            if self._settings._RATE_LIMIT and type(self._settings._RATE_LIMIT) == int:
-                time_to_sleep = 60 - int(time() - before_generation_loop)
-                if time_to_sleep > 0:
-                    for _ in range(time_to_sleep):
-                        if self._stop_signal.qsize() != 0:
-                            break
-                        sleep(1)
+            try:
+                captcha_to_refresh = self._used_captchas.get(timeout = 1)
+            except Empty:
+                continue
+            # Only spend a token once there is a CAPTCHA to regenerate:
+            if not self._rate_limiter.acquire(lambda: self._stop_signal.qsize() != 0):
+                break
+            refill_start_time = perf_counter_ns()
+            captcha_to_refresh.generate()
+            self._time_series.record('Refilled', (perf_counter_ns() - refill_start_time) / 1_000_000_000)
+            self._add_to_pool(captcha_to_refresh, wait = True)
 
         # Close all queues before terminating:
-        self._fresh_captchas.close()
+        self._rate_limiter.close()
+        for fresh_captchas in self._profile_captchas.values():
+            fresh_captchas.close()
         self._used_captchas.close()
 
         # Remove stop signal last, to indicate that the process has closed all other queues:
@@ -599,39 +1296,192 @@ class Engine():
         self._stop_signal.close()
 
         # Wait to terminate the process until the queues' background threads have exited:
-        self._fresh_captchas.join_thread()
+        for fresh_captchas in self._profile_captchas.values():
+            fresh_captchas.join_thread()
         self._used_captchas.join_thread()
         self._stop_signal.join_thread()
 
+    def _release_pool_memory(self, size):
+        """Removes a CAPTCHA's encoded size from the pool's memory usage, once it is no longer fresh"""
+
+        with self._pool_memory.get_lock():
+            self._pool_memory.value -= size
+
+    def _reserve_pool_memory(self, size):
+        """Adds a CAPTCHA's encoded size to the pool's memory usage and returns True, or returns False if it does not fit"""
+
+        with self._pool_memory.get_lock():
+            # The pool may always hold at least one CAPTCHA, however large it is:
+            if self._pool_memory_limit.value and self._pool_memory.value \
+                and (self._pool_memory.value + size > self._pool_memory_limit.value):
+                return False
+            self._pool_memory.value += size
+            self._pool_memory_high_water.value = max(self._pool_memory_high_water.value, self._pool_memory.value)
+            self._largest_pooled_captcha.value = max(self._largest_pooled_captcha.value, size)
+            return True
+
+    def _save_pool_snapshot(self, captchas):
+        """Appends unserved Captcha instances to the pool snapshot file, for reuse by future Engine instances"""
+
+        from cryptography.fernet import Fernet
+        from fcntl import LOCK_EX, LOCK_UN, flock
+        from mmap import ACCESS_READ, mmap
+        from os import O_CREAT, O_RDWR, open as open_file
+        from pickle import dumps
+
+        fernet = Fernet(self._settings._POOL_SNAPSHOT_KEY)
+        settings_hash = self._settings._get_hash()
+        file_descriptor = open_file(self._settings._POOL_SNAPSHOT_PATH, O_RDWR | O_CREAT, 0o600)
+        with open(file_descriptor, 'r+b') as snapshot_file:
+            flock(snapshot_file, LOCK_EX)
+            start_new_snapshot = True
+            if Path(self._settings._POOL_SNAPSHOT_PATH).stat().st_size:
+                with mmap(snapshot_file.fileno(), 0, access = ACCESS_READ) as snapshot:
+                    entries, served_entries, snapshot_hash = self._read_pool_snapshot(snapshot)
+                # Only keep appending to the existing file while it still holds usable entries:
+                start_new_snapshot = (snapshot_hash != settings_hash) or (len(served_entries) >= len(entries))
+            if start_new_snapshot:
+                snapshot_file.truncate(0)
+                snapshot_file.write(f'H {settings_hash}\n'.encode())
+            snapshot_file.seek(0, 2)
+            for captcha in captchas:
+                if captcha.get_settings()._get_hash() != settings_hash:
+                    continue
+                snapshot_file.write(b'E ' + fernet.encrypt(dumps(captcha)) + b'\n')
+            snapshot_file.flush()
+            flock(snapshot_file, LOCK_UN)
+
+    def _seal_solution(self, solution, profile):
+        """Returns everything needed to issue a blob for a solution, except for the time, which is bound when it is issued
+
+        Sealing happens when a CAPTCHA is added to the pool, so that issuing its blob only costs a single HMAC. The
+        key is only referred to by its identifier, so that it is never sent between processes or saved in snapshots.
+        """
+
+        from hashlib import sha256
+        from hmac import digest
+
+        settings = self._profiles[profile]
+        key_id, key = next(iter(self._get_sealing_keys(settings._TOKEN_FORMAT).items()))
+        if settings._TOKEN_FORMAT == 'COMPACT':
+            if profile == 'default':
+                version = _SEALED_TOKEN_VERSION
+                nonce = urandom(8)
+            else:
+                version = _SEALED_PROFILE_TOKEN_VERSION
+                nonce = bytes([self._get_profile_id(profile)]) + urandom(7)
+            solution_tag = digest(
+                key,
+                nonce + self._get_profile_binding(profile) + self._normalize_solution(solution, settings).encode(),
+                sha256,
+            )[:12]
+            return 'COMPACT', key_id, settings._CASE_SENSITIVE, (version, nonce, solution_tag)
+
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        from cryptography.hazmat.primitives.padding import PKCS7
+
+        # Blobs from the default profile only contain the solution, as they did before profiles existed:
+        padder = PKCS7(algorithms.AES.block_size).padder()
+        padded_solution = padder.update(self._get_profile_binding(profile) + solution.encode()) + padder.finalize()
+        iv = urandom(16)
+        encryptor = Cipher(algorithms.AES(key[16:]), modes.CBC(iv)).encryptor()
+        ciphertext = encryptor.update(padded_solution) + encryptor.finalize()
+        return 'FERNET', key_id, settings._CASE_SENSITIVE, (iv + ciphertext,)
+
+    def _seal_is_current(self, seal, profile):
+        """Returns True if a sealed solution matches the profile's current settings and the newest key"""
+
+        if seal is None:
+            return False
+        token_format, key_id, case_sensitive, _ = seal
+        settings = self._profiles[profile]
+        if (token_format != settings._TOKEN_FORMAT) or (case_sensitive != settings._CASE_SENSITIVE):
+            return False
+        return key_id == next(iter(self._get_sealing_keys(token_format)))
+
+    def _take_fresh_captcha(self, profile, priority):
+        """Returns a fresh CAPTCHA from a profile's pool for a request of the provided priority, waiting until one is available to it"""
+
+        fresh_captchas = self._profile_captchas[profile]
+        reserved_captchas = self._get_reserved_captchas(profile, priority)
+        timeout = self._settings._POOL_WAIT_TIMEOUT
+        start_time = perf_counter_ns()
+        deadline = perf_counter() + timeout
+        waited = starved = False
+        try:
+            # Requests of every priority check the reserve and take their CAPTCHA under the same lock, so that no other
+            # request can take a CAPTCHA in between (and the pool can only grow while the lock is held):
+            with self._pool_changed:
+                while True:
+                    available = fresh_captchas.qsize() > reserved_captchas
+                    if available:
+                        # The size is only approximate (a CAPTCHA may not have reached the queue yet), so the lock is
+                        # never held while blocking on the queue itself:
+                        try:
+                            new_captcha = fresh_captchas.get_nowait()
+                            break
+                        except Empty:
+                            pass
+                    if self._shut_down:
+                        raise RuntimeError('This engine is shut down')
+                    if timeout and (perf_counter() >= deadline):
+                        raise Empty
+                    waited = True
+                    starved = starved or (fresh_captchas.qsize() > 0)
+                    # Waits are cut short now and then, to notice when the engine is shut down (and retried
+                    # quickly when a CAPTCHA is on its way to the queue):
+                    wait_time = 0.01 if available else 0.5
+                    self._pool_changed.wait(max(0, min(wait_time, deadline - perf_counter())) if timeout else wait_time)
+        except Empty:
+            raise RuntimeError(
+                f'No fresh CAPTCHA was available to a request of priority {priority} within the POOL_WAIT_TIMEOUT setting\'s {timeout} seconds'
+            ) from None
+        finally:
+            with self._stats_lock:
+                priority_stats = self._priority_stats.setdefault(priority, {'Requests': 0, 'Waits': 0, 'Starved': 0, 'Wait Time': 0})
+                priority_stats['Requests'] += 1
+                priority_stats['Waits'] += waited
+                priority_stats['Starved'] += starved
+                priority_stats['Wait Time'] += perf_counter_ns() - start_time
+        with self._pool_changed:
+            self._pool_changed.notify_all()
+        return new_captcha
+
     def _start_subprocesses(self):
-        """Starts the Engine's concurrent subprocesses for clearing and refreshing CAPTCHAs"""
+        """Starts the Engine's concurrent subprocesses (or threads) for clearing and refreshing CAPTCHAs"""
 
-        self._captcha_generation_process = Process(target = self._generate_captcha_instances, args = ())
-        self._captcha_refresh_process = Process(target = self._refresh_captchas, args = ())
-        self._captcha_validation_process = Process(target = self._validate_captchas, args = ())
+        self._captcha_generation_process = self._create_worker(self._generate_captcha_instances)
+        self._captcha_refresh_processes = [
+            self._create_worker(self._refresh_captchas) for _ in range(self._refresh_workers)
+        ]
+        self._captcha_validation_process = self._create_worker(self._validate_captchas)
         self._captcha_generation_process.start()
-        self._captcha_refresh_process.start()
+        for captcha_refresh_process in self._captcha_refresh_processes:
+            captcha_refresh_process.start()
         self._captcha_validation_process.start()
 
-    def _validate_captchas(self):
-        """Checks for, adds, and expires CAPTCHA blobs from the validated blobs list"""
+    def _update_maximum_fernet_length(self, profile):
+        """Raises the length of the longest Fernet blob that may have been provided, to cover a profile's current settings"""
+
+        from math import ceil
 
-        validated_blobs = []
-        validated_blobs_lock = Lock()
+        settings = self._profiles[profile]
+        # Solutions are encoded as UTF-8, which takes up to 4 bytes per character:
+        plaintext_size = len(self._get_profile_binding(profile)) + (4 * max(len(settings._TEXT), settings._TEXT_LENGTH))
+        token_size = _FERNET_TOKEN_OVERHEAD + (16 * ((plaintext_size // 16) + 1))
+        # Blobs provided before the settings changed remain valid, so the length is never lowered:
+        self._maximum_fernet_length = max(self._maximum_fernet_length, 4 * ceil(token_size / 3))
+
+    def _validate_captchas(self):
+        """Checks for and adds CAPTCHA blobs to the replay store, and expires them from it"""
 
         def validate():
             while self._stop_signal.qsize() == 0:
                 try:
-                    blob_to_validate = self._blob_to_validate.get(timeout = 1)
+                    blob_to_validate, lifetime, serial_number, issue_time = self._blob_to_validate.get(timeout = 1)
                 except Empty:
                     continue
-                validated_blobs_lock.acquire()
-                if blob_to_validate in validated_blobs:
-                    self._blob_validation_result.put(False)
-                else:
-                    validated_blobs.append(blob_to_validate)
-                    self._blob_validation_result.put(True)
-                validated_blobs_lock.release()
+                self._blob_validation_result.put(self._record_blob(blob_to_validate, lifetime, serial_number, issue_time))
 
         validate_thread = Thread(target = validate, args = ())
         validate_thread.start()
@@ -644,26 +1494,20 @@ class Engine():
                     break
             if self._stop_signal.qsize() != 0:
                 break
-            if validated_blobs:
-                validated_blobs_lock.acquire()
-                validated = []
-                for encrypted_blob in validated_blobs:
-                    validated.append(encrypted_blob)
-                validated_blobs_lock.release()
-                blobs_to_remove = []
-                for encrypted_blob in validated:
-                    try:
-                        self._fernet.decrypt(encrypted_blob, ttl = self._settings._LIFETIME)
-                    except InvalidToken:
-                        blobs_to_remove.append(encrypted_blob)
-                if blobs_to_remove:
-                    validated_blobs_lock.acquire()
-                    for encrypted_blob in blobs_to_remove:
-                        validated_blobs.remove(encrypted_blob)
-                    validated_blobs_lock.release()
+            try:
+                self._replay_store.expire()
+                self._replay_store_size.value = self._replay_store.size()
+            except Exception:
+                # The store may be temporarily unavailable, so the previous size is kept until the next attempt:
+                pass
+            self._serial_replay_store.expire()
+            self._serial_replay_memory.value = self._serial_replay_store.get_memory_usage()
+            if self._staging_directory:
+                self._expire_pool_files()
 
         # Wait for thread to terminate:
         validate_thread.join()
+        self._replay_store.close()
 
         # Close all queues before terminating:
         self._blob_to_validate.close()
@@ -678,28 +1522,186 @@ class Engine():
         self._blob_validation_result.join_thread()
         self._stop_signal.join_thread()
 
-    def get_captcha(self, save_path = ''):
-        """Returns (and optionally saves to disk) a new CAPTCHA and its metadata"""
+    def _wait_for_warm_start(self):
+        """Blocks until each profile's pool holds the number of fresh CAPTCHAs required by its WARM_START setting"""
+
+        for profile, settings in self._profiles.items():
+            minimum_fresh_captchas = min(settings._WARM_START, settings._POOL_SIZE)
+            while self._profile_captchas[profile].qsize() < minimum_fresh_captchas:
+                if not self._captcha_generation_process.is_alive():
+                    # The other workers are still running, and would keep the interpreter from exiting:
+                    self.shut_down()
+                    raise RuntimeError('The CAPTCHA generation subprocess exited before the Engine was ready')
+                # Stop waiting once the pool's memory budget is full, as no more fresh CAPTCHAs can be added:
+                if self._pool_memory_limit.value and (
+                    self._pool_memory.value + self._largest_pooled_captcha.value > self._pool_memory_limit.value
+                ):
+                    break
+                sleep(0.01)
+        self._startup_time = round(time() - self._creation_time, 3)
+
+    def _write_pool_file(self, captcha):
+        """Moves a fresh CAPTCHA's image out of memory, and into a file in the staging directory"""
+
+        from secrets import token_hex
+
+        # A CAPTCHA that was taken out of the pool without being issued still has its previous image file:
+        if getattr(captcha, '_image_path', ''):
+            Path(captcha._image_path).unlink(missing_ok = True)
+        image_path = self._staging_directory / token_hex(16)
+        with open(image_path, 'wb') as image_file:
+            image_file.write(captcha.get_image_data())
+        captcha._image_path = str(image_path)
+        captcha._release_image_data()
+
+    def fetch_image(self, image_name):
+        """Returns an issued CAPTCHA image (from the POOL_DIRECTORY directory) as an open file, and deletes it
+
+        The image is deleted as soon as it is opened, so that each image can only be fetched once, and images
+        are never returned after their blobs expire. The returned file can be read, or passed to os.sendfile, and
+        must be closed by the caller.
+        """
+
+        from os import fstat
+        from re import fullmatch
+
+        if not self._settings._POOL_DIRECTORY:
+            raise RuntimeError('The POOL_DIRECTORY setting is not set')
+        if (type(image_name) is not str) or (not fullmatch(r'[A-Za-z0-9_-]+\.[a-z]+', image_name)):
+            raise ValueError(f'The image name "{image_name}" is not valid')
+        image_path = Path(self._settings._POOL_DIRECTORY) / image_name
+        try:
+            image_file = open(image_path, 'rb')
+        except FileNotFoundError:
+            raise ValueError(f'The image "{image_name}" does not exist, or has already been fetched') from None
+        try:
+            image_path.unlink()
+        except FileNotFoundError:
+            # Another process fetched the same image at the same moment, and was first to delete it:
+            image_file.close()
+            raise ValueError(f'The image "{image_name}" does not exist, or has already been fetched') from None
+        # Issued images record the expiration time of their blobs as their modification time:
+        if fstat(image_file.fileno()).st_mtime <= time():
+            image_file.close()
+            raise ValueError(f'The image "{image_name}" has expired')
+        return image_file
+
+    def get_captcha(self, save_path = '', raw = False, profile = 'default', priority = 0):
+        """Returns (and optionally saves to disk) a new CAPTCHA and its metadata
+
+        When raw is True, the CAPTCHA image is returned as bytes (alongside its MIME type),
+        rather than as a base64-encoded string. When the POOL_DIRECTORY setting is set, the name
+        of the image's file in that directory is returned instead. The CAPTCHA is taken from the
+        named profile's pool, without taking any of the CAPTCHAs reserved for higher priorities
+        (see the PRIORITY_RESERVES setting).
+        """
 
         if self._shut_down:
             raise RuntimeError('This engine is shut down')
-
-        new_captcha = self._fresh_captchas.get()
-        captcha_as_base64 = new_captcha.base64()
-        timestamp_and_encrypted_solution = self._fernet.encrypt(new_captcha.get_solution().encode()).decode()
+        if profile not in self._profiles:
+            raise ValueError(f'The profile "{profile}" does not exist')
+        if (type(priority) is not int) or (not 0 <= priority <= len(self._profiles[profile]._PRIORITY_RESERVES)):
+            raise ValueError(f'The priority "{priority}" does not exist for the profile "{profile}"')
+
+        start_time = perf_counter_ns()
+        new_captcha = self._take_fresh_captcha(profile, priority)
+        self._release_pool_memory(new_captcha._image_data_size)
+        if self._staging_directory:
+            from os import rename, utime
+            from secrets import token_urlsafe
+
+            # Images are renamed when they are issued, so that their names can't be known any earlier:
+            image_name = f"{token_urlsafe(24)}.{new_captcha.get_settings()._FORMAT.lower()}"
+            image_path = Path(self._settings._POOL_DIRECTORY) / image_name
+            rename(new_captcha._image_path, image_path)
+            new_captcha._image_path = ''
+            # Issued images expire along with their blobs, which is recorded as their modification time:
+            expiration_time = time() + self._profiles[profile]._LIFETIME
+            utime(image_path, (expiration_time, expiration_time))
+            captcha_data = {
+                'image_name': image_name,
+                'mime_type': new_captcha.get_mime_type(),
+            }
+            if save_path:
+                new_captcha._image_data = image_path.read_bytes()
+        elif raw:
+            captcha_data = {
+                'image': new_captcha.get_image_data(),
+                'mime_type': new_captcha.get_mime_type(),
+            }
+        else:
+            captcha_data = {'base64_captcha': new_captcha.base64()}
+        # Only the issue time is left to sign, unless the settings or keys changed since the CAPTCHA was sealed:
+        seal = getattr(new_captcha, '_seal', None)
+        sealing_key = None
+        if self._seal_is_current(seal, profile):
+            sealing_key = self._get_sealing_keys(seal[0]).get(seal[1])
+        # The key may have been rotated away since it was checked (if keys aren't retained at all):
+        while sealing_key is None:
+            seal = self._seal_solution(new_captcha.get_solution(), profile)
+            sealing_key = self._get_sealing_keys(seal[0]).get(seal[1])
+        new_captcha._seal = None
+        captcha_data['encrypted_blob'] = self._bind_issue_time(seal, sealing_key)
         if save_path:
             new_captcha.save(save_path)
+        # Used CAPTCHAs don't need their images, so they aren't kept in memory (or sent between processes):
+        new_captcha._release_image_data()
         self._used_captchas.put(new_captcha)
-        self._get_queries += 1
-        return {
-            'base64_captcha': captcha_as_base64,
-            'encrypted_blob': timestamp_and_encrypted_solution,
-        }
+        with self._stats_lock:
+            self._get_queries += 1
+        latency = (perf_counter_ns() - start_time) / 1_000_000_000
+        pool_depth = self._profile_captchas[profile].qsize()
+        self._time_series.record('Issued', latency)
+        self._time_series.record('Pool Depth', pool_depth)
+        if self._event_stream:
+            self._event_stream.emit(
+                'issue',
+                blob_id = self._get_blob_id(captcha_data['encrypted_blob']),
+                profile = profile,
+                latency = latency,
+                pool_depth = pool_depth,
+            )
+        return captcha_data
 
-    def get_settings(self):
-        """Returns the Settings instance used by the Engine when generating CAPTCHAs"""
+    def get_profiles(self):
+        """Returns the names of the Engine's profiles (including the default profile)"""
 
-        return self._settings
+        return list(self._profiles)
+
+    def get_recent_stats(self):
+        """Returns the Engine's activity over the last 1, 5, and 60 minutes, as a dictionary, without touching its pool
+
+        Rates are per minute, and latencies and refill times are in seconds. The average pool depth is the
+        number of fresh CAPTCHAs left in a profile's pool after each CAPTCHA provided from it.
+        """
+
+        def average(metric):
+            if window[metric]['Count'] == 0:
+                return 0
+            return window[metric]['Total'] / window[metric]['Count']
+
+        recent_stats = {}
+        for minutes in [1, 5, 60]:
+            window = self._time_series.get_window(minutes * 60)
+            per_minute = 60 / window['Seconds']
+            recent_stats[f"Last {minutes} Minute{'s' if minutes > 1 else ''}"] = {
+                'Generations/Minute': round(window['Issued']['Count'] * per_minute, 2),
+                'Validations/Minute': round(window['Validated']['Count'] * per_minute, 2),
+                'Solves/Minute': round(window['Solved']['Count'] * per_minute, 2),
+                'Refills/Minute': round(window['Refilled']['Count'] * per_minute, 2),
+                'Average Generation Latency': round(average('Issued'), 6),
+                'Average Validation Latency': round(average('Validated'), 6),
+                'Average Refill Time': round(average('Refilled'), 6),
+                'Average Pool Depth': round(average('Pool Depth'), 2),
+            }
+        return recent_stats
+
+    def get_settings(self, profile = 'default'):
+        """Returns the Settings instance used by the Engine when generating a profile's CAPTCHAs"""
+
+        if profile not in self._profiles:
+            raise ValueError(f'The profile "{profile}" does not exist')
+        return self._profiles[profile]
 
     def get_stats(self):
         """Returns configuration and statistical information about this Engine instance, as a dictionary"""
@@ -707,6 +1709,9 @@ class Engine():
             self._final_stats['Shut Down'] = True
             self._final_stats['Fresh CAPTCHAs'] = 0
             self._final_stats['Used CAPTCHAs'] = 0
+            self._final_stats['Pool Memory'] = 0
+            for profile_stats in self._final_stats.get('Profiles', {}).values():
+                profile_stats['Fresh CAPTCHAs'] = 0
             return self._final_stats
         else:
             stats = {'Shut Down': self._shut_down}
@@ -721,9 +1726,14 @@ class Engine():
             stats['Active Minutes'] = tmp_active_time // 60
             tmp_active_time -= stats['Active Minutes'] * 60
             stats['Active Seconds'] = tmp_active_time
+            stats['Startup Time'] = self._startup_time
+            stats['Backend'] = self._backend
+            stats['Refresh Workers'] = self._refresh_workers
+            stats['Rate Limit Tokens'] = round(self._rate_limiter.get_level(), 2)
             stats['CAPTCHAs Distributed'] = self._get_queries
             stats['Validation Attempts'] = self._validate_queries
             stats['CAPTCHA Solves'] = self._captcha_solves
+            stats['Rejections'] = dict(self._rejections)
             stats['Generations/Hour'] = round(
                 stats['CAPTCHAs Distributed'] /
                 (stats['Active Total'] / (60 * 60)), 2
@@ -736,12 +1746,14 @@ class Engine():
                 stats['CAPTCHA Solves'] /
                 (stats['Active Total'] / (60 * 60)), 2
             )
+            stats['Recent Activity'] = self.get_recent_stats()
             total_font_sizes = 0
             total_colors_evaluated = 0
             total_position_corrections = 0
             total_generations = 0
             total_data_sizes = 0
             total_noise_layers = 0
+            # Only the default profile's CAPTCHAs are analyzed, as used CAPTCHAs may belong to any profile:
             available_captcha_instances = min(
                 self._fresh_captchas.qsize() + self._used_captchas.qsize(),
                 self._settings._POOL_SIZE
@@ -750,15 +1762,47 @@ class Engine():
             # to prevent long hangs when rate limiting is used with large pool sizes:
             before_loop_time = time()
             captcha_instances = []
-            for _ in range(available_captcha_instances):
-                try:
-                    captcha_instances.append(self._fresh_captchas.get(timeout = 5))
-                    if time() - before_loop_time >= 5:
+            # The CAPTCHAs are put back before the lock is released, so that requests never find them missing from the pool:
+            with self._pool_changed:
+                for _ in range(available_captcha_instances):
+                    try:
+                        captcha_instances.append(self._fresh_captchas.get(timeout = 5))
+                        if time() - before_loop_time >= 5:
+                            break
+                    except Empty:
                         break
-                except Empty:
-                    break
+                for captcha in captcha_instances:
+                    self._fresh_captchas.put(captcha)
+                self._pool_changed.notify_all()
             stats['Fresh CAPTCHAs'] = len(captcha_instances)
             stats['Used CAPTCHAs'] = self._used_captchas.qsize()
+            stats['Pool Memory'] = self._pool_memory.value
+            stats['Pool Memory High-Water'] = self._pool_memory_high_water.value
+            stats['Largest Pooled CAPTCHA'] = self._largest_pooled_captcha.value
+            stats['Replay Store Size'] = self._replay_store_size.value
+            stats['Serial Replay Memory'] = self._serial_replay_memory.value
+            if self._event_stream:
+                stats['Events'] = self._event_stream.get_stats()
+            if len(self._profiles) > 1:
+                stats['Profiles'] = {}
+                for profile, settings in self._profiles.items():
+                    stats['Profiles'][profile] = {
+                        'Pool Size': settings._POOL_SIZE,
+                        'Fresh CAPTCHAs': self._profile_captchas[profile].qsize(),
+                    }
+                stats['Profiles']['default']['Fresh CAPTCHAs'] = len(captcha_instances)
+            if any(settings._PRIORITY_RESERVES for settings in self._profiles.values()):
+                stats['Priorities'] = {}
+                with self._stats_lock:
+                    all_priority_stats = {priority: dict(priority_stats) for priority, priority_stats in self._priority_stats.items()}
+                for priority in sorted(all_priority_stats, reverse = True):
+                    priority_stats = all_priority_stats[priority]
+                    stats['Priorities'][priority] = {
+                        'Requests': priority_stats['Requests'],
+                        'Waits': priority_stats['Waits'],
+                        'Starved': priority_stats['Starved'],
+                        'Average Wait': round(priority_stats['Wait Time'] / max(1, priority_stats['Requests']) / 1_000_000_000, 6),
+                    }
             for captcha in captcha_instances:
                 captcha_stats = captcha.get_stats()
                 total_font_sizes += captcha_stats['Average Font Size']
@@ -767,7 +1811,6 @@ class Engine():
                 total_generations += captcha_stats['Generation']
                 total_data_sizes += captcha_stats['Image Data Size']
                 total_noise_layers += captcha_stats['Layers of Noise']
-                self._fresh_captchas.put(captcha)
             num_instances = len(captcha_instances)
             if num_instances == 0:
                 num_instances = 1
@@ -801,18 +1844,55 @@ class Engine():
         stats_output += f"{stats['Active Hours']} hours, "
         stats_output += f"{stats['Active Minutes']} minutes, "
         stats_output += f"and {stats['Active Seconds']} seconds\n"
+        stats_output += f"    Startup Time (In Seconds): {stats['Startup Time']}\n"
         if self._shut_down:
             stats_output += f"\n    Pool Size: 0\n"
         else:
             stats_output += f"\n    Pool Size: {stats['Settings']['POOL_SIZE']}\n"
         stats_output += f"    Fresh CAPTCHAs in Pool: {stats['Fresh CAPTCHAs']}\n"
         stats_output += f"    Used CAPTCHAs in Pool: {stats['Used CAPTCHAs']}\n"
+        stats_output += f"    Pool Memory (In Bytes): {stats['Pool Memory']}\n"
+        stats_output += f"    Pool Memory High-Water Mark (In Bytes): {stats['Pool Memory High-Water']}\n"
+        stats_output += f"    Largest Pooled CAPTCHA (In Bytes): {stats['Largest Pooled CAPTCHA']}\n"
+        if 'Profiles' in stats:
+            stats_output += '    Fresh CAPTCHAs per Profile:\n'
+            for profile, profile_stats in stats['Profiles'].items():
+                stats_output += f"        {profile}: {profile_stats['Fresh CAPTCHAs']} of {profile_stats['Pool Size']}\n"
+        if 'Priorities' in stats:
+            stats_output += '    Requests per Priority:\n'
+            for priority, priority_stats in stats['Priorities'].items():
+                stats_output += f"        {priority}: {priority_stats['Requests']} Requests, "
+                stats_output += f"{priority_stats['Waits']} Waited ({priority_stats['Starved']} Starved), "
+                stats_output += f"Average Wait (In Seconds): {priority_stats['Average Wait']}\n"
         stats_output += f"\n    CAPTCHAs Distributed: {stats['CAPTCHAs Distributed']}\n"
         stats_output += f"    Validation Attempts: {stats['Validation Attempts']}\n"
         stats_output += f"    CAPTCHA Solves: {stats['CAPTCHA Solves']}\n"
+        stats_output += '    Rejected Validation Attempts:\n'
+        for reason, rejections in stats['Rejections'].items():
+            stats_output += f"        {reason.capitalize()}: {rejections}\n"
+        stats_output += f"    Blobs in Replay Store (As of the Last Expiration): {stats['Replay Store Size']}\n"
+        stats_output += f"    Serial Number Bitmap Memory (In Bytes, As of the Last Expiration): {stats['Serial Replay Memory']}\n"
+        if 'Events' in stats:
+            stats_output += f"\n    Events Emitted: {stats['Events']['Emitted']}\n"
+            stats_output += f"    Events Written: {stats['Events']['Written']}\n"
+            stats_output += f"    Events Dropped: {stats['Events']['Dropped']}\n"
+            stats_output += f"    Events Failed to Be Written: {stats['Events']['Failed']}\n"
         stats_output += f"\n    CAPTCHAs Generated per Hour: {stats['Generations/Hour']}\n"
         stats_output += f"    Validation Attempts per Hour: {stats['Validations/Hour']}\n"
         stats_output += f"    CAPTCHA Solves per Hour: {stats['Solves/Hour']}\n"
+        for window, window_stats in stats['Recent Activity'].items():
+            stats_output += f"\n    {window}:\n"
+            stats_output += f"        CAPTCHAs Generated per Minute: {window_stats['Generations/Minute']}\n"
+            stats_output += f"        Validation Attempts per Minute: {window_stats['Validations/Minute']}\n"
+            stats_output += f"        CAPTCHA Solves per Minute: {window_stats['Solves/Minute']}\n"
+            stats_output += f"        CAPTCHAs Refilled per Minute: {window_stats['Refills/Minute']}\n"
+            stats_output += f"        Average Generation Latency (In Seconds): {window_stats['Average Generation Latency']}\n"
+            stats_output += f"        Average Validation Latency (In Seconds): {window_stats['Average Validation Latency']}\n"
+            stats_output += f"        Average Refill Time (In Seconds): {window_stats['Average Refill Time']}\n"
+            stats_output += f"        Average Fresh CAPTCHAs in Pool: {window_stats['Average Pool Depth']}\n"
+        stats_output += f"\n    Backend: {stats['Backend']}\n"
+        stats_output += f"    Refresh Workers: {stats['Refresh Workers']}\n"
+        stats_output += f"    Rate Limit Tokens Available: {stats['Rate Limit Tokens']}\n"
         stats_output += "\n    Average Stats per Captcha Instance "
         stats_output += f"({stats['Captcha Instance Averages']['Instances Analyzed']} Analyzed):\n"
         stats_output += '        Average number of CAPTCHAs generated per Captcha Instance: '
@@ -842,12 +1922,17 @@ class Engine():
 
         self._final_stats = self.get_stats()
         self._shut_down = True
-        self._stop_signal.put('STOP')
-        self._stop_signal.put('STOP')
-        self._stop_signal.put('STOP')
+        for _ in range(2 + self._refresh_workers):
+            self._stop_signal.put('STOP')
 
         # Empty and close all queues before terminating:
         while self._stop_signal.qsize() != 0: # .empty() is bugged, so must use .qsize()
+            # A worker that exited early (such as after an error) never takes its stop signal:
+            workers = [self._captcha_generation_process, self._captcha_validation_process] + self._captcha_refresh_processes
+            if not any(worker.is_alive() for worker in workers):
+                while self._stop_signal.qsize() != 0:
+                    self._stop_signal.get()
+                break
             sleep(0.25)
         self._stop_signal.close()
         self._stop_signal.join_thread()
@@ -859,10 +1944,15 @@ class Engine():
             self._blob_validation_result.get()
         self._blob_validation_result.close()
         self._blob_validation_result.join_thread()
+        fresh_captchas = []
         while self._fresh_captchas.qsize() != 0:
-            self._fresh_captchas.get()
-        self._fresh_captchas.close()
-        self._fresh_captchas.join_thread()
+            fresh_captchas.append(self._fresh_captchas.get())
+        # Only the default profile's CAPTCHAs are kept in the pool snapshot:
+        for profile_captchas in self._profile_captchas.values():
+            while profile_captchas.qsize() != 0:
+                profile_captchas.get()
+            profile_captchas.close()
+            profile_captchas.join_thread()
         while self._modified_settings.qsize() != 0:
             self._modified_settings.get()
         self._modified_settings.close()
@@ -874,47 +1964,168 @@ class Engine():
 
         # Ensure that all processes have terminated before returning:
         self._captcha_generation_process.join()
-        self._captcha_refresh_process.join()
+        for captcha_refresh_process in self._captcha_refresh_processes:
+            captcha_refresh_process.join()
         self._captcha_validation_process.join()
 
-    def update_settings(self, settings = None):
-        """Updates the Engine's Settings instance and transitions its CAPTCHAs to the new settings"""
+        if self._staging_directory:
+            from shutil import rmtree
+
+            # Snapshots hold the images themselves, so they are read back before the staging directory is removed:
+            if self._settings._POOL_SNAPSHOT_PATH:
+                for captcha in fresh_captchas:
+                    captcha._image_data = Path(captcha._image_path).read_bytes()
+                    captcha._image_path = ''
+            rmtree(self._staging_directory, ignore_errors = True)
+        if self._settings._POOL_SNAPSHOT_PATH:
+            self._save_pool_snapshot(fresh_captchas)
+        # The event stream may be shared with other Engines, so it is flushed, but not closed:
+        if self._event_stream:
+            self._event_stream.flush()
+        self._rate_limiter.close()
+
+    def update_settings(self, settings = None, profile = 'default'):
+        """Updates one of the Engine's Settings instances and transitions the profile's CAPTCHAs to the new settings
+
+        Settings that apply to the whole Engine (such as RATE_LIMIT) are only taken from the default profile.
+        """
 
+        if profile not in self._profiles:
+            raise ValueError(f'The profile "{profile}" does not exist')
+        current_settings = self._profiles[profile]
         if settings:
             if isinstance(settings, Settings):
-                if settings.get_settings()['POOL_SIZE'] != self._settings.get_settings()['POOL_SIZE']:
+                if settings.get_settings()['POOL_SIZE'] != current_settings.get_settings()['POOL_SIZE']:
                     raise RuntimeError('The POOL_SIZE setting cannot be dynamically updated')
-                self._settings = settings
+                self._check_key_retention(settings)
+                if profile == 'default':
+                    if settings._RATE_LIMIT_PATH != self._settings._RATE_LIMIT_PATH:
+                        raise RuntimeError('The RATE_LIMIT_PATH setting cannot be dynamically updated')
+                    for setting in ['POOL_DIRECTORY', 'WORKER_NICENESS', 'WORKER_CPU_AFFINITY', 'REFRESH_WORKERS']:
+                        if settings.get_settings()[setting] != self._settings.get_settings()[setting]:
+                            raise RuntimeError(f'The {setting} setting cannot be dynamically updated')
             else:
                 raise TypeError(f'The "settings" argument supplied must be an instance of "Settings", not a "{type(settings)}"')
         else:
-            self._settings = Settings()
-        self._modified_settings.put(self._settings)
+            settings = Settings()
+        self._profiles[profile] = settings
+        self._update_maximum_fernet_length(profile)
+        if profile == 'default':
+            self._settings = settings
+            # The rate limiter's state and the pool's memory limit are shared, so the subprocesses see them immediately:
+            self._rate_limiter.configure(self._settings._get_generation_rate(), self._settings._RATE_LIMIT_BURST)
+            self._pool_memory_limit.value = self._settings._POOL_MEMORY_LIMIT
+            self._validation_throttle.configure(
+                self._settings._VALIDATION_RATE_LIMIT / 60,
+                self._settings._VALIDATION_RATE_LIMIT_BURST,
+            )
+        self._modified_settings.put((profile, settings))
+
+    def validate(self, encrypted_blob, proposed_solution, client_key = None):
+        """Returns True if a CAPTCHA solution is valid, and False if not
 
-    def validate(self, encrypted_blob, proposed_solution):
-        """Returns True if a CAPTCHA solution is valid, and False if not"""
+        When a client key (such as the client's IP address) is provided, the client's validation attempts are
+        limited by the VALIDATION_RATE_LIMIT setting. If the replay store fails to record the blob, a RuntimeError
+        is raised (rather than the blob being accepted without replay protection).
+        """
 
         if self._shut_down:
             raise RuntimeError('This engine is shut down')
-        self._validate_queries += 1
+        with self._stats_lock:
+            self._validate_queries += 1
+
+        start_time = perf_counter_ns()
+        issue_time = 0
+        # Cheap checks come first, so that garbage and floods are rejected without any cryptography or IPC:
+        rejection_reason = self._prefilter_blob(encrypted_blob, client_key)
+        if rejection_reason:
+            solution_matches = False
+            profile = ''
+            serial_number = None
+        # Blobs are recognized by their length, so that outstanding blobs remain
+        # valid when the TOKEN_FORMAT setting is changed:
+        elif len(encrypted_blob) in [_COMPACT_TOKEN_LENGTH, _SERIAL_TOKEN_LENGTH]:
+            rejection_reason, solution_matches, issue_time, profile, serial_number = self._check_compact_blob(
+                encrypted_blob,
+                proposed_solution,
+            )
+        else:
+            from cryptography.fernet import InvalidToken
 
-        try:
-            true_solution = self._fernet.decrypt(encrypted_blob, ttl = self._settings._LIFETIME).decode()
-        except InvalidToken:
-            return False
-        self._blob_to_validate.put(encrypted_blob)
-        if not self._settings._CASE_SENSITIVE:
-            proposed_solution = proposed_solution.lower()
-            true_solution = true_solution.lower()
-        if proposed_solution == true_solution:
-            if self._blob_validation_result.get():
-                self._captcha_solves += 1
-                return True
+            rejection_reason = ''
+            serial_number = None
+            solution_matches = False
+            profile = ''
+            try:
+                # Profiles may have different lifetimes, so the longest is enforced first, and the profile's afterwards:
+                true_solution = self._key_ring.get_fernet().decrypt(
+                    encrypted_blob,
+                    ttl = max(settings._LIFETIME for settings in self._profiles.values()),
+                ).decode()
+                profile = 'default'
+                if '\x00' in true_solution:
+                    profile, true_solution = true_solution.split('\x00', 1)
+                if profile not in self._profiles:
+                    profile = ''
+                    rejection_reason = 'invalid'
+                elif self._get_fernet_issue_time(encrypted_blob) + self._profiles[profile]._LIFETIME < time():
+                    rejection_reason = 'expired'
+                else:
+                    settings = self._profiles[profile]
+                    solution_matches = (
+                        self._normalize_solution(proposed_solution, settings) == self._normalize_solution(true_solution, settings)
+                    )
+            except InvalidToken:
+                # Expired blobs are told apart from invalid ones by their unverified timestamp (rather than by decrypting
+                # them again), so a forged blob may be counted as expired, but it is rejected either way:
+                unverified_issue_time = self._get_fernet_issue_time(encrypted_blob)
+                if unverified_issue_time and (unverified_issue_time + max(settings._LIFETIME for settings in self._profiles.values()) < time()):
+                    rejection_reason = 'expired'
+                else:
+                    rejection_reason = 'invalid'
+            if self._event_stream and (rejection_reason != 'invalid'):
+                issue_time = self._get_fernet_issue_time(encrypted_blob)
+
+        if not rejection_reason:
+            # Blobs are recorded even when the solution doesn't match, so that each blob only gets one attempt:
+            if serial_number is None:
+                lifetime = self._profiles[profile]._LIFETIME
             else:
-                return False
-        else:
-            self._blob_validation_result.get()
-            return False
+                # Serial numbers are recorded in epochs shared by every profile, so must be kept for the longest lifetime:
+                lifetime = max(settings._LIFETIME for settings in self._profiles.values())
+            if self._backend == 'threads':
+                # The replay stores are already in this process, so there is no need to hand the blob to a worker:
+                rejection_reason, error = self._record_blob(encrypted_blob, lifetime, serial_number, issue_time)
+            else:
+                with self._validation_lock:
+                    self._blob_to_validate.put((encrypted_blob, lifetime, serial_number, issue_time))
+                    rejection_reason, error = self._blob_validation_result.get()
+            if error:
+                raise RuntimeError(f'The replay store could not record the blob ({error})')
+            if (not rejection_reason) and (not solution_matches):
+                rejection_reason = 'mismatch'
+            elif not rejection_reason:
+                with self._stats_lock:
+                    self._captcha_solves += 1
+                self._time_series.record('Solved')
+        if rejection_reason:
+            with self._stats_lock:
+                self._rejections[rejection_reason] += 1
+        latency = (perf_counter_ns() - start_time) / 1_000_000_000
+        self._time_series.record('Validated', latency)
+        if self._event_stream:
+            self._event_stream.emit(
+                'validate',
+                # Malformed blobs may be of any size (or type), so they aren't hashed:
+                blob_id = '' if rejection_reason == 'malformed' else self._get_blob_id(encrypted_blob),
+                result = not rejection_reason,
+                reason = rejection_reason or 'solved',
+                profile = profile,
+                issue_time = issue_time,
+                latency = latency,
+                pool_depth = self._profile_captchas[profile or 'default'].qsize(),
+            )
+        return not rejection_reason
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Shut down the engine and exit the runtime context"""
@@ -928,6 +2139,104 @@ class Engine():
         return self.print_stats(True)
 
 
+class _RandomSource():
+    """Provides unbiased random values derived from a block of bytes fetched from the OS's CSPRNG in one call"""
+
+    def __init__(self, size):
+        """Fetches a block of random bytes large enough for (about) the expected number of draws"""
+
+        self._buffer = urandom(size)
+        self._position = 0
+
+    def bytes(self, size):
+        """Returns the requested number of random bytes, fetching more from the OS only if the block is exhausted"""
+
+        end = self._position + size
+        if end > len(self._buffer):
+            # Fall back to fetching another block, rather than ever reusing bytes:
+            self._buffer = urandom(max(size, 4096))
+            self._position = 0
+            end = size
+        random_bytes = self._buffer[self._position:end]
+        self._position = end
+        return random_bytes
+
+    def choice(self, sequence):
+        """Returns a random item from a non-empty sequence"""
+
+        return sequence[self.randbelow(len(sequence))]
+
+    def randbelow(self, upper_bound):
+        """Returns a random int in the range [0, upper_bound)"""
+
+        if upper_bound <= 0:
+            raise ValueError('The upper bound must be greater than 0')
+        bits = (upper_bound - 1).bit_length()
+        size = (bits + 7) // 8
+        mask = (1 << bits) - 1
+        # Discard values outside of the range (rather than using a modulus), so that the result is unbiased:
+        while True:
+            value = int.from_bytes(self.bytes(size), 'big') & mask
+            if value < upper_bound:
+                return value
+
+    def randbelow_many(self, upper_bound, count):
+        """Returns a list of count random ints in the range [0, upper_bound)"""
+
+        if upper_bound <= 0:
+            raise ValueError('The upper bound must be greater than 0')
+        bits = (upper_bound - 1).bit_length()
+        mask = (1 << bits) - 1
+        for size, type_code in [(1, 'B'), (2, 'H'), (4, 'I'), (8, 'Q')]:
+            if bits <= size * 8:
+                break
+        values = []
+        while len(values) < count:
+            remaining = count - len(values)
+            # Values are unpacked in bulk, and those outside of the range are discarded, as in randbelow:
+            for value in unpack(f'>{remaining}{type_code}', self.bytes(remaining * size)):
+                value &= mask
+                if value < upper_bound:
+                    values.append(value)
+        return values
+
+    def randrange(self, start, stop = None):
+        """Returns a random int in the range [start, stop), or [0, start) if stop is not provided"""
+
+        if stop is None:
+            return self.randbelow(start)
+        return start + self.randbelow(stop - start)
+
+
+class _ThreadQueue(Queue):
+    """A queue shared by threads, with the same interface as the multiprocessing queues used by the processes backend"""
+
+    def close(self):
+        """Does nothing, as there is no background thread or pipe to close"""
+
+        pass
+
+    def join_thread(self):
+        """Does nothing, as there is no background thread to wait for"""
+
+        pass
+
+
+class _ThreadValue():
+    """An integer shared by threads, with the same interface as the multiprocessing values used by the processes backend"""
+
+    def __init__(self, value):
+        """Initializes a new _ThreadValue object holding value"""
+
+        self.value = value
+        self._lock = Lock()
+
+    def get_lock(self):
+        """Returns the lock that guards the value"""
+
+        return self._lock
+
+
 class Settings():
     """Contains all of the configuration settings used when generating CAPTCHAs"""
 
@@ -940,6 +2249,8 @@ class Settings():
     def _calculate_font_sizes(self):
         """Calculates the font size to use with each typeface, based on provided settings"""
 
+        from PIL import ImageFont
+
         self._FONT_SIZES = {}
         if self._TEXT:
             text_length = len(self._TEXT)
@@ -978,6 +2289,58 @@ class Settings():
             else:
                 self._FONT_SIZES[typeface] = font_size
 
+    def _get_engine_setting_names(self):
+        """Returns the names of the settings that only apply to Engines"""
+
+        return [
+            'CASE_SENSITIVE',
+            'LIFETIME',
+            'POOL_SIZE',
+            'POOL_MEMORY_LIMIT',
+            'POOL_DIRECTORY',
+            'PRIORITY_RESERVES',
+            'POOL_WAIT_TIMEOUT',
+            'RATE_LIMIT',
+            'RATE_LIMIT_BURST',
+            'RATE_LIMIT_PATH',
+            'VALIDATION_RATE_LIMIT',
+            'VALIDATION_RATE_LIMIT_BURST',
+            'REFRESH_WORKERS',
+            'WORKER_NICENESS',
+            'WORKER_CPU_AFFINITY',
+            'WARM_START',
+            'POOL_SNAPSHOT_PATH',
+            'POOL_SNAPSHOT_KEY',
+            'TOKEN_FORMAT',
+            'REPLAY_PROTECTION',
+        ]
+
+    def _get_font_sizes(self):
+        """Returns the font size to use with each typeface, calculating them first if necessary"""
+
+        if self._FONT_SIZES is None:
+            self._calculate_font_sizes()
+        return self._FONT_SIZES
+
+    def _get_generation_rate(self):
+        """Returns the number of CAPTCHAs that may be regenerated per second according to the RATE_LIMIT setting (0 if unlimited)"""
+
+        if not self._RATE_LIMIT:
+            return 0
+        if type(self._RATE_LIMIT) == int:
+            return self._RATE_LIMIT / 60
+        return 1 / self._RATE_LIMIT
+
+    def _get_hash(self):
+        """Returns a hash of the settings that apply to CAPTCHAs, for checking if Captcha instances are interchangeable"""
+
+        from hashlib import sha256
+
+        settings = self.get_settings()
+        for setting in self._get_engine_setting_names():
+            del settings[setting]
+        return sha256(repr(settings).encode()).hexdigest()
+
     def _pretty_format_settings(self, exclude_engine_settings = False):
         """Creates a human readable string of the current settings"""
 
@@ -989,9 +2352,12 @@ class Settings():
                 max_setting_name_length = len(setting)
         for setting in settings:
             if exclude_engine_settings:
-                if setting in ['CASE_SENSITIVE', 'LIFETIME', 'POOL_SIZE', 'RATE_LIMIT']:
+                if setting in self._get_engine_setting_names():
                     continue
             trailing_spaces = ' ' * (max_setting_name_length - len(setting) + 1)
+            # Never display secret values:
+            if setting == 'POOL_SNAPSHOT_KEY' and settings[setting]:
+                settings[setting] = '********'
             # Visually indicate that this value is a string (especially helpful for empty strings):
             if type(settings[setting]) == str:
                 settings[setting] = f"'{settings[setting]}'"
@@ -999,7 +2365,7 @@ class Settings():
             if type(settings[setting]) == list and len(settings[setting]) > 1:
                 final_output += f'    {setting}{trailing_spaces}= [\n'
                 for list_item in settings[setting]:
-                    final_output += f'    {" " * len(setting)}{trailing_spaces}      \'{list_item}\',\n'
+                    final_output += f'    {" " * len(setting)}{trailing_spaces}      {list_item!r},\n'
                 final_output += f'    {" " * len(setting)}{trailing_spaces}  ]\n'
             else:
                 final_output += f'    {setting}{trailing_spaces}= {settings[setting]}\n'
@@ -1130,6 +2496,20 @@ class Settings():
 
         return Settings().get_settings()
 
+    def get_mime_type(self):
+        """Returns the MIME type of the configured output image format"""
+
+        return {
+            'BMP': 'image/bmp',
+            'GIF': 'image/gif',
+            'ICO': 'image/vnd.microsoft.icon',
+            'JPEG': 'image/jpeg',
+            'PNG': 'image/png',
+            'TIFF': 'image/tiff',
+            'WEBP': 'image/webp',
+            'PDF': 'application/pdf',
+        }[self._FORMAT]
+
     def get_settings(self):
         """Returns all settings and their current values as a dictionary"""
 
@@ -1137,6 +2517,7 @@ class Settings():
             'WIDTH': self._WIDTH,
             'HEIGHT': self._HEIGHT,
             'FORMAT': self._FORMAT,
+            'ENCODER_OPTIONS': self._ENCODER_OPTIONS,
             'TEXT': self._TEXT,
             'TEXT_LENGTH': self._TEXT_LENGTH,
             'CHARACTER_SET': self._CHARACTER_SET,
@@ -1148,10 +2529,59 @@ class Settings():
             'MAXIMUM_NOISE': self._MAXIMUM_NOISE,
             'MINIMUM_COLOR_BRIGHTNESS_DIFFERENCE': self._MINIMUM_COLOR_BRIGHTNESS_DIFFERENCE,
             'MINIMUM_COLOR_HUE_DIFFERENCE': self._MINIMUM_COLOR_HUE_DIFFERENCE,
+            'COLOR_MODE': self._COLOR_MODE,
+            'NOISE_BANK_SIZE': self._NOISE_BANK_SIZE,
+            'NOISE_BANK_REFRESH_INTERVAL': self._NOISE_BANK_REFRESH_INTERVAL,
             'CASE_SENSITIVE': self._CASE_SENSITIVE,
             'LIFETIME': self._LIFETIME,
             'POOL_SIZE': self._POOL_SIZE,
+            'POOL_MEMORY_LIMIT': self._POOL_MEMORY_LIMIT,
+            'POOL_DIRECTORY': self._POOL_DIRECTORY,
+            'PRIORITY_RESERVES': self._PRIORITY_RESERVES,
+            'POOL_WAIT_TIMEOUT': self._POOL_WAIT_TIMEOUT,
             'RATE_LIMIT': self._RATE_LIMIT,
+            'RATE_LIMIT_BURST': self._RATE_LIMIT_BURST,
+            'RATE_LIMIT_PATH': self._RATE_LIMIT_PATH,
+            'VALIDATION_RATE_LIMIT': self._VALIDATION_RATE_LIMIT,
+            'VALIDATION_RATE_LIMIT_BURST': self._VALIDATION_RATE_LIMIT_BURST,
+            'REFRESH_WORKERS': self._REFRESH_WORKERS,
+            'WORKER_NICENESS': self._WORKER_NICENESS,
+            'WORKER_CPU_AFFINITY': self._WORKER_CPU_AFFINITY,
+            'WARM_START': self._WARM_START,
+            'POOL_SNAPSHOT_PATH': self._POOL_SNAPSHOT_PATH,
+            'POOL_SNAPSHOT_KEY': self._POOL_SNAPSHOT_KEY,
+            'TOKEN_FORMAT': self._TOKEN_FORMAT,
+            'REPLAY_PROTECTION': self._REPLAY_PROTECTION,
+        }
+
+    def get_supported_encoder_options(self):
+        """Returns the encoder options supported by each output image format, and the values each option may be set to"""
+
+        return {
+            'BMP': {},
+            'GIF': {
+                'optimize': [False, True],
+            },
+            'ICO': {},
+            'JPEG': {
+                'quality': list(range(1, 101)),
+                'subsampling': [0, 1, 2],
+                'optimize': [False, True],
+                'progressive': [False, True],
+            },
+            'PNG': {
+                'compress_level': list(range(10)),
+                'optimize': [False, True],
+            },
+            'TIFF': {
+                'compression': ['raw', 'packbits', 'tiff_lzw', 'tiff_adobe_deflate'],
+            },
+            'WEBP': {
+                'quality': list(range(101)),
+                'method': list(range(7)),
+                'lossless': [False, True],
+            },
+            'PDF': {},
         }
 
     def get_supported_image_formats(self):
@@ -1168,6 +2598,14 @@ class Settings():
             'PDF',
         ]
 
+    def get_supported_token_formats(self):
+        """Returns a list of all of the supported blob (token) formats"""
+
+        return [
+            'FERNET',
+            'COMPACT',
+        ]
+
     def set(self, **kwargs):
         """Sets specified settings to specified values, then performs validation"""
 
@@ -1178,6 +2616,8 @@ class Settings():
                 self._HEIGHT = kwargs[setting]
             elif setting == 'FORMAT':
                 self._FORMAT = kwargs[setting].upper()
+            elif setting == 'ENCODER_OPTIONS':
+                self._ENCODER_OPTIONS = kwargs[setting]
             elif setting == 'TEXT':
                 self._TEXT = kwargs[setting]
             elif setting == 'TEXT_LENGTH':
@@ -1200,14 +2640,52 @@ class Settings():
                 self._MINIMUM_COLOR_BRIGHTNESS_DIFFERENCE = kwargs[setting]
             elif setting == 'MINIMUM_COLOR_HUE_DIFFERENCE':
                 self._MINIMUM_COLOR_HUE_DIFFERENCE = kwargs[setting]
+            elif setting == 'COLOR_MODE':
+                self._COLOR_MODE = kwargs[setting].upper()
+            elif setting == 'NOISE_BANK_SIZE':
+                self._NOISE_BANK_SIZE = kwargs[setting]
+            elif setting == 'NOISE_BANK_REFRESH_INTERVAL':
+                self._NOISE_BANK_REFRESH_INTERVAL = kwargs[setting]
             elif setting == 'CASE_SENSITIVE':
                 self._CASE_SENSITIVE = kwargs[setting]
             elif setting == 'LIFETIME':
                 self._LIFETIME = kwargs[setting]
             elif setting == 'POOL_SIZE':
                 self._POOL_SIZE = kwargs[setting]
+            elif setting == 'POOL_MEMORY_LIMIT':
+                self._POOL_MEMORY_LIMIT = kwargs[setting]
+            elif setting == 'POOL_DIRECTORY':
+                self._POOL_DIRECTORY = kwargs[setting]
+            elif setting == 'PRIORITY_RESERVES':
+                self._PRIORITY_RESERVES = kwargs[setting]
+            elif setting == 'POOL_WAIT_TIMEOUT':
+                self._POOL_WAIT_TIMEOUT = kwargs[setting]
             elif setting == 'RATE_LIMIT':
                 self._RATE_LIMIT = kwargs[setting]
+            elif setting == 'RATE_LIMIT_BURST':
+                self._RATE_LIMIT_BURST = kwargs[setting]
+            elif setting == 'RATE_LIMIT_PATH':
+                self._RATE_LIMIT_PATH = kwargs[setting]
+            elif setting == 'VALIDATION_RATE_LIMIT':
+                self._VALIDATION_RATE_LIMIT = kwargs[setting]
+            elif setting == 'VALIDATION_RATE_LIMIT_BURST':
+                self._VALIDATION_RATE_LIMIT_BURST = kwargs[setting]
+            elif setting == 'REFRESH_WORKERS':
+                self._REFRESH_WORKERS = kwargs[setting]
+            elif setting == 'WORKER_NICENESS':
+                self._WORKER_NICENESS = kwargs[setting]
+            elif setting == 'WORKER_CPU_AFFINITY':
+                self._WORKER_CPU_AFFINITY = kwargs[setting]
+            elif setting == 'WARM_START':
+                self._WARM_START = kwargs[setting]
+            elif setting == 'POOL_SNAPSHOT_PATH':
+                self._POOL_SNAPSHOT_PATH = kwargs[setting]
+            elif setting == 'POOL_SNAPSHOT_KEY':
+                self._POOL_SNAPSHOT_KEY = kwargs[setting]
+            elif setting == 'TOKEN_FORMAT':
+                self._TOKEN_FORMAT = kwargs[setting].upper()
+            elif setting == 'REPLAY_PROTECTION':
+                self._REPLAY_PROTECTION = kwargs[setting].upper()
             else:
                 raise NameError(f'The setting "{setting}" does not exist')
 
@@ -1216,9 +2694,14 @@ class Settings():
     def set_default_values(self):
         """Sets all settings to their default value"""
 
+        # Switch these once minimum supported Python version is Python 3.10:
+        #from importlib.resources import files
+        from importlib_resources import files
+
         self._WIDTH = 750 # In pixels
         self._HEIGHT = 250 # In pixels
         self._FORMAT = 'PNG'
+        self._ENCODER_OPTIONS = {} # Uses the image library's defaults if empty
         self._TEXT = '' # Randomly generated if blank
         self._TEXT_LENGTH = 6
         self._CHARACTER_SET = 'abcdefghjkmnpqrstuvwxyzABCDEFGHJKMNPQRSTUVWXYZ23456789' # Commonly-confused characters discluded
@@ -1234,10 +2717,29 @@ class Settings():
         self._MAXIMUM_NOISE = 25 # In maximum layers of noise
         self._MINIMUM_COLOR_BRIGHTNESS_DIFFERENCE = 65 # Per W3 should be 125 in production
         self._MINIMUM_COLOR_HUE_DIFFERENCE = 250 # Per W3 should be 500 in production
+        self._COLOR_MODE = 'RGB'
+        self._NOISE_BANK_SIZE = 0 # In noise layers; disabled
+        self._NOISE_BANK_REFRESH_INTERVAL = 60 # In seconds
         self._CASE_SENSITIVE = False
         self._LIFETIME = 600 # In seconds
         self._POOL_SIZE = 500 # In Captcha instances
+        self._POOL_MEMORY_LIMIT = 0 # In bytes; disabled
+        self._POOL_DIRECTORY = '' # Images are returned inline if blank
+        self._PRIORITY_RESERVES = [] # Percentages of the pool; only priority 0 if empty
+        self._POOL_WAIT_TIMEOUT = 0 # In seconds; unlimited
         self._RATE_LIMIT = 0 # Disabled
+        self._RATE_LIMIT_BURST = 1 # In CAPTCHAs
+        self._RATE_LIMIT_PATH = '' # Not shared between Engines if blank
+        self._VALIDATION_RATE_LIMIT = 0 # Per client, per minute; disabled
+        self._VALIDATION_RATE_LIMIT_BURST = 10
+        self._REFRESH_WORKERS = 1 # In subprocesses; automatic if 0
+        self._WORKER_NICENESS = 0 # Unchanged
+        self._WORKER_CPU_AFFINITY = [] # Unrestricted if empty
+        self._WARM_START = 0 # In Captcha instances; disabled
+        self._POOL_SNAPSHOT_PATH = '' # Disabled if blank
+        self._POOL_SNAPSHOT_KEY = ''
+        self._TOKEN_FORMAT = 'FERNET'
+        self._REPLAY_PROTECTION = 'STORE' # SERIAL only applies to COMPACT tokens
 
         self.validate_settings()
 
@@ -1270,6 +2772,21 @@ class Settings():
             raise TypeError('The FORMAT setting is not a str')
         if self._FORMAT not in self.get_supported_image_formats():
             raise ValueError('The FORMAT setting provided is not a supported output image format')
+        if type(self._ENCODER_OPTIONS) is not dict:
+            raise TypeError('The ENCODER_OPTIONS setting is not a dict')
+        supported_encoder_options = self.get_supported_encoder_options()[self._FORMAT]
+        for option in self._ENCODER_OPTIONS:
+            if option not in supported_encoder_options:
+                raise ValueError(f"The ENCODER_OPTIONS setting contains the option '{option}', which is not supported by the {self._FORMAT} format")
+            value = self._ENCODER_OPTIONS[option]
+            allowed_values = supported_encoder_options[option]
+            if (type(value) is not type(allowed_values[0])) or (value not in allowed_values):
+                if type(allowed_values[0]) is int:
+                    raise ValueError(
+                        f"The '{option}' option of the ENCODER_OPTIONS setting must be an integer " +
+                        f'from {allowed_values[0]} through {allowed_values[-1]}'
+                    )
+                raise ValueError(f"The '{option}' option of the ENCODER_OPTIONS setting must be one of: {allowed_values}")
         if type(self._TEXT) is not str:
             raise TypeError('The TEXT setting is not a str')
         if self._TEXT and (len(self._TEXT) < 3):
@@ -1323,6 +2840,29 @@ class Settings():
             raise TypeError('The MINIMUM_COLOR_HUE_DIFFERENCE setting is not an int')
         if self._MINIMUM_COLOR_HUE_DIFFERENCE > 600:
             raise ValueError('The MINIMUM_COLOR_HUE_DIFFERENCE setting must be an integer less than or equal to 600')
+        if type(self._COLOR_MODE) is not str:
+            raise TypeError('The COLOR_MODE setting is not a str')
+        if self._COLOR_MODE not in ['RGB', 'P']:
+            raise ValueError("The COLOR_MODE setting must be equal to 'RGB' or 'P'")
+        if self._COLOR_MODE == 'P':
+            if self._FORMAT == 'JPEG':
+                raise ValueError("The COLOR_MODE setting must be equal to 'RGB' when the FORMAT setting is 'JPEG'")
+            # The background, each character, and each layer of noise may all need their own palette entry:
+            if 1 + max(len(self._TEXT), self._TEXT_LENGTH) + self._MAXIMUM_NOISE > 256:
+                raise ValueError(
+                    "The TEXT_LENGTH (or TEXT) and MAXIMUM_NOISE settings require more than 256 colors, " +
+                    "which is the maximum when the COLOR_MODE setting is 'P'"
+                )
+        if type(self._NOISE_BANK_SIZE) is not int:
+            raise TypeError('The NOISE_BANK_SIZE setting is not an int')
+        if self._NOISE_BANK_SIZE < 0:
+            raise ValueError('The NOISE_BANK_SIZE setting cannot be less than 0')
+        if self._NOISE_BANK_SIZE and (self._MAXIMUM_NOISE > 255):
+            raise ValueError('The MAXIMUM_NOISE setting cannot be greater than 255 when the NOISE_BANK_SIZE setting is enabled')
+        if type(self._NOISE_BANK_REFRESH_INTERVAL) is not int and type(self._NOISE_BANK_REFRESH_INTERVAL) is not float:
+            raise TypeError('The NOISE_BANK_REFRESH_INTERVAL setting is not an int or float')
+        if self._NOISE_BANK_REFRESH_INTERVAL <= 0:
+            raise ValueError('The NOISE_BANK_REFRESH_INTERVAL setting must be greater than 0')
         if type(self._CASE_SENSITIVE) is not bool:
             raise TypeError('The CASE_SENSITIVE setting is not a bool')
         if type(self._LIFETIME) is not int:
@@ -1333,14 +2873,107 @@ class Settings():
             raise TypeError('The POOL_SIZE setting is not an int')
         if self._POOL_SIZE < 1:
             raise ValueError('The POOL_SIZE setting must be an integer greater than 0')
+        if type(self._POOL_MEMORY_LIMIT) is not int:
+            raise TypeError('The POOL_MEMORY_LIMIT setting is not an int')
+        if self._POOL_MEMORY_LIMIT < 0:
+            raise ValueError('The POOL_MEMORY_LIMIT setting cannot be less than 0')
+        if type(self._POOL_DIRECTORY) is not str:
+            raise TypeError('The POOL_DIRECTORY setting is not a str')
+        if self._POOL_DIRECTORY and (not Path(self._POOL_DIRECTORY).is_dir()):
+            raise ValueError(f"The POOL_DIRECTORY directory '{self._POOL_DIRECTORY}' could not be found")
+        if type(self._PRIORITY_RESERVES) is not list:
+            raise TypeError('The PRIORITY_RESERVES setting is not a list')
+        for reserve in self._PRIORITY_RESERVES:
+            if type(reserve) is not int:
+                raise TypeError('The PRIORITY_RESERVES setting contains an item that is not an int')
+            if reserve < 0:
+                raise ValueError('The PRIORITY_RESERVES setting contains a percentage less than 0')
+        if sum(self._PRIORITY_RESERVES) >= 100:
+            raise ValueError('The PRIORITY_RESERVES setting must add up to less than 100 percent')
+        if type(self._POOL_WAIT_TIMEOUT) is not int and type(self._POOL_WAIT_TIMEOUT) is not float:
+            raise TypeError('The POOL_WAIT_TIMEOUT setting is not an int or float')
+        if self._POOL_WAIT_TIMEOUT < 0:
+            raise ValueError('The POOL_WAIT_TIMEOUT setting cannot be less than 0')
         if type(self._RATE_LIMIT) is not int and type(self._RATE_LIMIT) is not float:
             raise TypeError('The RATE_LIMIT setting is not an int or float')
         if self._RATE_LIMIT < 0:
             raise ValueError('The RATE_LIMIT setting cannot be less than 0')
         if type(self._RATE_LIMIT) == float and self._RATE_LIMIT == 0.0:
             self._RATE_LIMIT = 0
-
-        self._calculate_font_sizes()
+        if type(self._RATE_LIMIT_BURST) is not int:
+            raise TypeError('The RATE_LIMIT_BURST setting is not an int')
+        if self._RATE_LIMIT_BURST < 1:
+            raise ValueError('The RATE_LIMIT_BURST setting must be an integer greater than 0')
+        if type(self._RATE_LIMIT_PATH) is not str:
+            raise TypeError('The RATE_LIMIT_PATH setting is not a str')
+        if self._RATE_LIMIT_PATH and (not Path(self._RATE_LIMIT_PATH).parent.is_dir()):
+            raise ValueError(f"The directory for the RATE_LIMIT_PATH file '{self._RATE_LIMIT_PATH}' could not be found")
+        if type(self._VALIDATION_RATE_LIMIT) is not int:
+            raise TypeError('The VALIDATION_RATE_LIMIT setting is not an int')
+        if self._VALIDATION_RATE_LIMIT < 0:
+            raise ValueError('The VALIDATION_RATE_LIMIT setting cannot be less than 0')
+        if type(self._VALIDATION_RATE_LIMIT_BURST) is not int:
+            raise TypeError('The VALIDATION_RATE_LIMIT_BURST setting is not an int')
+        if self._VALIDATION_RATE_LIMIT_BURST < 1:
+            raise ValueError('The VALIDATION_RATE_LIMIT_BURST setting must be an integer greater than 0')
+        if type(self._REFRESH_WORKERS) is not int:
+            raise TypeError('The REFRESH_WORKERS setting is not an int')
+        if self._REFRESH_WORKERS < 0:
+            raise ValueError('The REFRESH_WORKERS setting cannot be less than 0')
+        if type(self._WORKER_NICENESS) is not int:
+            raise TypeError('The WORKER_NICENESS setting is not an int')
+        if (self._WORKER_NICENESS < 0) or (self._WORKER_NICENESS > 19):
+            raise ValueError('The WORKER_NICENESS setting must be an integer from 0 to 19')
+        if type(self._WORKER_CPU_AFFINITY) is not list:
+            raise TypeError('The WORKER_CPU_AFFINITY setting is not a list')
+        for cpu in self._WORKER_CPU_AFFINITY:
+            if type(cpu) is not int:
+                raise TypeError('The WORKER_CPU_AFFINITY setting contains an item that is not an int')
+            if cpu < 0:
+                raise ValueError('The WORKER_CPU_AFFINITY setting contains a CPU number less than 0')
+        if self._WORKER_CPU_AFFINITY:
+            try:
+                from os import sched_getaffinity
+            except ImportError:
+                raise ValueError('The WORKER_CPU_AFFINITY setting is not supported on this platform') from None
+            if not set(self._WORKER_CPU_AFFINITY).issubset(sched_getaffinity(0)):
+                raise ValueError('The WORKER_CPU_AFFINITY setting contains a CPU that is not available to this process')
+        if type(self._WARM_START) is not int:
+            raise TypeError('The WARM_START setting is not an int')
+        if self._WARM_START < 0:
+            raise ValueError('The WARM_START setting cannot be less than 0')
+        if self._WARM_START > self._POOL_SIZE:
+            raise ValueError('The WARM_START setting cannot be greater than the POOL_SIZE setting')
+        if type(self._POOL_SNAPSHOT_PATH) is not str:
+            raise TypeError('The POOL_SNAPSHOT_PATH setting is not a str')
+        if type(self._POOL_SNAPSHOT_KEY) is not str:
+            raise TypeError('The POOL_SNAPSHOT_KEY setting is not a str')
+        if self._POOL_SNAPSHOT_PATH:
+            if not self._POOL_SNAPSHOT_KEY:
+                raise ValueError('The POOL_SNAPSHOT_KEY setting cannot be blank when the POOL_SNAPSHOT_PATH setting is set')
+            if not Path(self._POOL_SNAPSHOT_PATH).parent.is_dir():
+                raise ValueError(f"The directory for the POOL_SNAPSHOT_PATH file '{self._POOL_SNAPSHOT_PATH}' could not be found")
+            from cryptography.fernet import Fernet
+            try:
+                Fernet(self._POOL_SNAPSHOT_KEY)
+            except ValueError:
+                raise ValueError('The POOL_SNAPSHOT_KEY setting is not a valid Fernet key') from None
+        if type(self._TOKEN_FORMAT) is not str:
+            raise TypeError('The TOKEN_FORMAT setting is not a str')
+        if self._TOKEN_FORMAT not in self.get_supported_token_formats():
+            raise ValueError('The TOKEN_FORMAT setting provided is not a supported token format')
+        if type(self._REPLAY_PROTECTION) is not str:
+            raise TypeError('The REPLAY_PROTECTION setting is not a str')
+        if self._REPLAY_PROTECTION not in ['STORE', 'SERIAL']:
+            raise ValueError("The REPLAY_PROTECTION setting must be either 'STORE' or 'SERIAL'")
+
+        # Font sizes depend on font metrics, which require Pillow, so they are only calculated once a CAPTCHA is rendered.
+        # Until then, the text is checked against the WIDTH setting as if no character were wider than its font size:
+        text_length = (len(self._TEXT) if self._TEXT else self._TEXT_LENGTH) + 1
+        font_size = round(((self._WIDTH - 1) // text_length) / (1 + self._FONT_SIZE_SHIFT_PERCENTAGE / 100))
+        if round(font_size - (font_size * (self._FONT_SIZE_SHIFT_PERCENTAGE / 100))) <= 0:
+            raise ValueError('The WIDTH setting is too small to fit the provided number of characters')
+        self._FONT_SIZES = None
 
     def __repr__(self):
         """Returns a string that represents this Settings instance"""
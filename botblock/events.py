@@ -0,0 +1,282 @@
+"""Contains the event stream used by Engines to record CAPTCHA issuance and validation, without blocking requests"""
+
+from abc import ABC, abstractmethod
+from collections import deque
+from json import dumps
+from os import getpid
+from threading import Event, Lock, Thread
+from time import time
+
+
+class EventSink(ABC):
+    """The interface shared by all event sinks, which durably record batches of events"""
+
+    def __getstate__(self):
+        """Returns the picklable state of the event sink, without its lock or open files"""
+
+        state = self.__dict__.copy()
+        for attribute in ['_connection', '_file', '_lock']:
+            if attribute in state:
+                state[attribute] = None
+        return state
+
+    def close(self):
+        """Releases any resources (such as open files) held by the event sink"""
+
+        pass
+
+    @abstractmethod
+    def write(self, events):
+        """Records a batch of events (each a dictionary)"""
+
+        pass
+
+    def __setstate__(self, state):
+        """Restores the event sink from its pickled state"""
+
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+
+class JSONLEventSink(EventSink):
+    """An event sink that appends each event to a file, as one line of JSON"""
+
+    def __init__(self, path):
+        """Initializes a new JSONLEventSink object, appending to the file at the provided path"""
+
+        self._path = str(path)
+        self._file = None
+        self._file_pid = 0
+        self._lock = Lock()
+
+    def close(self):
+        """Closes this process's handle on the file"""
+
+        with self._lock:
+            if (self._file is not None) and (self._file_pid == getpid()):
+                self._file.close()
+            self._file = None
+
+    def write(self, events):
+        """Appends a batch of events to the file, with a single write"""
+
+        with self._lock:
+            # Files must not be shared with forked children, so each process opens its own:
+            if (self._file is None) or (self._file_pid != getpid()):
+                self._file = open(self._path, 'a')
+                self._file_pid = getpid()
+            self._file.write(''.join(dumps(event) + '\n' for event in events))
+            self._file.flush()
+
+
+class SQLiteEventSink(EventSink):
+    """An event sink that inserts events into an SQLite database file, for querying"""
+
+    def __init__(self, path, timeout = 5):
+        """Initializes a new SQLiteEventSink object using the database file at the provided path"""
+
+        self._path = str(path)
+        self._timeout = timeout
+        self._connection = None
+        self._connection_pid = 0
+        self._lock = Lock()
+
+    def _get_connection(self):
+        """Returns this process's connection to the database, opening it first if necessary"""
+
+        from sqlite3 import connect
+
+        # Connections must not be shared with forked children, so each process opens its own:
+        if (self._connection is None) or (self._connection_pid != getpid()):
+            self._connection = connect(
+                self._path,
+                timeout = self._timeout,
+                isolation_level = None,
+                check_same_thread = False,
+            )
+            self._connection_pid = getpid()
+            self._connection.execute('PRAGMA journal_mode = WAL')
+            self._connection.execute('PRAGMA synchronous = NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS events (time REAL NOT NULL, type TEXT NOT NULL, data TEXT NOT NULL)'
+            )
+        return self._connection
+
+    def close(self):
+        """Closes this process's connection to the database"""
+
+        with self._lock:
+            if (self._connection is not None) and (self._connection_pid == getpid()):
+                self._connection.close()
+            self._connection = None
+
+    def write(self, events):
+        """Inserts a batch of events in a single transaction"""
+
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.executemany(
+                    'INSERT INTO events (time, type, data) VALUES (?, ?, ?)',
+                    [(event['time'], event['type'], dumps(event)) for event in events],
+                )
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+
+class EventStream():
+    """Buffers events in memory, and writes them to one or more sinks in batches, on a background thread"""
+
+    def __init__(self, sinks, capacity = 10000, batch_size = 500, flush_interval = 1):
+        """Initializes a new EventStream object, and starts its background thread
+
+        Emitting an event never blocks: when the buffer already holds capacity events, new events
+        are dropped (and counted) until the background thread catches up.
+        """
+
+        if isinstance(sinks, EventSink):
+            sinks = [sinks]
+        for sink in sinks:
+            if not isinstance(sink, EventSink):
+                raise TypeError(f'The "sinks" argument supplied must only contain instances of "EventSink", not a "{type(sink)}"')
+        if (type(capacity) is not int) or (capacity < 1):
+            raise ValueError('The "capacity" argument supplied must be an integer greater than 0')
+        if (type(batch_size) is not int) or (batch_size < 1):
+            raise ValueError('The "batch_size" argument supplied must be an integer greater than 0')
+        if (type(flush_interval) not in [int, float]) or (flush_interval <= 0):
+            raise ValueError('The "flush_interval" argument supplied must be greater than 0')
+
+        self._sinks = list(sinks)
+        self._capacity = capacity
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._buffer = deque()
+        self._emitted = 0
+        self._dropped = 0
+        self._written = 0
+        self._failed = 0
+        self._closed = False
+        # Held by the background thread while writing, so that flush can wait for a batch in progress:
+        self._write_lock = Lock()
+        # Events may be emitted from any request thread, so the buffer's capacity and the counters are checked and
+        # updated under this lock (which is only ever held briefly):
+        self._emit_lock = Lock()
+        self._wake_up = Event()
+        self._thread = Thread(target = self._write_events, args = (), daemon = True)
+        self._thread.start()
+
+    def __enter__(self):
+        """Enter the runtime context and return this object"""
+
+        return self
+
+    def __getstate__(self):
+        """Returns the picklable state of the event stream, without its buffer, locks, or thread (which stay in this process)"""
+
+        state = self.__dict__.copy()
+        state['_buffer'] = None
+        state['_write_lock'] = None
+        state['_emit_lock'] = None
+        state['_wake_up'] = None
+        state['_thread'] = None
+        return state
+
+    def _write_batch(self):
+        """Writes up to one batch of buffered events to every sink, and returns the number of events written"""
+
+        batch = []
+        while self._buffer and (len(batch) < self._batch_size):
+            batch.append(self._buffer.popleft())
+        if batch:
+            succeeded = failed = False
+            for sink in self._sinks:
+                try:
+                    sink.write(batch)
+                    succeeded = True
+                except Exception:
+                    # Failing to record events must never affect CAPTCHAs, so failures are only counted:
+                    failed = True
+            # Events are counted as written if any sink recorded them, and as failed (once) if any sink did not:
+            if succeeded:
+                self._written += len(batch)
+            if failed:
+                self._failed += len(batch)
+        return len(batch)
+
+    def _write_events(self):
+        """Writes buffered events in batches, whenever a batch fills up or the flush interval passes"""
+
+        while not self._closed:
+            self._wake_up.wait(self._flush_interval)
+            self._wake_up.clear()
+            with self._write_lock:
+                while self._write_batch() == self._batch_size:
+                    pass
+
+    def close(self):
+        """Writes any buffered events, stops the background thread, and closes the sinks"""
+
+        if self._closed:
+            return
+        self._closed = True
+        self._wake_up.set()
+        self._thread.join()
+        with self._write_lock:
+            while self._write_batch():
+                pass
+        for sink in self._sinks:
+            sink.close()
+
+    def emit(self, event_type, **fields):
+        """Adds an event to the buffer (or drops it, if the buffer is full), without ever blocking"""
+
+        event = {'time': time(), 'type': event_type}
+        event.update(fields)
+        with self._emit_lock:
+            self._emitted += 1
+            if self._closed or (len(self._buffer) >= self._capacity):
+                self._dropped += 1
+                return
+            self._buffer.append(event)
+            buffered = len(self._buffer)
+        if buffered >= self._batch_size:
+            self._wake_up.set()
+
+    def flush(self):
+        """Blocks until every event buffered so far has been written"""
+
+        with self._write_lock:
+            while self._write_batch():
+                pass
+
+    def get_stats(self):
+        """Returns the number of events emitted, dropped, buffered, written, and failed to be written, as a dictionary"""
+
+        with self._emit_lock:
+            emitted = self._emitted
+            dropped = self._dropped
+        return {
+            'Emitted': emitted,
+            'Dropped': dropped,
+            'Buffered': len(self._buffer),
+            'Written': self._written,
+            'Failed': self._failed,
+        }
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Close the event stream and exit the runtime context"""
+
+        self.close()
+
+    def __setstate__(self, state):
+        """Restores the event stream from its pickled state, without its background thread (so it drops every event)"""
+
+        self.__dict__.update(state)
+        self._buffer = deque()
+        self._write_lock = Lock()
+        self._emit_lock = Lock()
+        self._wake_up = Event()
+        self._closed = True
@@ -0,0 +1,214 @@
+"""Contains the key ring used by Engines to encrypt and authenticate CAPTCHA blobs"""
+
+from os import environ
+from pathlib import Path
+from threading import Lock
+from time import time
+
+
+class KeyRing():
+    """A set of Fernet keys, which may be shared by several Engines and rotated on a schedule"""
+
+    def __init__(self, keys = None, path = '', environment_variable = '', rotation_interval = 0, retention = 600):
+        """Initializes a new KeyRing object from provided keys, a key file, and/or an environment variable
+
+        Keys are ordered from newest to oldest. New blobs are always encrypted with the newest key, while
+        blobs encrypted with any key in the ring can be decrypted. When no keys are provided, a random key
+        is generated (and written to the key file, if a path is provided).
+        """
+
+        self._path = str(path)
+        self._environment_variable = environment_variable
+        self._rotation_interval = rotation_interval
+        self._retention = retention
+        self._fernet = None
+        self._mac_keys = []
+        self._last_check = 0
+        self._lock = Lock()
+        self._file_modification_time = 0
+
+        if type(self._rotation_interval) not in [int, float]:
+            raise TypeError('The "rotation_interval" argument supplied must be an int or float')
+        if self._rotation_interval < 0:
+            raise ValueError('The "rotation_interval" argument supplied cannot be less than 0')
+        if type(self._retention) not in [int, float]:
+            raise TypeError('The "retention" argument supplied must be an int or float')
+        if self._retention < 0:
+            raise ValueError('The "retention" argument supplied cannot be less than 0')
+
+        # Each key is stored alongside the time at which it was created:
+        self._keys = []
+        current_time = time()
+        for key in (keys or []):
+            self._keys.append((current_time, self._validate_key(key)))
+        if environment_variable:
+            for key in environ.get(environment_variable, '').split(','):
+                if key.strip():
+                    self._keys.append((current_time, self._validate_key(key.strip())))
+        if self._path:
+            self._synchronize_file(force_write = bool(self._keys))
+        if not self._keys:
+            self._rotate()
+        self._update_fernet()
+
+    def __getstate__(self):
+        """Returns the picklable state of the key ring, without its lock"""
+
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def _generate_key(self):
+        """Returns a new, random Fernet key"""
+
+        from cryptography.fernet import Fernet
+
+        return Fernet.generate_key().decode()
+
+    def _read_file(self, key_file):
+        """Returns the keys (and their creation times) stored in an open key file"""
+
+        keys = []
+        key_file.seek(0)
+        for line in key_file.read().splitlines():
+            if line.strip():
+                creation_time, key = line.split()
+                keys.append((float(creation_time), self._validate_key(key)))
+        return keys
+
+    def _retire_keys(self, keys, current_time):
+        """Returns the keys that are still needed, dropping any that were replaced longer ago than the retention period"""
+
+        keys_to_keep = keys[:1]
+        for newer_key, key in zip(keys, keys[1:]):
+            if current_time - newer_key[0] < self._retention:
+                keys_to_keep.append(key)
+        return keys_to_keep
+
+    def _rotate(self):
+        """Adds a new key to the front of the key ring, and drops keys that are no longer needed"""
+
+        current_time = time()
+        self._keys = self._retire_keys([(current_time, self._generate_key())] + self._keys, current_time)
+
+    def _rotation_due(self):
+        """Returns True if the newest key is older than the rotation interval"""
+
+        return bool(self._rotation_interval) and (time() - self._keys[0][0] >= self._rotation_interval)
+
+    def _synchronize_file(self, force_write = False):
+        """Reloads the key ring from the key file, rotating the keys in the file first if a rotation is due"""
+
+        from fcntl import LOCK_EX, LOCK_UN, flock
+        from os import O_CREAT, O_RDWR, open as open_file
+
+        file_descriptor = open_file(self._path, O_RDWR | O_CREAT, 0o600)
+        with open(file_descriptor, 'r+') as key_file:
+            # Lock the file, so that only one Engine (or process) rotates the keys:
+            flock(key_file, LOCK_EX)
+            file_keys = self._read_file(key_file)
+            write_file = force_write or (not file_keys)
+            if force_write:
+                # Keys provided directly take precedence over (but do not replace) those in the file:
+                provided_keys = [key for _, key in self._keys]
+                self._keys += [file_key for file_key in file_keys if file_key[1] not in provided_keys]
+            else:
+                self._keys = file_keys
+            if (not self._keys) or self._rotation_due():
+                self._rotate()
+                write_file = True
+            if write_file:
+                key_file.seek(0)
+                key_file.truncate()
+                key_file.write(''.join(f'{creation_time} {key}\n' for creation_time, key in self._keys))
+                key_file.flush()
+            flock(key_file, LOCK_UN)
+        self._file_modification_time = Path(self._path).stat().st_mtime_ns
+
+    def _refresh(self):
+        """Reloads or rotates the keys if necessary, checking for changes about once per second"""
+
+        current_time = time()
+        # Only check for changes about once per second, to keep this method cheap:
+        if current_time - self._last_check >= 1:
+            with self._lock:
+                self._last_check = current_time
+                if self._path:
+                    try:
+                        file_changed = Path(self._path).stat().st_mtime_ns != self._file_modification_time
+                    except FileNotFoundError:
+                        file_changed = True
+                    if file_changed or self._rotation_due():
+                        self._synchronize_file()
+                        self._update_fernet()
+                elif self._rotation_due():
+                    self._rotate()
+                    self._update_fernet()
+
+    def _update_fernet(self):
+        """Rebuilds the MultiFernet instance and the MAC keys from the current keys"""
+
+        from base64 import urlsafe_b64decode
+        from cryptography.fernet import Fernet, MultiFernet
+        from hashlib import sha256
+        from hmac import digest
+
+        self._fernet = MultiFernet([Fernet(key) for _, key in self._keys])
+        # Derive separate keys for compact tokens, rather than reusing the Fernet keys directly:
+        self._mac_keys = [
+            digest(urlsafe_b64decode(key), b'BotBlock compact token', sha256)
+            for _, key in self._keys
+        ]
+
+    def _validate_key(self, key):
+        """Returns a key as a str, after checking that it is a valid Fernet key"""
+
+        from cryptography.fernet import Fernet
+
+        if type(key) is bytes:
+            key = key.decode()
+        if type(key) is not str:
+            raise TypeError(f'Keys must be of type "str" or "bytes", not "{type(key)}"')
+        try:
+            Fernet(key)
+        except ValueError:
+            raise ValueError('At least one key is not a valid Fernet key') from None
+        return key
+
+    def get_fernet(self):
+        """Returns a MultiFernet instance for the current keys, after reloading or rotating them if necessary"""
+
+        self._refresh()
+        return self._fernet
+
+    def get_keys(self):
+        """Returns the keys in the key ring, from newest to oldest"""
+
+        return [key for _, key in self._keys]
+
+    def get_mac_keys(self):
+        """Returns the keys used to authenticate compact tokens (derived from the current keys), from newest to oldest"""
+
+        self._refresh()
+        return self._mac_keys
+
+    def get_path(self):
+        """Returns the path of the key file ('' if the keys aren't kept in a file)"""
+
+        return self._path
+
+    def get_retention(self):
+        """Returns the number of seconds that replaced keys are kept for"""
+
+        return self._retention
+
+    def get_rotation_interval(self):
+        """Returns the number of seconds after which a new key is added to the key ring (0 if disabled)"""
+
+        return self._rotation_interval
+
+    def __setstate__(self, state):
+        """Restores the key ring from its pickled state"""
+
+        self.__dict__.update(state)
+        self._lock = Lock()
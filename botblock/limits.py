@@ -0,0 +1,257 @@
+"""Contains the token buckets used by Engines to limit the rate at which CAPTCHAs are regenerated, and validated by each client"""
+
+from collections import OrderedDict
+from os import getpid
+from struct import Struct
+from threading import Lock
+from time import sleep, time
+
+
+# The bucket's state is its token count, the time it was last refilled, its refill rate, and its burst size:
+_BUCKET_STATE = Struct('=dddd')
+
+
+class TokenBucket():
+    """A token bucket whose state can be shared by several processes, and (through a file) by several Engines"""
+
+    def __init__(self, rate = 0, burst = 1, path = '', shared = True):
+        """Initializes a new TokenBucket object, refilled with rate tokens per second and holding up to burst tokens
+
+        When a path is provided, the bucket's state is kept in that file, so that every process and Engine on the
+        host using the same path shares a single budget. Otherwise, the state is kept in shared memory, and is only
+        shared with the processes started by this process (or, if shared is False, in this process's memory, and is
+        only shared with its threads). A rate of 0 disables rate limiting.
+        """
+
+        self._path = str(path)
+        self._file = None
+        self._file_pid = 0
+        # File locks don't exclude threads using the same file, so they must also hold a thread lock:
+        self._file_lock = Lock()
+        self._state = None
+        self._state_lock = None
+        if (not self._path) and shared:
+            from multiprocessing import Lock as ProcessLock, RawArray
+
+            self._state = RawArray('d', 4)
+            self._state_lock = ProcessLock()
+        elif not self._path:
+            self._state = [0.0, 0.0, 0.0, 0.0]
+            self._state_lock = Lock()
+        self.configure(rate, burst)
+
+    def __getstate__(self):
+        """Returns the picklable state of the token bucket, without its open file"""
+
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_file_pid'] = 0
+        state['_file_lock'] = None
+        return state
+
+    def _get_file(self):
+        """Returns this process's handle on the state file, opening it first if necessary"""
+
+        from os import O_CREAT, O_RDWR, open as open_file
+
+        # File handles must not be shared with forked children, so each process opens its own:
+        if (self._file is None) or (self._file_pid != getpid()):
+            self._file = open(open_file(self._path, O_RDWR | O_CREAT, 0o600), 'r+b', buffering = 0)
+            self._file_pid = getpid()
+        return self._file
+
+    def _read_state(self):
+        """Returns the bucket's current state (the lock must be held)"""
+
+        if self._path:
+            bucket_file = self._get_file()
+            bucket_file.seek(0)
+            data = bucket_file.read(_BUCKET_STATE.size)
+            if len(data) < _BUCKET_STATE.size:
+                # A new state file is treated like new shared memory, which starts zeroed:
+                return [0.0, 0.0, 0.0, 0.0]
+            return list(_BUCKET_STATE.unpack(data))
+        return list(self._state)
+
+    def _refill(self, state, current_time):
+        """Adds the tokens earned since the bucket was last refilled to its state"""
+
+        tokens, last_refill, rate, burst = state
+        # Clocks can step backwards, which must never remove tokens:
+        elapsed_time = max(0, current_time - last_refill)
+        state[0] = min(burst, tokens + (elapsed_time * rate))
+        state[1] = current_time
+
+    def _update(self, function):
+        """Calls a function with the bucket's state while holding its lock, saves the state, and returns the result"""
+
+        if self._path:
+            from fcntl import LOCK_EX, LOCK_UN, flock
+
+            with self._file_lock:
+                bucket_file = self._get_file()
+                flock(bucket_file, LOCK_EX)
+                try:
+                    state = self._read_state()
+                    result = function(state)
+                    bucket_file.seek(0)
+                    bucket_file.write(_BUCKET_STATE.pack(*state))
+                finally:
+                    flock(bucket_file, LOCK_UN)
+        else:
+            with self._state_lock:
+                state = self._read_state()
+                result = function(state)
+                self._state[:] = state
+        return result
+
+    def acquire(self, should_stop = None):
+        """Blocks until a token is available and takes it, returning True, or returns False if should_stop returns True first"""
+
+        def take_token(state):
+            if state[2] == 0:
+                return 0
+            self._refill(state, time())
+            if state[0] >= 1:
+                state[0] -= 1
+                return 0
+            return (1 - state[0]) / state[2]
+
+        while True:
+            time_to_wait = self._update(take_token)
+            if time_to_wait == 0:
+                return True
+            # Wait in short steps, so that stop requests (and rate changes) are noticed promptly:
+            sleep(min(time_to_wait, 0.25))
+            if should_stop and should_stop():
+                return False
+
+    def close(self):
+        """Closes this process's handle on the state file, if there is one"""
+
+        with self._file_lock:
+            if (self._file is not None) and (self._file_pid == getpid()):
+                self._file.close()
+            self._file = None
+
+    def configure(self, rate, burst):
+        """Changes the bucket's refill rate (in tokens per second) and burst size, for every process sharing it
+
+        A new bucket starts full, while an existing bucket keeps its current tokens (up to the new burst size).
+        """
+
+        if type(rate) not in [int, float]:
+            raise TypeError('The "rate" argument supplied must be an int or float')
+        if rate < 0:
+            raise ValueError('The "rate" argument supplied cannot be less than 0')
+        if type(burst) is not int:
+            raise TypeError('The "burst" argument supplied must be an int')
+        if burst < 1:
+            raise ValueError('The "burst" argument supplied must be greater than 0')
+
+        def set_parameters(state):
+            current_time = time()
+            # The bucket has never been refilled, so it is new:
+            if state[1] == 0:
+                state[:] = [burst, current_time, rate, burst]
+            self._refill(state, current_time)
+            state[2] = rate
+            state[3] = burst
+            state[0] = min(state[0], burst)
+
+        self._update(set_parameters)
+
+    def get_burst(self):
+        """Returns the maximum number of tokens that the bucket can hold"""
+
+        return self._update(lambda state: state[3])
+
+    def get_level(self):
+        """Returns the number of tokens currently in the bucket"""
+
+        def level(state):
+            self._refill(state, time())
+            return state[0]
+
+        return self._update(level)
+
+    def get_rate(self):
+        """Returns the number of tokens added to the bucket per second (0 if rate limiting is disabled)"""
+
+        return self._update(lambda state: state[2])
+
+    def __setstate__(self, state):
+        """Restores the token bucket from its pickled state"""
+
+        self.__dict__.update(state)
+        self._file_lock = Lock()
+
+
+class ClientThrottle():
+    """A token bucket for each client (identified by any hashable key), kept in this process's memory"""
+
+    def __init__(self, rate = 0, burst = 1, capacity = 65536):
+        """Initializes a new ClientThrottle object, whose buckets are refilled with rate tokens per second and hold up to burst tokens
+
+        Only the buckets of the capacity most recently seen clients are kept, and a client that has been
+        forgotten starts over with a full bucket. A rate of 0 disables throttling.
+        """
+
+        if (type(capacity) is not int) or (capacity < 1):
+            raise ValueError('The "capacity" argument supplied must be an integer greater than 0')
+
+        self._capacity = capacity
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+        self.configure(rate, burst)
+
+    def __getstate__(self):
+        """Returns the picklable state of the throttle, without its lock"""
+
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def allow(self, client_key):
+        """Takes a token from a client's bucket and returns True, or returns False (without waiting) if the bucket is empty"""
+
+        if self._rate == 0:
+            return True
+        current_time = time()
+        with self._lock:
+            tokens, last_refill = self._buckets.pop(client_key, (self._burst, current_time))
+            # Clocks can step backwards, which must never remove tokens:
+            tokens = min(self._burst, tokens + (max(0, current_time - last_refill) * self._rate))
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[client_key] = (tokens, current_time)
+            if len(self._buckets) > self._capacity:
+                self._buckets.popitem(last = False)
+        return allowed
+
+    def configure(self, rate, burst):
+        """Changes the refill rate (in tokens per second) and burst size of every client's bucket"""
+
+        if type(rate) not in [int, float]:
+            raise TypeError('The "rate" argument supplied must be an int or float')
+        if rate < 0:
+            raise ValueError('The "rate" argument supplied cannot be less than 0')
+        if type(burst) is not int:
+            raise TypeError('The "burst" argument supplied must be an int')
+        if burst < 1:
+            raise ValueError('The "burst" argument supplied must be greater than 0')
+
+        self._rate = rate
+        self._burst = burst
+
+    def size(self):
+        """Returns the number of clients whose buckets are currently kept"""
+
+        return len(self._buckets)
+
+    def __setstate__(self, state):
+        """Restores the throttle from its pickled state"""
+
+        self.__dict__.update(state)
+        self._lock = Lock()
@@ -0,0 +1,90 @@
+"""Contains the time series used by Engines to report their recent activity, without keeping every observation"""
+
+from threading import Lock
+from time import time
+
+
+# Each ring buffer's resolution (in seconds), and the number of periods it holds:
+_RESOLUTIONS = [(1, 60), (60, 60), (60 * 60, 24)]
+
+
+class TimeSeries():
+    """Fixed-size ring buffers of per-second, per-minute, and per-hour totals, which can be shared by several processes"""
+
+    def __init__(self, metrics, shared = True):
+        """Initializes a new, empty TimeSeries object, which records observations of each of the named metrics
+
+        Each observation of a metric adds 1 to its count and its value to its total, in the current period of
+        every ring buffer. The ring buffers are kept in shared memory, and are shared with the processes started
+        by this process (or, if shared is False, in this process's memory, and are only shared with its threads).
+        Their size never changes, however many observations are recorded.
+        """
+
+        self._metrics = {metric: index for index, metric in enumerate(metrics)}
+        # Each period is recorded as its number, followed by the count and total of each metric:
+        self._period_size = 1 + (2 * len(self._metrics))
+        self._ring_offsets = []
+        data_size = 0
+        for _, periods in _RESOLUTIONS:
+            self._ring_offsets.append(data_size)
+            data_size += periods * self._period_size
+        self._start_time = time()
+        if shared:
+            from multiprocessing import Lock as ProcessLock, RawArray
+
+            self._data = RawArray('d', data_size)
+            self._lock = ProcessLock()
+        else:
+            self._data = [0.0] * data_size
+            self._lock = Lock()
+
+    def get_metrics(self):
+        """Returns the names of the metrics recorded by the time series"""
+
+        return list(self._metrics)
+
+    def get_window(self, seconds):
+        """Returns the count and total of each metric over (about) the last number of seconds provided, as a dictionary
+
+        The window is read from the finest ring buffer that covers it, so it is rounded up to a whole number of that
+        buffer's periods, the last of which is still in progress. The number of seconds actually covered (which is
+        never more than the time series has existed) is included as 'Seconds'.
+        """
+
+        if (type(seconds) not in [int, float]) or (seconds <= 0):
+            raise ValueError('The "seconds" argument supplied must be greater than 0')
+
+        current_time = time()
+        for (resolution, periods), offset in zip(_RESOLUTIONS, self._ring_offsets):
+            if resolution * periods >= seconds:
+                break
+        window_periods = min(periods, -(-seconds // resolution))
+        current_period = current_time // resolution
+        window = {metric: {'Count': 0, 'Total': 0.0} for metric in self._metrics}
+        with self._lock:
+            for period in range(int(current_period - window_periods) + 1, int(current_period) + 1):
+                position = offset + ((period % periods) * self._period_size)
+                # Periods that haven't been recorded since the ring buffer wrapped around still hold older totals:
+                if self._data[position] != period:
+                    continue
+                for metric, index in self._metrics.items():
+                    window[metric]['Count'] += int(self._data[position + 1 + (2 * index)])
+                    window[metric]['Total'] += self._data[position + 2 + (2 * index)]
+        covered_seconds = ((window_periods - 1) * resolution) + (current_time - (current_period * resolution))
+        window['Seconds'] = max(1, min(covered_seconds, current_time - self._start_time))
+        return window
+
+    def record(self, metric, value = 1):
+        """Records an observation of a metric (such as a duration, or a depth) in the current period"""
+
+        current_time = time()
+        index = 1 + (2 * self._metrics[metric])
+        with self._lock:
+            for (resolution, periods), offset in zip(_RESOLUTIONS, self._ring_offsets):
+                period = current_time // resolution
+                position = offset + (int(period % periods) * self._period_size)
+                # The ring buffer has wrapped around to this period's position, so the old period is started over:
+                if self._data[position] != period:
+                    self._data[position:position + self._period_size] = [period] + ([0.0] * (self._period_size - 1))
+                self._data[position + index] += 1
+                self._data[position + index + 1] += value
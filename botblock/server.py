@@ -0,0 +1,328 @@
+"""Contains the classes required to share a single BotBlock Engine between processes, over a Unix domain socket"""
+
+from base64 import b64decode, b64encode
+from json import dumps, loads
+from os import chmod, getpid, umask
+from pathlib import Path
+from socket import AF_UNIX, SOCK_STREAM, socket
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+from struct import Struct
+from threading import Lock, Thread
+
+
+# Every message is a JSON document, prefixed by its length in bytes:
+_MESSAGE_LENGTH = Struct('>I')
+# Requests only carry method names and short arguments, so a Server closes connections that send anything longer:
+_MAXIMUM_REQUEST_LENGTH = 64 * 1024
+
+# The Engine methods that clients are allowed to call, and the arguments that they may pass to each one
+# (which never include get_captcha's save_path, as clients must not be able to make the Server write files):
+_METHODS = {
+    'get_captcha': ['raw', 'profile', 'priority'],
+    'get_recent_stats': [],
+    'get_stats': [],
+    'validate': ['encrypted_blob', 'proposed_solution', 'client_key'],
+}
+
+
+def _decode_bytes(value):
+    """Restores bytes that were encoded by _encode_bytes while decoding JSON"""
+
+    if list(value) == ['__bytes__']:
+        return b64decode(value['__bytes__'])
+    return value
+
+
+def _encode_bytes(value):
+    """Encodes bytes (such as raw CAPTCHA images), which JSON cannot represent directly"""
+
+    if type(value) is bytes:
+        return {'__bytes__': b64encode(value).decode()}
+    raise TypeError(f'Object of type "{type(value)}" is not JSON serializable')
+
+
+def _receive_message(stream, maximum_length = 0):
+    """Reads one length-prefixed JSON message from a file-like stream, or returns None at the end of the stream
+
+    If maximum_length is not 0, a ValueError is raised (before the message is read) if the message is any longer.
+    """
+
+    header = stream.read(_MESSAGE_LENGTH.size)
+    if len(header) < _MESSAGE_LENGTH.size:
+        return None
+    length = _MESSAGE_LENGTH.unpack(header)[0]
+    if maximum_length and (length > maximum_length):
+        raise ValueError(f'The message length of {length} bytes exceeds the maximum of {maximum_length} bytes')
+    body = stream.read(length)
+    return loads(body, object_hook = _decode_bytes)
+
+
+def _encode_message(message):
+    """Returns a message as length-prefixed JSON"""
+
+    body = dumps(message, default = _encode_bytes).encode()
+    return _MESSAGE_LENGTH.pack(len(body)) + body
+
+
+class Client():
+    """A lightweight handle to an Engine owned by a Server, for use within web workers"""
+
+    def __init__(self, path):
+        """Initializes a new Client object for the Server listening at the provided socket path"""
+
+        self._path = str(path)
+        self._connection = None
+        self._connection_lock = Lock()
+        self._connection_pid = 0
+        self._stream = None
+
+    def __enter__(self):
+        """Enter the runtime context and return this object"""
+
+        return self
+
+    def _call(self, requests):
+        """Sends one or more requests over a single connection, and returns their results in order"""
+
+        with self._connection_lock:
+            # Connections cannot be shared with forked children, so each process opens its own:
+            if (self._connection is None) or (self._connection_pid != getpid()):
+                self._connect()
+            try:
+                self._connection.sendall(b''.join(_encode_message(request) for request in requests))
+                responses = [_receive_message(self._stream) for _ in requests]
+            except OSError:
+                self._disconnect()
+                raise
+            if None in responses:
+                self._disconnect()
+                raise ConnectionError('The BotBlock server closed the connection')
+
+        results = []
+        for response in responses:
+            if 'error' in response:
+                if response['error'] == 'TypeError':
+                    raise TypeError(response['message'])
+                if response['error'] == 'ValueError':
+                    raise ValueError(response['message'])
+                raise RuntimeError(response['message'])
+            results.append(response['result'])
+        return results
+
+    def _connect(self):
+        """Opens a new connection to the Server"""
+
+        self._disconnect()
+        self._connection = socket(AF_UNIX, SOCK_STREAM)
+        self._connection.connect(self._path)
+        self._connection_pid = getpid()
+        self._stream = self._connection.makefile('rb')
+
+    def _disconnect(self):
+        """Closes the current connection to the Server, if there is one"""
+
+        if self._connection is not None:
+            # Only close the socket in the process that opened it, so a parent's connection survives a fork:
+            if self._connection_pid == getpid():
+                self._stream.close()
+                self._connection.close()
+            self._connection = None
+            self._stream = None
+
+    def close(self):
+        """Closes the Client's connection to the Server"""
+
+        with self._connection_lock:
+            self._disconnect()
+
+    def get_captcha(self, raw = False, profile = 'default', priority = 0):
+        """Returns a new CAPTCHA and its metadata from the Server's Engine, taken from the named profile's pool at the provided priority"""
+
+        return self._call([{'method': 'get_captcha', 'args': [raw, profile, priority]}])[0]
+
+    def get_recent_stats(self):
+        """Returns the recent activity of the Server's Engine, as a dictionary"""
+
+        return self._call([{'method': 'get_recent_stats', 'args': []}])[0]
+
+    def get_stats(self):
+        """Returns the statistical information of the Server's Engine, as a dictionary"""
+
+        return self._call([{'method': 'get_stats', 'args': []}])[0]
+
+    def pipeline(self):
+        """Returns a Pipeline, for sending several requests to the Server at once"""
+
+        return Pipeline(self)
+
+    def validate(self, encrypted_blob, proposed_solution, client_key = None):
+        """Returns True if a CAPTCHA solution is valid according to the Server's Engine, and False if not"""
+
+        return self._call([{'method': 'validate', 'args': [encrypted_blob, proposed_solution, client_key]}])[0]
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Close the connection and exit the runtime context"""
+
+        self.close()
+
+
+class Pipeline():
+    """Queues requests for a Client, so that they are sent to the Server together and answered in a single round trip"""
+
+    def __init__(self, client):
+        """Initializes a new, empty Pipeline for the provided Client"""
+
+        self._client = client
+        self._requests = []
+
+    def __enter__(self):
+        """Enter the runtime context and return this object"""
+
+        return self
+
+    def execute(self):
+        """Sends all of the queued requests, and returns a list of their results, in order"""
+
+        if not self._requests:
+            return []
+        requests = self._requests
+        self._requests = []
+        return self._client._call(requests)
+
+    def get_captcha(self, raw = False, profile = 'default', priority = 0):
+        """Queues a request for a new CAPTCHA from the named profile, at the provided priority"""
+
+        self._requests.append({'method': 'get_captcha', 'args': [raw, profile, priority]})
+        return self
+
+    def get_recent_stats(self):
+        """Queues a request for the Engine's recent activity"""
+
+        self._requests.append({'method': 'get_recent_stats', 'args': []})
+        return self
+
+    def get_stats(self):
+        """Queues a request for the Engine's statistical information"""
+
+        self._requests.append({'method': 'get_stats', 'args': []})
+        return self
+
+    def validate(self, encrypted_blob, proposed_solution, client_key = None):
+        """Queues a request to validate a CAPTCHA solution, on behalf of the client identified by client_key (if provided)"""
+
+        self._requests.append({'method': 'validate', 'args': [encrypted_blob, proposed_solution, client_key]})
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Discard any requests that were not executed and exit the runtime context"""
+
+        self._requests = []
+
+
+class _RequestHandler(StreamRequestHandler):
+    """Answers the requests sent over a single Client connection, in order"""
+
+    def handle(self):
+        """Reads requests until the Client disconnects, and writes back a response to each"""
+
+        while True:
+            try:
+                request = _receive_message(self.rfile, _MAXIMUM_REQUEST_LENGTH)
+            except (OSError, ValueError):
+                # The connection is closed, as the rest of the stream can no longer be split into messages:
+                return
+            if request is None:
+                return
+            response = self.server._botblock_server._handle_request(request)
+            try:
+                self.wfile.write(_encode_message(response))
+            except OSError:
+                return
+
+
+class _UnixServer(ThreadingUnixStreamServer):
+    """A threaded Unix domain socket server, which does not block shut down on open connections"""
+
+    daemon_threads = True
+
+
+class Server():
+    """Owns a single Engine, and shares it with Clients in other processes over a Unix domain socket"""
+
+    def __init__(self, engine, path, permissions = 0o600):
+        """Initializes a new Server object for sharing an Engine at the provided socket path"""
+
+        from botblock.captcha import Engine
+
+        if not isinstance(engine, Engine):
+            raise TypeError(f'The "engine" argument supplied must be an instance of "Engine", not a "{type(engine)}"')
+        self._engine = engine
+        # Engine instances are only safe for concurrent calls to get_captcha (which may wait for the pool to be
+        # refilled), so all other requests from all connections are serialized:
+        self._engine_lock = Lock()
+        self._path = Path(path)
+        if self._path.is_socket():
+            self._path.unlink()
+        # The socket is created accessible only to this user, so that no one else can connect before it is chmod'ed:
+        previous_umask = umask(0o177)
+        try:
+            self._server = _UnixServer(str(self._path), _RequestHandler)
+        finally:
+            umask(previous_umask)
+        self._server._botblock_server = self
+        chmod(self._path, permissions)
+        self._serve_thread = None
+
+    def __enter__(self):
+        """Start serving in the background, then enter the runtime context and return this object"""
+
+        self.start()
+        return self
+
+    def _handle_request(self, request):
+        """Calls the requested Engine method, and returns a response describing its result"""
+
+        if type(request) is not dict:
+            return {'error': 'TypeError', 'message': f'The request must be a JSON object, not a "{type(request).__name__}"'}
+        method = request.get('method')
+        if method not in _METHODS:
+            return {'error': 'RuntimeError', 'message': f'The method "{method}" is not available'}
+        args = request.get('args', [])
+        if (type(args) is not list) or (len(args) > len(_METHODS[method])):
+            return {'error': 'TypeError', 'message': f'Too many arguments were supplied to the method "{method}"'}
+        try:
+            if method == 'get_captcha':
+                result = self._engine.get_captcha(**dict(zip(_METHODS[method], args)))
+            else:
+                with self._engine_lock:
+                    result = getattr(self._engine, method)(**dict(zip(_METHODS[method], args)))
+        except (RuntimeError, TypeError, ValueError) as exception:
+            return {'error': type(exception).__name__, 'message': str(exception)}
+        return {'result': result}
+
+    def serve_forever(self):
+        """Answers Client requests until the Server is shut down"""
+
+        self._server.serve_forever()
+
+    def shut_down(self):
+        """Stops answering Client requests and removes the socket file (the Engine itself is not shut down)"""
+
+        if self._serve_thread is not None:
+            self._server.shutdown()
+            self._serve_thread.join()
+            self._serve_thread = None
+        self._server.server_close()
+        if self._path.is_socket():
+            self._path.unlink()
+
+    def start(self):
+        """Starts answering Client requests on a background thread"""
+
+        self._serve_thread = Thread(target = self.serve_forever, args = (), daemon = True)
+        self._serve_thread.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Shut down the Server and exit the runtime context"""
+
+        self.shut_down()
@@ -0,0 +1,364 @@
+"""Contains a long-running soak and load test harness, for finding slow leaks and starvation in Engines"""
+
+from json import dumps
+from os import getpid
+from pathlib import Path
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep, time
+
+
+# The traffic patterns that the soak test can drive an Engine with:
+_PATTERNS = [
+    'steady',
+    'burst',
+    'replay',
+    'expired',
+]
+
+
+def _get_process_usage(pid):
+    """Returns the resident set size (in bytes) and number of threads of a process, or zeros if they are unavailable"""
+
+    rss = 0
+    threads = 0
+    try:
+        for line in Path(f'/proc/{pid}/status').read_text().splitlines():
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+            elif line.startswith('Threads:'):
+                threads = int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return rss, threads
+
+
+def _get_percentile(sorted_values, percentile):
+    """Returns a percentile of a sorted list of values, or 0 if the list is empty"""
+
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile))]
+
+
+class _SoakTraffic():
+    """Drives an Engine from several threads with one or more traffic patterns, and records what happens"""
+
+    def __init__(self, engine, patterns, workers):
+        """Initializes a new _SoakTraffic object for the provided Engine"""
+
+        self._engine = engine
+        # As with a Server, calls to validate are serialized, while get_captcha (which may wait for the pool to be
+        # refilled) is called concurrently, so that its latency isn't inflated by waiting for other calls:
+        self._engine_lock = Lock()
+        self._patterns = patterns
+        self._workers = workers
+        self._stop_event = Event()
+        self._threads = []
+        self._results_lock = Lock()
+        self._counters = {
+            'Issued': 0,
+            'Validated': 0,
+            'Solved': 0,
+            'Valid Rejected': 0,
+            'Replays Accepted': 0,
+            'Expired Accepted': 0,
+            'Errors': 0,
+        }
+        self._get_latencies = []
+        self._validate_latencies = []
+        self._validation_times = []
+
+    def _call(self, method, *args):
+        """Calls an Engine method, and records its latency"""
+
+        start_time = perf_counter()
+        if method == 'get_captcha':
+            result = self._engine.get_captcha(*args)
+        else:
+            with self._engine_lock:
+                result = getattr(self._engine, method)(*args)
+        latency = perf_counter() - start_time
+        with self._results_lock:
+            if method == 'get_captcha':
+                self._counters['Issued'] += 1
+                self._get_latencies.append(latency)
+            else:
+                self._counters['Validated'] += 1
+                self._validate_latencies.append(latency)
+                self._validation_times.append(time())
+        return result
+
+    def _count(self, counter):
+        """Increments one of the counters"""
+
+        with self._results_lock:
+            self._counters[counter] += 1
+
+    def _get_solution(self, encrypted_blob):
+        """Returns the solution of a Fernet blob, or an empty string for compact blobs (whose solutions cannot be recovered)"""
+
+        from cryptography.fernet import InvalidToken
+
+        try:
+            return self._engine._key_ring.get_fernet().decrypt(encrypted_blob).decode()
+        except InvalidToken:
+            return ''
+
+    def _issue_and_solve(self):
+        """Issues a CAPTCHA and validates it (with its solution, when it can be recovered), then returns its blob"""
+
+        encrypted_blob = self._call('get_captcha')['encrypted_blob']
+        solution = self._get_solution(encrypted_blob)
+        if solution:
+            if self._call('validate', encrypted_blob, solution):
+                self._count('Solved')
+            else:
+                self._count('Valid Rejected')
+        else:
+            self._call('validate', encrypted_blob, 'wrong')
+        return encrypted_blob
+
+    def _run_burst(self):
+        """Alternates between quiet periods and bursts large enough to empty the pool"""
+
+        while not self._stop_event.is_set():
+            for _ in range(max(1, self._engine.get_settings()._POOL_SIZE // self._workers)):
+                if self._stop_event.is_set():
+                    return
+                self._issue_and_solve()
+            self._stop_event.wait(5)
+
+    def _run_expired(self):
+        """Floods the Engine with authentic blobs that have already expired"""
+
+        from secrets import token_urlsafe
+
+        while not self._stop_event.is_set():
+            lifetime = self._engine.get_settings()._LIFETIME
+            solution = token_urlsafe(6)
+            encrypted_blob = self._engine._key_ring.get_fernet().encrypt_at_time(
+                solution.encode(),
+                int(time()) - lifetime - 60,
+            ).decode()
+            if self._call('validate', encrypted_blob, solution):
+                self._count('Expired Accepted')
+
+    def _run_replay(self):
+        """Solves CAPTCHAs, and then floods the Engine with replays of the blobs that were already used"""
+
+        used_blobs = []
+        while not self._stop_event.is_set():
+            used_blobs.append(self._issue_and_solve())
+            used_blobs = used_blobs[-100:]
+            for encrypted_blob in used_blobs:
+                if self._stop_event.is_set():
+                    return
+                if self._call('validate', encrypted_blob, self._get_solution(encrypted_blob) or 'wrong'):
+                    self._count('Replays Accepted')
+
+    def _run_steady(self):
+        """Issues and solves CAPTCHAs at a steady pace"""
+
+        while not self._stop_event.is_set():
+            self._issue_and_solve()
+            self._stop_event.wait(0.05)
+
+    def _run_worker(self, pattern):
+        """Runs a traffic pattern until the soak test is stopped, counting (rather than raising) any errors"""
+
+        while not self._stop_event.is_set():
+            try:
+                getattr(self, f'_run_{pattern}')()
+            except Exception:
+                self._count('Errors')
+                self._stop_event.wait(1)
+
+    def get_counters(self):
+        """Returns a copy of the counters"""
+
+        with self._results_lock:
+            return dict(self._counters)
+
+    def get_validations_since(self, since):
+        """Returns the number of validations attempted since the provided time"""
+
+        with self._results_lock:
+            self._validation_times = [
+                validation_time for validation_time in self._validation_times
+                if validation_time >= since
+            ]
+            return len(self._validation_times)
+
+    def start(self):
+        """Starts the worker threads, assigning the traffic patterns to them in turn"""
+
+        for i in range(self._workers):
+            thread = Thread(target = self._run_worker, args = (self._patterns[i % len(self._patterns)],), daemon = True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stops the worker threads, and waits for them to exit"""
+
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join()
+
+    def take_latencies(self):
+        """Returns (and resets) the sorted get_captcha and validate latencies recorded since the last call"""
+
+        with self._results_lock:
+            get_latencies = sorted(self._get_latencies)
+            validate_latencies = sorted(self._validate_latencies)
+            self._get_latencies = []
+            self._validate_latencies = []
+        return get_latencies, validate_latencies
+
+
+def run_soak_test(
+    settings = None,
+    patterns = None,
+    duration = 3600,
+    workers = 4,
+    sample_interval = 10,
+    report_path = '',
+    max_rss_growth = 0.25,
+    max_thread_growth = 2,
+    max_latency = 1.0,
+    max_empty_pool_samples = 3,
+):
+    """Drives an Engine with concurrent traffic for a long time, and checks it for leaks and starvation
+
+    Every sample_interval seconds, the RSS and thread count of all of the Engine's processes, the pool's depth,
+    the replay store's size, and the latency percentiles of get_captcha and validate are sampled, and written
+    to the JSONL report (if a path is provided). Returns a dictionary summarizing the test, including whether
+    it passed and a list of the thresholds that were exceeded.
+    """
+
+    from botblock.captcha import Engine, Settings
+
+    if settings:
+        if not isinstance(settings, Settings):
+            raise TypeError(f'The "settings" argument supplied must be an instance of "Settings", not a "{type(settings)}"')
+    else:
+        settings = Settings(POOL_SIZE = 100)
+    patterns = patterns or ['steady', 'burst', 'replay', 'expired']
+    for pattern in patterns:
+        if pattern not in _PATTERNS:
+            raise ValueError(f'The pattern "{pattern}" is not one of: {_PATTERNS}')
+    if (type(workers) is not int) or (workers < 1):
+        raise ValueError('The "workers" argument supplied must be an integer greater than 0')
+
+    report_file = open(report_path, 'w') if report_path else None
+    engine = Engine(settings)
+    pids = [getpid(), engine._captcha_generation_process.pid, engine._captcha_validation_process.pid]
+    pids += [process.pid for process in engine._captcha_refresh_processes]
+    traffic = _SoakTraffic(engine, patterns, workers)
+
+    print('BotBlock Engine Soak Test')
+    print('')
+    print(f'Driving an Engine with {workers} workers ({", ".join(patterns)}) for {duration} seconds,')
+    print(f'sampling every {sample_interval} seconds.')
+    print('')
+
+    samples = []
+    failures = []
+    empty_pool_samples = 0
+    start_time = time()
+    traffic.start()
+    try:
+        while time() - start_time < duration:
+            sleep(min(sample_interval, max(0, duration - (time() - start_time))))
+            # The queues' sizes and the shared replay store size can be read while the traffic is running:
+            fresh_captchas = engine._fresh_captchas.qsize()
+            used_captchas = engine._used_captchas.qsize()
+            replay_store_size = engine._replay_store_size.value
+            rss = 0
+            threads = 0
+            for pid in pids:
+                process_rss, process_threads = _get_process_usage(pid)
+                rss += process_rss
+                threads += process_threads
+            get_latencies, validate_latencies = traffic.take_latencies()
+            sample = {
+                'Elapsed': round(time() - start_time, 1),
+                'RSS': rss,
+                'Threads': threads,
+                'Fresh CAPTCHAs': fresh_captchas,
+                'Used CAPTCHAs': used_captchas,
+                'Replay Store Size': replay_store_size,
+                # Expired keys are only removed about every 30 seconds, so allow for a minute of extra keys:
+                'Replay Store Bound': traffic.get_validations_since(time() - settings._LIFETIME - 60),
+                'Get p50': round(_get_percentile(get_latencies, 0.5), 6),
+                'Get p99': round(_get_percentile(get_latencies, 0.99), 6),
+                'Validate p50': round(_get_percentile(validate_latencies, 0.5), 6),
+                'Validate p99': round(_get_percentile(validate_latencies, 0.99), 6),
+                'Counters': traffic.get_counters(),
+            }
+            samples.append(sample)
+            if report_file:
+                report_file.write(dumps(sample) + '\n')
+                report_file.flush()
+            print(
+                f"{sample['Elapsed']}s: RSS {round(rss / 1_048_576, 1)} MiB, {threads} threads, "
+                f"{fresh_captchas} fresh, get p99 {sample['Get p99']}s, validate p99 {sample['Validate p99']}s"
+            )
+
+            # Starvation is only reported when the pool stays empty, as bursts are expected to empty it briefly:
+            if fresh_captchas == 0:
+                empty_pool_samples += 1
+                if empty_pool_samples == max_empty_pool_samples:
+                    failures.append(f"The pool was empty for {empty_pool_samples} samples in a row at {sample['Elapsed']}s")
+            else:
+                empty_pool_samples = 0
+            if max(sample['Get p99'], sample['Validate p99']) > max_latency:
+                failures.append(f"The p99 latency exceeded {max_latency}s at {sample['Elapsed']}s")
+            if replay_store_size > sample['Replay Store Bound']:
+                failures.append(f"The replay store held more keys than could still be unexpired at {sample['Elapsed']}s")
+    finally:
+        traffic.stop()
+        engine.shut_down()
+
+    counters = traffic.get_counters()
+    # Growth is measured from the first quarter of the test (after warming up) to the last quarter:
+    if len(samples) >= 4:
+        quarter = len(samples) // 4
+        initial_rss = max(sample['RSS'] for sample in samples[:quarter])
+        final_rss = min(sample['RSS'] for sample in samples[-quarter:])
+        if initial_rss and (final_rss > initial_rss * (1 + max_rss_growth)):
+            failures.append(f'The RSS grew by more than {round(max_rss_growth * 100)}% ({initial_rss} to {final_rss} bytes)')
+        initial_threads = max(sample['Threads'] for sample in samples[:quarter])
+        final_threads = min(sample['Threads'] for sample in samples[-quarter:])
+        if final_threads > initial_threads + max_thread_growth:
+            failures.append(f'The number of threads grew by more than {max_thread_growth} ({initial_threads} to {final_threads})')
+    for counter in ['Valid Rejected', 'Replays Accepted', 'Expired Accepted', 'Errors']:
+        if counters[counter]:
+            failures.append(f'{counters[counter]} {counter.lower()}')
+
+    summary = {
+        'Passed': not failures,
+        'Failures': failures,
+        'Duration': round(time() - start_time, 1),
+        'Patterns': patterns,
+        'Workers': workers,
+        'Samples': len(samples),
+        'Counters': counters,
+    }
+    if report_file:
+        report_file.write(dumps({'Summary': summary}) + '\n')
+        report_file.close()
+
+    print('')
+    print('')
+    print('Soak Test Results:')
+    print('')
+    for counter, value in counters.items():
+        print(f'    {counter}: {value}')
+    print('')
+    if failures:
+        print('FAILED:')
+        for failure in failures:
+            print(f'    {failure}')
+    else:
+        print('PASSED')
+    return summary
@@ -0,0 +1,521 @@
+"""Contains the replay stores used by Engines to ensure that each CAPTCHA can only be validated once"""
+
+from abc import ABC, abstractmethod
+from collections import deque
+from os import getpid
+from threading import Lock, Thread
+from time import time
+
+
+class ReplayStore(ABC):
+    """The interface shared by all replay stores, which records keys until their time to live expires"""
+
+    def __getstate__(self):
+        """Returns the picklable state of the replay store, without its lock or connections"""
+
+        state = self.__dict__.copy()
+        for attribute in ['_connection', '_lock', '_stream']:
+            if attribute in state:
+                state[attribute] = None
+        return state
+
+    @abstractmethod
+    def add(self, key, ttl):
+        """Atomically records a key for ttl seconds, and returns True if it was not already recorded, and False if it was"""
+
+        pass
+
+    def add_many(self, keys, ttl):
+        """Records several keys for ttl seconds in a single batch, and returns a list of the results of add for each key"""
+
+        return [self.add(key, ttl) for key in keys]
+
+    def close(self):
+        """Releases any resources (such as connections) held by the replay store"""
+
+        pass
+
+    def expire(self):
+        """Removes expired keys (for replay stores that cannot do so automatically)"""
+
+        pass
+
+    @abstractmethod
+    def size(self):
+        """Returns the number of keys currently recorded"""
+
+        pass
+
+    def __setstate__(self, state):
+        """Restores the replay store from its pickled state"""
+
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+
+class MemoryReplayStore(ReplayStore):
+    """A replay store kept in the memory of a single process (the default)"""
+
+    def __init__(self):
+        """Initializes a new, empty MemoryReplayStore object"""
+
+        self._expirations = {}
+        self._lock = Lock()
+
+    def add(self, key, ttl):
+        """Atomically records a key for ttl seconds, and returns True if it was not already recorded, and False if it was"""
+
+        current_time = time()
+        with self._lock:
+            expiration = self._expirations.get(key)
+            if (expiration is not None) and (expiration > current_time):
+                return False
+            # Re-insert expired keys, so that the dictionary stays ordered by expiration time:
+            self._expirations.pop(key, None)
+            self._expirations[key] = current_time + ttl
+            return True
+
+    def expire(self):
+        """Removes expired keys"""
+
+        current_time = time()
+        with self._lock:
+            # Keys are (almost always) recorded with the same time to live, so the oldest keys are
+            # found at the start of the dictionary, and removal can stop at the first unexpired key:
+            expired_keys = []
+            for key, expiration in self._expirations.items():
+                if expiration > current_time:
+                    break
+                expired_keys.append(key)
+            for key in expired_keys:
+                del self._expirations[key]
+
+    def size(self):
+        """Returns the number of keys currently recorded"""
+
+        return len(self._expirations)
+
+
+class SerialReplayStore(ReplayStore):
+    """A replay store for serial numbers that are issued in increasing order, which uses one bit per serial number
+
+    Serial numbers are grouped into epochs of epoch_size consecutive numbers (rather than into periods of issuance
+    time, as each epoch's bitmap is indexed by serial number), and each epoch is recorded in a bitmap. Expiry is
+    still tied to issuance time: since serial numbers are issued in increasing order, every serial number in an
+    epoch was issued no later than any serial number in a later epoch, so once a serial number from a later epoch
+    was issued longer than ttl seconds ago, the earlier epoch's serial numbers have all expired, and its whole
+    bitmap is dropped.
+    """
+
+    def __init__(self, epoch_size = 65536):
+        """Initializes a new, empty SerialReplayStore object"""
+
+        if (type(epoch_size) is not int) or (epoch_size < 8) or (epoch_size % 8):
+            raise ValueError('The "epoch_size" argument supplied must be a positive multiple of 8')
+        self._epoch_size = epoch_size
+        self._bitmaps = {}
+        # The time at which the epochs before each epoch can be dropped (based on the earliest issue time recorded in it):
+        self._expirations = {}
+        self._last_dropped_epoch = -1
+        self._recorded = 0
+        self._lock = Lock()
+
+    def add(self, key, ttl, issue_time = None):
+        """Atomically records a serial number, and returns True if it was not already recorded, and False if it was
+
+        The issue_time is the time at which the serial number was issued (the current time, if it is not provided).
+        False is also returned for serial numbers that have expired, which can be told apart using is_expired.
+        """
+
+        if issue_time is None:
+            issue_time = time()
+        epoch, position = divmod(key, self._epoch_size)
+        byte, mask = position >> 3, 1 << (position & 7)
+        with self._lock:
+            # Serial numbers from dropped epochs have expired, so they can never be accepted again:
+            if epoch <= self._last_dropped_epoch:
+                return False
+            bitmap = self._bitmaps.get(epoch)
+            if bitmap is None:
+                bitmap = self._bitmaps[epoch] = bytearray(self._epoch_size // 8)
+            # Issue times may only be known to the second, so a second is added to keep earlier epochs long enough:
+            expiration = issue_time + ttl + 1
+            self._expirations[epoch] = min(self._expirations.get(epoch, expiration), expiration)
+            if bitmap[byte] & mask:
+                return False
+            bitmap[byte] |= mask
+            self._recorded += 1
+            return True
+
+    def expire(self):
+        """Drops the bitmaps of the epochs whose serial numbers have all expired"""
+
+        current_time = time()
+        with self._lock:
+            expired_epochs = [epoch for epoch, expiration in self._expirations.items() if expiration <= current_time]
+            if not expired_epochs:
+                return
+            newest_expired_epoch = max(expired_epochs)
+            for epoch in [epoch for epoch in self._bitmaps if epoch < newest_expired_epoch]:
+                self._recorded -= bin(int.from_bytes(self._bitmaps.pop(epoch), 'big')).count('1')
+                del self._expirations[epoch]
+            self._last_dropped_epoch = max(self._last_dropped_epoch, newest_expired_epoch - 1)
+
+    def is_expired(self, key):
+        """Returns True if a serial number's epoch has been dropped (so the serial number has expired), and False if not"""
+
+        with self._lock:
+            return key // self._epoch_size <= self._last_dropped_epoch
+
+    def get_memory_usage(self):
+        """Returns the total size (in bytes) of the bitmaps currently held"""
+
+        return len(self._bitmaps) * (self._epoch_size // 8)
+
+    def size(self):
+        """Returns the number of serial numbers currently recorded"""
+
+        return self._recorded
+
+
+class SQLiteReplayStore(ReplayStore):
+    """A replay store kept in an SQLite database file, which can be shared by several processes on the same host"""
+
+    def __init__(self, path, timeout = 5):
+        """Initializes a new SQLiteReplayStore object using the database file at the provided path"""
+
+        self._path = str(path)
+        self._timeout = timeout
+        self._connection = None
+        self._connection_pid = 0
+        self._lock = Lock()
+
+    def _get_connection(self):
+        """Returns this process's connection to the database, opening it first if necessary"""
+
+        from sqlite3 import connect
+
+        # Connections must not be shared with forked children, so each process opens its own:
+        if (self._connection is None) or (self._connection_pid != getpid()):
+            self._connection = connect(
+                self._path,
+                timeout = self._timeout,
+                isolation_level = None,
+                check_same_thread = False,
+            )
+            self._connection_pid = getpid()
+            self._connection.execute('PRAGMA journal_mode = WAL')
+            self._connection.execute('PRAGMA synchronous = NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS replay_store (key TEXT PRIMARY KEY, expiration REAL NOT NULL) WITHOUT ROWID'
+            )
+        return self._connection
+
+    def _insert(self, connection, key, ttl, current_time):
+        """Inserts a key, replacing it if it has expired, and returns True if it was inserted"""
+
+        cursor = connection.execute(
+            'INSERT INTO replay_store (key, expiration) VALUES (?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET expiration = excluded.expiration '
+            'WHERE replay_store.expiration <= ?',
+            (key, current_time + ttl, current_time),
+        )
+        return cursor.rowcount == 1
+
+    def add(self, key, ttl):
+        """Atomically records a key for ttl seconds, and returns True if it was not already recorded, and False if it was"""
+
+        with self._lock:
+            return self._insert(self._get_connection(), key, ttl, time())
+
+    def add_many(self, keys, ttl):
+        """Records several keys for ttl seconds in a single transaction, and returns a list of the results of add for each key"""
+
+        current_time = time()
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                results = [self._insert(connection, key, ttl, current_time) for key in keys]
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+            return results
+
+    def close(self):
+        """Closes this process's connection to the database"""
+
+        with self._lock:
+            if (self._connection is not None) and (self._connection_pid == getpid()):
+                self._connection.close()
+            self._connection = None
+
+    def expire(self):
+        """Removes expired keys"""
+
+        with self._lock:
+            self._get_connection().execute('DELETE FROM replay_store WHERE expiration <= ?', (time(),))
+
+    def size(self):
+        """Returns the number of keys currently recorded"""
+
+        with self._lock:
+            return self._get_connection().execute(
+                'SELECT COUNT(*) FROM replay_store WHERE expiration > ?', (time(),)
+            ).fetchone()[0]
+
+
+class RedisReplayStore(ReplayStore):
+    """A replay store kept on a network server that speaks the Redis protocol, which can be shared by many hosts"""
+
+    def __init__(self, host = 'localhost', port = 6379, unix_socket = '', prefix = 'botblock:', timeout = 5):
+        """Initializes a new RedisReplayStore object for the server at the provided address"""
+
+        self._host = host
+        self._port = port
+        self._unix_socket = unix_socket
+        self._prefix = prefix
+        self._timeout = timeout
+        self._connection = None
+        self._connection_pid = 0
+        self._stream = None
+        # The server expires keys itself, so only the expiration times of the keys recorded through this object are tracked:
+        self._expirations = deque()
+        self._lock = Lock()
+
+    def _connect(self):
+        """Opens a new connection to the server"""
+
+        from socket import AF_UNIX, SOCK_STREAM, create_connection, socket
+
+        self._disconnect()
+        if self._unix_socket:
+            self._connection = socket(AF_UNIX, SOCK_STREAM)
+            self._connection.settimeout(self._timeout)
+            self._connection.connect(self._unix_socket)
+        else:
+            self._connection = create_connection((self._host, self._port), timeout = self._timeout)
+        self._connection_pid = getpid()
+        self._stream = self._connection.makefile('rb')
+
+    def _disconnect(self):
+        """Closes the current connection to the server, if there is one"""
+
+        if self._connection is not None:
+            if self._connection_pid == getpid():
+                self._stream.close()
+                self._connection.close()
+            self._connection = None
+            self._stream = None
+
+    def _encode_command(self, *arguments):
+        """Returns a command encoded with the Redis serialization protocol"""
+
+        command = [f'*{len(arguments)}\r\n'.encode()]
+        for argument in arguments:
+            if type(argument) is not bytes:
+                argument = str(argument).encode()
+            command.append(f'${len(argument)}\r\n'.encode())
+            command.append(argument + b'\r\n')
+        return b''.join(command)
+
+    def _execute(self, commands):
+        """Sends several commands at once (pipelining them), and returns their replies in order"""
+
+        # Connections must not be shared with forked children, so each process opens its own:
+        if (self._connection is None) or (self._connection_pid != getpid()):
+            self._connect()
+        try:
+            self._connection.sendall(b''.join(commands))
+            return [self._read_reply() for _ in commands]
+        except Exception:
+            # Any replies left unread would be mistaken for the replies to later commands, so the connection is dropped:
+            self._disconnect()
+            raise
+
+    def _read_reply(self):
+        """Reads and returns a single reply from the server"""
+
+        line = self._stream.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('The Redis server closed the connection')
+        reply_type, value = line[:1], line[1:-2]
+        if reply_type == b'+':
+            return value.decode()
+        if reply_type == b'-':
+            raise RuntimeError(f'The Redis server returned an error: {value.decode()}')
+        if reply_type == b':':
+            return int(value)
+        if reply_type == b'$':
+            if int(value) == -1:
+                return None
+            data = self._stream.read(int(value) + 2)
+            return data[:-2]
+        if reply_type == b'*':
+            if int(value) == -1:
+                return None
+            return [self._read_reply() for _ in range(int(value))]
+        raise ConnectionError('The Redis server sent an invalid reply')
+
+    def _set_command(self, key, ttl):
+        """Returns the command that records a key (as str or bytes) only if it is absent, with a time to live"""
+
+        if type(key) is not bytes:
+            key = str(key).encode()
+        return self._encode_command('SET', self._prefix.encode() + key, 1, 'NX', 'PX', max(1, round(ttl * 1000)))
+
+    def add(self, key, ttl):
+        """Atomically records a key for ttl seconds, and returns True if it was not already recorded, and False if it was"""
+
+        return self.add_many([key], ttl)[0]
+
+    def add_many(self, keys, ttl):
+        """Records several keys for ttl seconds in a single pipelined batch, and returns a list of the results of add for each key"""
+
+        with self._lock:
+            results = [reply == 'OK' for reply in self._execute([self._set_command(key, ttl) for key in keys])]
+            expiration = time() + ttl
+            self._expirations.extend(expiration for result in results if result)
+        return results
+
+    def close(self):
+        """Closes this process's connection to the server"""
+
+        with self._lock:
+            self._disconnect()
+
+    def expire(self):
+        """Forgets the expiration times of the keys that the server has expired"""
+
+        current_time = time()
+        with self._lock:
+            # Keys are (almost always) recorded with the same time to live, so the oldest are at the start:
+            while self._expirations and (self._expirations[0] <= current_time):
+                self._expirations.popleft()
+
+    def size(self):
+        """Returns the number of unexpired keys recorded through this object (as of the last expiration)
+
+        Keys recorded by other processes or hosts sharing the server aren't counted, as counting every key
+        on the server would require scanning its whole keyspace.
+        """
+
+        return len(self._expirations)
+
+
+class LocalRedisServer():
+    """A minimal stand-in for a Redis server, run in this process, which only supports the commands used by RedisReplayStore
+
+    It listens on a Unix domain socket, so that RedisReplayStore can be tested and benchmarked without a real server.
+    """
+
+    def __init__(self, path):
+        """Initializes a new LocalRedisServer object listening at the provided socket path"""
+
+        from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+
+        local_server = self
+
+        class RequestHandler(StreamRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        arguments = local_server._read_command(self.rfile)
+                    except (OSError, ValueError):
+                        return
+                    if arguments is None:
+                        return
+                    try:
+                        self.wfile.write(local_server._execute(arguments))
+                    except OSError:
+                        return
+
+        class UnixServer(ThreadingUnixStreamServer):
+            daemon_threads = True
+
+        self._path = str(path)
+        self._values = {}
+        self._expirations = {}
+        self._lock = Lock()
+        self._server = UnixServer(self._path, RequestHandler)
+        self._serve_thread = None
+
+    def __enter__(self):
+        """Start serving in the background, then enter the runtime context and return this object"""
+
+        self.start()
+        return self
+
+    def _execute(self, arguments):
+        """Executes a command, and returns its reply encoded with the Redis serialization protocol"""
+
+        command = arguments[0].upper() if arguments else b''
+        if command == b'PING':
+            return b'+PONG\r\n'
+        if command == b'SET':
+            key, value = arguments[1], arguments[2]
+            options = [argument.upper() for argument in arguments[3:]]
+            ttl = None
+            if b'PX' in options:
+                ttl = int(options[options.index(b'PX') + 1]) / 1000
+            elif b'EX' in options:
+                ttl = int(options[options.index(b'EX') + 1])
+            current_time = time()
+            with self._lock:
+                expiration = self._expirations.get(key)
+                exists = (key in self._values) and ((expiration is None) or (expiration > current_time))
+                if exists and (b'NX' in options):
+                    return b'$-1\r\n'
+                self._values[key] = value
+                self._expirations[key] = None if ttl is None else current_time + ttl
+            return b'+OK\r\n'
+        return f'-ERR unknown command \'{command.decode(errors = "replace")}\'\r\n'.encode()
+
+    def _read_command(self, stream):
+        """Reads one command (an array of bulk strings) from a stream, or returns None at the end of the stream"""
+
+        line = stream.readline()
+        if not line:
+            return None
+        if line[:1] != b'*':
+            raise ValueError('Commands must be arrays of bulk strings')
+        arguments = []
+        for _ in range(int(line[1:-2])):
+            length = int(stream.readline()[1:-2])
+            arguments.append(stream.read(length + 2)[:-2])
+        return arguments
+
+    def expire(self):
+        """Removes expired keys"""
+
+        current_time = time()
+        with self._lock:
+            for key in [key for key, expiration in self._expirations.items() if (expiration is not None) and (expiration <= current_time)]:
+                del self._values[key]
+                del self._expirations[key]
+
+    def shut_down(self):
+        """Stops serving and removes the socket file"""
+
+        from os import unlink
+        from pathlib import Path
+
+        if self._serve_thread is not None:
+            self._server.shutdown()
+            self._serve_thread.join()
+            self._serve_thread = None
+        self._server.server_close()
+        if Path(self._path).is_socket():
+            unlink(self._path)
+
+    def start(self):
+        """Starts serving on a background thread"""
+
+        self._serve_thread = Thread(target = self._server.serve_forever, args = (), daemon = True)
+        self._serve_thread.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Shut down the server and exit the runtime context"""
+
+        self.shut_down()